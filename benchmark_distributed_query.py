@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Load-test harness for distributed_query.py.
+
+Generates synthetic labels and artists tables, starts mock data nodes for them
+(the artists table range-sharded across --shards nodes) plus the router, replays
+a workload of filter, aggregate and join queries and reports latency
+percentiles and the bytes moved per query.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import httpx
+import logging
+
+from mock_data_node import generate_synthetic_table
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Default workload: name -> SQL
+DEFAULT_WORKLOAD = {
+    'point_lookup': "SELECT * FROM artists WHERE id = 4242",
+    'filter': "SELECT id, name, score FROM artists WHERE country = 'SE' AND score > 99",
+    'aggregate': "SELECT country, COUNT(*), AVG(score) FROM artists GROUP BY country",
+    'top_n': "SELECT id, name, score FROM artists ORDER BY score DESC LIMIT 10",
+    'join_filter': ("SELECT artists.name, labels.name FROM artists JOIN labels ON artists.label_id = labels.id "
+                    "WHERE labels.country = 'JP' AND artists.score > 99"),
+    'join_aggregate': ("SELECT labels.country, COUNT(*) FROM artists JOIN labels ON artists.label_id = labels.id "
+                       "GROUP BY labels.country")
+}
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def wait_until_up(url: str, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+def start_cluster(args, work_dir: str) -> List[subprocess.Popen]:
+    """Generate the data, start the mock data nodes and the router. Returns the processes."""
+    labels_path = os.path.join(work_dir, 'labels.parquet')
+    artists_path = os.path.join(work_dir, 'artists.parquet')
+    logger.info(f"Generating {args.label_rows:,} labels and {args.artist_rows:,} artists in {work_dir}")
+    generate_synthetic_table('labels', args.label_rows, labels_path, args.seed)
+    generate_synthetic_table('artists', args.artist_rows, artists_path, args.seed, args.label_rows)
+
+    node_args = ['--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms)]
+    if args.bandwidth_mbps:
+        node_args += ['--bandwidth-mbps', str(args.bandwidth_mbps)]
+
+    # labels on one node, artists range-sharded on id across the others
+    nodes = [('labels', labels_path, None, {})]
+    shard_size = -(-args.artist_rows // args.shards)
+    for i in range(args.shards):
+        key_min, key_max = i * shard_size, (i + 1) * shard_size - 1
+        nodes.append(('artists', artists_path, f"id BETWEEN {key_min} AND {key_max}",
+                      {'key_min': key_min, 'key_max': key_max}))
+
+    processes = []
+    tables = {}
+    for i, (table, source, where, bounds) in enumerate(nodes):
+        port = args.base_port + i
+        command = [sys.executable, os.path.join(SCRIPT_DIR, 'mock_data_node.py'),
+                   '--table-name', table, '--source', source, '--port', str(port), *node_args]
+        if where:
+            command += ['--where', where]
+        processes.append(subprocess.Popen(command))
+        shard = {'url': 'http://127.0.0.1', 'port': port, 'table_name': table, **bounds}
+        if table == 'artists' and args.shards > 1:
+            tables.setdefault('artists', {'table_name': 'artists', 'shard_key': 'id', 'shards': []})
+            tables['artists']['shards'].append(shard)
+        else:
+            tables[table] = shard
+
+    config_path = os.path.join(work_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'tables': tables}, f, indent=2)
+
+    router_command = [sys.executable, os.path.join(SCRIPT_DIR, 'distributed_query.py'),
+                      '--config', config_path, '--host', '127.0.0.1', '--port', str(args.router_port)]
+    if not args.with_caches:
+        # Repeated queries would otherwise be answered from the router's caches
+        router_command += ['--result-cache-mb', '0', '--fragment-cache-mb', '0']
+    router_command += args.router_args
+    processes.append(subprocess.Popen(router_command))
+
+    for i in range(len(nodes)):
+        wait_until_up(f"http://127.0.0.1:{args.base_port + i}/")
+    wait_until_up(f"http://127.0.0.1:{args.router_port}/")
+    return processes
+
+def node_bytes_sent(client: httpx.Client, node_urls: List[str]) -> int:
+    return sum(client.get(f"{url}/stats").json()['bytes_sent'] for url in node_urls)
+
+def run_workload(args, workload: Dict[str, str]) -> Dict[str, Dict]:
+    """Replay every query of the workload and measure it."""
+    router_url = f"http://127.0.0.1:{args.router_port}"
+    node_urls = [f"http://127.0.0.1:{args.base_port + i}" for i in range(args.shards + 1)]
+    report = {}
+
+    with httpx.Client(timeout=args.timeout) as client:
+        def run_query(sql: str):
+            start_time = time.time()
+            response = client.post(f"{router_url}/query", json={'query': sql})
+            elapsed_ms = (time.time() - start_time) * 1000
+            response.raise_for_status()
+            return elapsed_ms, len(response.content), len(response.json()['results'])
+
+        for name, sql in workload.items():
+            print(f"\nRunning {name}: {sql}")
+            for _ in range(args.warmup):
+                run_query(sql)
+
+            node_bytes_before = node_bytes_sent(client, node_urls)
+            start_time = time.time()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(lambda _: run_query(sql), range(args.repeat)))
+            wall_time = time.time() - start_time
+            node_bytes = node_bytes_sent(client, node_urls) - node_bytes_before
+
+            latencies = [result[0] for result in results]
+            report[name] = {
+                'query': sql,
+                'runs': len(results),
+                'rows': results[0][2],
+                'p50_ms': percentile(latencies, 50),
+                'p90_ms': percentile(latencies, 90),
+                'p99_ms': percentile(latencies, 99),
+                'mean_ms': sum(latencies) / len(latencies),
+                'queries_per_second': len(results) / wall_time,
+                'node_bytes_per_query': node_bytes / len(results),
+                'response_bytes_per_query': sum(result[1] for result in results) / len(results)
+            }
+    return report
+
+def print_report(report: Dict[str, Dict]) -> None:
+    print(f"\n{'workload':<16}{'rows':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'qps':>8}"
+          f"{'node KB/q':>12}{'resp KB/q':>12}")
+    for name, stats in report.items():
+        print(f"{name:<16}{stats['rows']:>8,}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['queries_per_second']:>8.1f}"
+              f"{stats['node_bytes_per_query'] / 1024:>12.1f}{stats['response_bytes_per_query'] / 1024:>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark distributed_query.py against local mock data nodes')
+    parser.add_argument('--shards', type=int, default=2, help='Data nodes the artists table is range-sharded across')
+    parser.add_argument('--artist-rows', type=int, default=200000, help='Rows of the synthetic artists table')
+    parser.add_argument('--label-rows', type=int, default=1000, help='Rows of the synthetic labels table')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic data')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='Latency injected by each data node')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra latency injected by each data node')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Simulated bandwidth of each data node')
+    parser.add_argument('--workload', help='JSON file mapping workload names to SQL (default: built-in workload)')
+    parser.add_argument('--repeat', type=int, default=20, help='Measured runs per query')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured runs per query')
+    parser.add_argument('--concurrency', type=int, default=1, help='Queries in flight at once')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-query timeout in seconds')
+    parser.add_argument('--base-port', type=int, default=18001, help='Port of the first data node')
+    parser.add_argument('--router-port', type=int, default=18000, help='Port of the router')
+    parser.add_argument('--with-caches', action='store_true', help='Keep the router\'s result and fragment caches on')
+    parser.add_argument('--router-args', nargs=argparse.REMAINDER, default=[],
+                        help='Extra arguments passed to distributed_query.py (must come last)')
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    parser.add_argument('--work-dir', help='Directory for generated data and config (default: a temp directory)')
+
+    args = parser.parse_args()
+
+    workload = DEFAULT_WORKLOAD
+    if args.workload:
+        with open(args.workload) as f:
+            workload = json.load(f)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='distributed_query_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    processes = []
+    try:
+        processes = start_cluster(args, work_dir)
+        report = run_workload(args, workload)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+if __name__ == "__main__":
+    main()
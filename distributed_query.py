@@ -1,25 +1,65 @@
 #!/usr/bin/env python3
 import argparse
+import io
 import json
+import os
 import re
+import tempfile
 import time
 from datetime import datetime
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple, Union
 import httpx
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, model_validator
 import uvicorn
 import duckdb
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
 import asyncio
+import contextlib
+import contextvars
+import random
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Media types served by the streaming response mode
+STREAM_MEDIA_TYPES = {
+    'application/x-ndjson': 'ndjson',
+    'application/vnd.apache.arrow.stream': 'arrow'
+}
+
+# Fragments are requested as Arrow IPC streams, falling back to JSON for nodes that only speak JSON
+FRAGMENT_ACCEPT = 'application/vnd.apache.arrow.stream, application/json;q=0.5'
+
+# Aggregates that can be split into partial aggregates on the data nodes
+AGGREGATE_CALL_PATTERN = re.compile(r'(?i)\b(COUNT|SUM|MIN|MAX|AVG)\s*\(')
+
+# Upper bounds in seconds of the latency histogram buckets served on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# W3C trace context header: version-trace_id-parent_span_id-flags
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+# The span the running task or DuckDB call belongs to
+_current_span = contextvars.ContextVar('current_span', default=None)
+
 class QueryRequest(BaseModel):
     query: str
+    max_rows: Optional[int] = None  # Row cap for streamed results
 
 class QueryResponse(BaseModel):
     results: list
@@ -27,46 +67,569 @@ class QueryResponse(BaseModel):
     execution_time_ms: float
     timestamp: str
     source_tables: List[str]
+    trace_id: Optional[str] = None  # ID of the query's trace, see GET /traces/{trace_id}
 
-class TableConfig(BaseModel):
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued, running, succeeded, failed or cancelled
+    query: str
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    fragments_started: int = 0
+    fragments_done: int = 0
+    rows_fetched: int = 0  # Rows received from data nodes so far
+    result_rows: Optional[int] = None
+    error: Optional[str] = None
+    source_tables: List[str] = []
+
+class JobResultPage(BaseModel):
+    job_id: str
+    results: list
+    columns: list
+    offset: int
+    total_rows: int
+    next_offset: Optional[int] = None  # None on the last page
+
+class FragmentPlan(BaseModel):
+    table: str
+    node: str
+    sql: str
+    estimated_rows: Optional[int] = None
+    cached: Optional[bool] = None
+    rows: Optional[int] = None
+    bytes: Optional[int] = None
+    elapsed_ms: Optional[float] = None
+    cancelled: Optional[bool] = None  # Fetch abandoned once other shards returned enough rows for a LIMIT
+
+class ExplainResponse(BaseModel):
+    query: str
+    strategy: Optional[str]
+    details: Dict
+    fragments: List[FragmentPlan]
+    local_query: str
+    analyze: bool
+    fetch_ms: Optional[float] = None  # Wall time fetching remote fragments and loading them locally
+    register_ms: Optional[float] = None  # Time spent loading fragments into temporary tables
+    local_ms: Optional[float] = None
+    total_ms: Optional[float] = None
+    profile: Optional[str] = None  # DuckDB EXPLAIN ANALYZE output of the local query
+    source_tables: List[str]
+
+class ReplicaConfig(BaseModel):
     url: str
     port: int
+    
+    @property
+    def base_url(self) -> str:
+        """Base URL of the data container."""
+        base_url = self.url
+        if not base_url.startswith(('http://', 'https://')):
+            base_url = f"http://{base_url}"
+        return f"{base_url}:{self.port}"
+
+class ShardConfig(ReplicaConfig):
+    table_name: Optional[str] = None  # Table name on the data node (defaults to the table's table_name)
+    filename: Optional[str] = None
+    key_min: Optional[Union[int, float, str]] = None  # Inclusive lower bound of the shard key (range sharding)
+    key_max: Optional[Union[int, float, str]] = None  # Inclusive upper bound of the shard key (range sharding)
+    hash_remainder: Optional[int] = None  # Rows where hash(CAST(key AS VARCHAR)) % hash_modulus equals this
+    replicas: List[ReplicaConfig] = []  # Further data containers serving the same data
+    
+    def base_urls(self) -> List[str]:
+        """Base URLs of every data container serving the shard, the primary first."""
+        return [self.base_url] + [replica.base_url for replica in self.replicas]
+
+class TableConfig(BaseModel):
+    url: Optional[str] = None
+    port: Optional[int] = None
     table_name: str
+    filename: Optional[str] = None
+    shard_key: Optional[str] = None  # Column the shards are split on, used to prune shards
+    hash_modulus: Optional[int] = None  # Number of hash buckets for hash-sharded tables
+    shards: List[ShardConfig] = []  # Data containers each serving a slice of the table
+    replicas: List[ReplicaConfig] = []  # Further data containers serving an unsharded table
+    index_columns: List[str] = []  # Lookup columns its data containers sort and index on (--index-column)
+    
+    @model_validator(mode='after')
+    def _check_location(self):
+        if not self.shards and (self.url is None or self.port is None):
+            raise ValueError(f"Table '{self.table_name}' needs either url and port or a list of shards")
+        return self
+    
+    def get_shards(self) -> List[ShardConfig]:
+        """Return the table's shards; an unsharded table is a single shard."""
+        if self.shards:
+            return self.shards
+        return [ShardConfig(url=self.url, port=self.port, table_name=self.table_name,
+                            filename=self.filename, replicas=self.replicas)]
 
 class Config(BaseModel):
     tables: Dict[str, TableConfig]
 
+class ServerSettings(BaseModel):
+    max_stream_rows: Optional[int] = None  # Row cap for streamed results (None for no cap)
+    stream_batch_rows: int = 10000  # Rows per record batch when streaming
+    duckdb_threads: Optional[int] = None  # DuckDB worker threads (None for DuckDB's default)
+    duckdb_memory_limit: Optional[str] = None  # DuckDB memory limit, e.g. '4GB' (None for DuckDB's default)
+    duckdb_temp_directory: Optional[str] = None  # Where DuckDB and large fragments spill (default: a temp directory)
+    spill_threshold_mb: int = 64  # Arrow fragments larger than this are spooled to disk as they arrive (0 never)
+    duckdb_sessions: int = 8  # Pooled DuckDB cursors, i.e. queries executing at once
+    duckdb_workers: Optional[int] = None  # Threads running DuckDB calls (defaults to duckdb_sessions)
+    result_cache_mb: int = 256  # Memory for cached query results (0 disables the cache)
+    fragment_cache_mb: int = 256  # Memory for cached remote fragment results (0 disables the cache)
+    version_ttl: float = 5.0  # Seconds a data node's version token is trusted before re-checking
+    http2: bool = True  # Negotiate HTTP/2 with data nodes when h2 is installed
+    http_timeout: float = 30.0  # Read/write timeout for data node requests in seconds
+    http_connect_timeout: float = 5.0  # Connect timeout for data node requests in seconds
+    http_max_connections: int = 100  # Connections across all data nodes
+    http_max_keepalive: int = 20  # Idle keep-alive connections kept open
+    http_keepalive_expiry: float = 30.0  # Seconds an idle connection is kept
+    node_max_concurrency: int = 16  # In-flight requests per data node
+    retry_attempts: int = 3  # Attempts per idempotent request
+    retry_backoff: float = 0.1  # Base delay for exponential backoff in seconds
+    retry_backoff_max: float = 2.0  # Upper bound of a single backoff delay in seconds
+    hedge_after_ms: Optional[float] = None  # Send a second copy of a slow request after this delay
+    breaker_failure_threshold: int = 5  # Consecutive failures that open a node's circuit
+    breaker_reset_timeout: float = 30.0  # Seconds before an open circuit lets a trial request through
+    health_check_interval: float = 10.0  # Seconds between data node health probes (0 disables)
+    job_spool_dir: Optional[str] = None  # Where job results are written (default: a temp directory)
+    job_ttl: float = 3600.0  # Seconds a finished job's results are kept
+    job_http_timeout: float = 600.0  # Data node request timeout for background jobs
+    broadcast_max_rows: int = 10000  # Tables up to this size are kept resident in router memory once joined (0 disables)
+    semi_join_max_keys: int = 1000  # Largest key list pushed from a broadcast table to the other join side
+    limit_fanout: int = 2  # Shards asked at once for the rows of an unordered LIMIT query
+    trace_buffer: int = 100  # Traces of recent queries kept for /traces (0 keeps none)
+
+class NodeUnavailableError(Exception):
+    """Raised when a data node's circuit breaker is open."""
+
+class CircuitBreaker:
+    """Per-node circuit breaker.
+    
+    Opens after a number of consecutive failures and rejects requests until the
+    reset timeout has passed, then lets a single trial request through (half-open).
+    A successful trial closes the circuit again, a failed one re-opens it, and one
+    that ends without an answer (e.g. cancelled) hands the trial to the next request.
+    """
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+    
+    def available(self) -> bool:
+        """Return whether the node could take a request now, without claiming a half-open trial."""
+        if self.state == 'open':
+            return time.time() - self.opened_at >= self.reset_timeout
+        return self.state == 'closed'
+    
+    def allow(self) -> bool:
+        """Return whether a request may be sent to the node now."""
+        if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            return True
+        return self.state == 'closed'
+    
+    def record_success(self) -> None:
+        self.state = 'closed'
+        self.failures = 0
+    
+    def abandon_trial(self) -> None:
+        """Re-open a half-open circuit whose trial request ended without an answer. The reset
+        timeout has already passed, so the next request becomes the trial.
+        """
+        if self.state == 'half_open':
+            self.state = 'open'
+    
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Opening circuit after {self.failures} consecutive failures")
+            self.state = 'open'
+            self.opened_at = time.time()
+
+class Histogram:
+    """Cumulative histogram of observed values, rendered in the Prometheus text format."""
+    
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+    
+    def render(self, name: str, labels: str = '') -> List[str]:
+        prefix = f"{labels}," if labels else ''
+        lines = [f'{name}_bucket{{{prefix}le="{bound}"}} {count}' for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ''
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class NodeState:
+    """Connection bookkeeping for one data node: its circuit breaker, in-flight request cap,
+    outstanding requests, smoothed latency and the counters served on /metrics.
+    """
+    
+    LATENCY_ALPHA = 0.3  # Weight of the newest sample in the latency EWMA
+    
+    def __init__(self, settings: ServerSettings):
+        self.breaker = CircuitBreaker(settings.breaker_failure_threshold, settings.breaker_reset_timeout)
+        self.max_concurrency = settings.node_max_concurrency
+        self._semaphore = None  # Created on first use, inside the server's event loop
+        self.outstanding = 0
+        self.latency = None  # EWMA of response times in seconds, None until the first response
+        self.request_duration = Histogram()
+        self.errors: Dict[str, int] = {}  # Failed requests by kind: 4xx, 5xx, transport, circuit_open
+        self.bytes_received = 0
+        self.rows_received = 0
+        self.ready = True  # False while the node reports that it is still loading or warming up
+        self.readiness_probe = True  # Whether the node serves /health/ready; older nodes are probed at /
+    
+    def record_error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+    
+    def record_latency(self, seconds: float) -> None:
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_ALPHA * (seconds - self.latency)
+    
+    def load_score(self) -> float:
+        """Expected wait for a new request: smoothed latency scaled by the requests already queued.
+        Nodes without a latency sample score zero so they get tried.
+        """
+        return (self.latency or 0.0) * (self.outstanding + 1)
+    
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+class ResultCache:
+    """LRU cache of Arrow tables bounded by their total size in bytes."""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key) -> Optional[pa.Table]:
+        """Return the cached table for a key and mark it as most recently used."""
+        table = self._entries.get(key)
+        if table is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return table
+    
+    def put(self, key, table: pa.Table) -> None:
+        """Cache a table, evicting the least recently used entries to stay within the memory limit."""
+        size = table.nbytes
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.current_bytes -= self._entries.pop(key).nbytes
+        while self._entries and self.current_bytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+            self.evictions += 1
+        self._entries[key] = table
+        self.current_bytes += size
+    
+    def clear(self) -> None:
+        """Remove every entry."""
+        self._entries.clear()
+        self.current_bytes = 0
+    
+    def stats(self) -> Dict:
+        """Return size and hit statistics."""
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class Span:
+    """A timed operation in a query's trace, modelled on OpenTelemetry spans.
+    Spans of one trace share the list they are recorded in.
+    """
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], spans: List['Span'], attributes: Dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = 'ok'
+        self.start_time = time.time()
+        self.end_time = None
+        self.spans = spans
+        spans.append(self)
+    
+    @property
+    def traceparent(self) -> str:
+        """W3C trace context header value making this span the parent of a remote span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+    
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': datetime.fromtimestamp(self.start_time).isoformat(),
+            'duration_ms': (self.end_time - self.start_time) * 1000 if self.end_time else None,
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+class Tracer:
+    """Creates spans and keeps the traces of the most recent queries."""
+    
+    def __init__(self, max_traces: int):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()  # Trace ID -> spans
+    
+    @contextlib.contextmanager
+    def span(self, name: str, traceparent: Optional[str] = None, **attributes):
+        """Time a block as a child of the current span, or as the root of a new trace that
+        continues the caller's trace context if a traceparent header is given.
+        """
+        parent = _current_span.get()
+        if parent is not None:
+            trace_id, parent_id, spans = parent.trace_id, parent.span_id, parent.spans
+        else:
+            match = TRACEPARENT_PATTERN.match(traceparent or '')
+            trace_id, parent_id = match.groups() if match else (uuid.uuid4().hex, None)
+            spans = []
+            if self.max_traces:
+                self._traces[trace_id] = spans
+                self._traces.move_to_end(trace_id)
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+        
+        span = Span(name, trace_id, parent_id, spans, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.status = 'cancelled'
+            raise
+        except Exception as e:
+            span.status = 'error'
+            span.attributes['error'] = e.detail if isinstance(e, HTTPException) else str(e)
+            raise
+        finally:
+            span.end_time = time.time()
+            _current_span.reset(token)
+            logger.debug(f"Span {span.name} of trace {trace_id}: {(span.end_time - span.start_time) * 1000:.2f}ms")
+    
+    def get_trace(self, trace_id: str) -> List[Dict]:
+        if trace_id not in self._traces:
+            raise HTTPException(status_code=404, detail=f"Trace {trace_id} not found")
+        return [span.to_dict() for span in self._traces[trace_id]]
+    
+    def recent(self) -> List[Dict]:
+        """Summaries of the kept traces, newest first."""
+        summaries = []
+        for trace_id, spans in reversed(self._traces.items()):
+            root = spans[0]
+            summaries.append({
+                'trace_id': trace_id,
+                'name': root.name,
+                'start_time': datetime.fromtimestamp(root.start_time).isoformat(),
+                'duration_ms': (root.end_time - root.start_time) * 1000 if root.end_time else None,
+                'status': root.status,
+                'spans': len(spans)
+            })
+        return summaries
+
+def current_span() -> Optional[Span]:
+    """Return the span the caller runs in, if any."""
+    return _current_span.get()
+
+class QuerySession:
+    """Per-query state: a DuckDB cursor from the router's pool and the temporary tables created on it."""
+    
+    def __init__(self, cursor: duckdb.DuckDBPyConnection, record_fragments: bool = False, dry_run: bool = False,
+                 http_timeout: Optional[float] = None):
+        self.cursor = cursor
+        self.query_id = uuid.uuid4().hex[:12]
+        self.temp_tables: List[str] = []
+        # Fragment records for /explain and job progress; dry runs record fragments without fetching them
+        self.fragments: Optional[List[Dict]] = [] if record_fragments else None
+        self.dry_run = dry_run
+        self.plan: Dict = {}
+        self.register_seconds = 0.0
+        self.http_timeout = http_timeout  # Overrides the client's timeout for this query's fragments
+    
+    def temp_table(self, table: str) -> str:
+        """Return a temporary table name unique to this query."""
+        temp_table = f"temp_{table}_{self.query_id}"
+        self.temp_tables.append(temp_table)
+        return temp_table
+
+class QueryJob:
+    """A query running in the background, its results spooled to a Parquet file."""
+    
+    def __init__(self, query: str, spool_dir: str):
+        self.job_id = uuid.uuid4().hex
+        self.query = query
+        self.path = os.path.join(spool_dir, f"{self.job_id}.parquet")
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.result_rows: Optional[int] = None
+        self.tables: List[str] = []
+        self.fragments: List[Dict] = []
+        self.session: Optional[QuerySession] = None
+        self.task: Optional[asyncio.Task] = None
+    
+    def to_status(self) -> JobStatus:
+        def timestamp(t: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(t).isoformat() if t else None
+        done = [fragment for fragment in self.fragments if fragment.get('rows') is not None]
+        return JobStatus(
+            job_id=self.job_id,
+            status=self.status,
+            query=self.query,
+            created_at=timestamp(self.created_at),
+            started_at=timestamp(self.started_at),
+            finished_at=timestamp(self.finished_at),
+            fragments_started=len(self.fragments),
+            fragments_done=len(done),
+            rows_fetched=sum(fragment['rows'] for fragment in done),
+            result_rows=self.result_rows,
+            error=self.error,
+            source_tables=self.tables
+        )
+
 class DistributedQueryServer:
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, settings: Optional[ServerSettings] = None):
         self.config = self._load_config(config_path)
+        self.settings = settings or ServerSettings()
         self.conn = duckdb.connect(database=':memory:')
-        self.client = httpx.AsyncClient(timeout=30.0)  # 30 second timeout
+        if self.settings.duckdb_threads:
+            self.conn.execute(f"SET threads={int(self.settings.duckdb_threads)}")
+        # Under the memory limit DuckDB's joins, sorts and aggregates spill to the temp directory
+        self.spill_dir = self.settings.duckdb_temp_directory or os.path.join(tempfile.gettempdir(), 'distributed_query_spill')
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.conn.execute("SET temp_directory = ?", [self.spill_dir])
+        if self.settings.duckdb_memory_limit:
+            self.conn.execute("SET memory_limit = ?", [self.settings.duckdb_memory_limit])
+        self._cursor_pool = None  # Created on first use, inside the server's event loop
+        self._db_executor = ThreadPoolExecutor(
+            max_workers=self.settings.duckdb_workers or self.settings.duckdb_sessions,
+            thread_name_prefix='duckdb'
+        )
+        # One pooled client for every data node request, with keep-alive connections
+        self.client = httpx.AsyncClient(
+            http2=self.settings.http2 and HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(self.settings.http_timeout, connect=self.settings.http_connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.settings.http_max_connections,
+                max_keepalive_connections=self.settings.http_max_keepalive,
+                keepalive_expiry=self.settings.http_keepalive_expiry
+            )
+        )
+        self._node_states = {}  # Base URL -> NodeState
         self._metadata_cache = {}  # Cache for table metadata
         self._metadata_cache_time = {}  # Cache timestamp for metadata
         self._metadata_cache_ttl = 300  # Cache TTL in seconds (5 minutes)
+        self._version_cache = {}  # Table -> (version token, time fetched)
+        self.result_cache = ResultCache(self.settings.result_cache_mb * 1024 * 1024)
+        self.fragment_cache = ResultCache(self.settings.fragment_cache_mb * 1024 * 1024)
+        self._jobs: Dict[str, QueryJob] = {}
+        self._broadcast_tables: Dict[str, Dict] = {}  # Table -> resident copy: local name, version, size
+        self._broadcast_locks: Dict[str, asyncio.Lock] = {}
+        self.job_spool_dir = self.settings.job_spool_dir or os.path.join(tempfile.gettempdir(), 'distributed_query_jobs')
+        os.makedirs(self.job_spool_dir, exist_ok=True)
+        self.tracer = Tracer(self.settings.trace_buffer)
+        self.query_duration = Histogram()
+        self.query_errors = 0
         
+    async def _run_db(self, func, *args):
+        """Run a blocking DuckDB call on the worker pool instead of the event loop.
+        The call runs in the caller's context, so its spans join the caller's trace. If the
+        caller is cancelled, it still waits for the call to stop (interrupt its cursor to hurry
+        that), so the cursor is not reused and the call's files are not removed under it.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._db_executor, lambda: context.run(func, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+    
+    async def _acquire_session(self, **kwargs) -> QuerySession:
+        """Take a DuckDB cursor from the pool, waiting while all of them are in use."""
+        if self._cursor_pool is None:
+            self._cursor_pool = asyncio.Queue()
+            for _ in range(self.settings.duckdb_sessions):
+                self._cursor_pool.put_nowait(self.conn.cursor())
+        return QuerySession(await self._cursor_pool.get(), **kwargs)
+    
+    async def _release_session(self, session: QuerySession) -> None:
+        """Drop the session's temporary tables and return its cursor to the pool."""
+        try:
+            await self._run_db(self._drop_temp_tables, session)
+        finally:
+            self._cursor_pool.put_nowait(session.cursor)
+    
+    @contextlib.asynccontextmanager
+    async def _session(self, **kwargs):
+        """Hold a query session for the duration of a block."""
+        session = await self._acquire_session(**kwargs)
+        try:
+            yield session
+        finally:
+            await self._release_session(session)
+    
+    def _create_temp_table(self, session: QuerySession, table: str, data: pa.Table) -> str:
+        """Copy a remote result into a temporary table that only this session can see."""
+        temp_table = session.temp_table(table)
+        if session.dry_run:
+            return temp_table
+        start_time = time.time()
+        with self.tracer.span('register', table=table, rows=data.num_rows):
+            session.cursor.register(f"df_{temp_table}", data)
+            try:
+                session.cursor.execute(f"CREATE TEMP TABLE {temp_table} AS SELECT * FROM df_{temp_table}")
+            finally:
+                session.cursor.unregister(f"df_{temp_table}")
+        session.register_seconds += time.time() - start_time
+        return temp_table
+    
     def _load_config(self, config_path: str) -> Config:
         """Load configuration from JSON file."""
         with open(config_path, 'r') as f:
             config_data = json.load(f)
         return Config(**config_data)
     
-    def _parse_query(self, query: str) -> Set[str]:
-        """Extract table names from the query."""
-        # Simple regex to find table names in FROM and JOIN clauses
-        table_pattern = r'(?i)(?:FROM|JOIN)\s+(\w+)'
-        tables = set(re.findall(table_pattern, query))
-        return tables
-    
-    def _validate_tables(self, tables: Set[str]) -> None:
-        """Validate that all tables in the query exist in the config."""
-        missing_tables = tables - set(self.config.tables.keys())
-        if missing_tables:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Tables not found in configuration: {', '.join(missing_tables)}"
-            )
-    
     def _parse_join_conditions(self, query: str) -> Tuple[List[str], List[str], List[str]]:
         """Parse join conditions from SQL query to determine table relationships."""
         # Extract table names from FROM and JOIN clauses
@@ -93,8 +656,11 @@ class DistributedQueryServer:
                 current_table = parts[i + 1].strip(';')
                 tables.append(current_table)
             elif word == 'on':
-                # Extract join condition
-                condition = ' '.join(parts[i + 1:]).split('where')[0].strip(';')
+                # Extract join condition up to the next JOIN or clause keyword
+                condition = re.split(
+                    r'(?i)\s+(?:(?:left|right|full|inner|cross|outer)\s+)*join\s|\s+where\s|\s+group\s+by\s|\s+having\s|\s+order\s+by\s|\s+limit\s',
+                    ' '.join(parts[i + 1:])
+                )[0].strip(';')
                 join_conditions.append(condition)
             elif word == 'where':
                 in_where = True
@@ -105,20 +671,347 @@ class DistributedQueryServer:
         
         return tables, join_conditions, where_conditions
 
-    def _extract_limit(self, query: str) -> Optional[int]:
-        """Extract LIMIT clause from the query."""
-        limit_pattern = r'(?i)LIMIT\s+(\d+)'
-        match = re.search(limit_pattern, query)
-        if match:
-            return int(match.group(1))
-        return None
+    def _parse_join_types(self, query: str) -> List[str]:
+        """Return the join type (INNER, LEFT, LEFT OUTER, ...) of each JOIN clause in order."""
+        join_pattern = r'(?i)\b((?:(?:LEFT|RIGHT|FULL|INNER|CROSS)\s+)?(?:OUTER\s+)?)JOIN\s'
+        return [' '.join(match.group(1).upper().split()) or 'INNER' for match in re.finditer(join_pattern, query)]
 
-    def _remove_limit(self, query: str) -> str:
-        """Remove LIMIT clause from the query."""
-        return re.sub(r'(?i)\s+LIMIT\s+\d+', '', query)
+    def _plan_join_pre_aggregation(self, components: Dict, tables: List[str], join_conditions: List[str],
+                                   join_types: List[str], common_where_conditions: List[str],
+                                   table_metadata: Dict) -> Dict[str, List[str]]:
+        """Find join inputs that contribute nothing but their join keys to an aggregate query.
+        
+        Such an input can be reduced on its data node to one row per distinct key plus a
+        row count, and the aggregates above the join weighted by that count.
+        Returns a mapping of table name to its join key columns.
+        """
+        if any(join_type != 'INNER' for join_type in join_types):
+            return {}
+        if not self._plan_partial_aggregation(components, '1'):
+            return {}
+        
+        # Collect the join keys of each table; only simple equi-joins qualify
+        join_keys = {table: [] for table in tables}
+        for condition in join_conditions:
+            for conjunct in self._split_conjuncts(condition):
+                match = re.fullmatch(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', conjunct.strip())
+                if not match or match.group(1) not in join_keys or match.group(3) not in join_keys:
+                    return {}
+                for table, column in (match.group(1, 2), match.group(3, 4)):
+                    if column not in join_keys[table]:
+                        join_keys[table].append(column)
+        
+        # Everything the query reads above the join, without string literals
+        referenced_text = ' '.join(filter(None, [
+            components['select'], components.get('group_by'),
+            components.get('having'), components.get('order_by')
+        ] + common_where_conditions))
+        referenced_text = re.sub(r"'[^']*'", "''", referenced_text)
+        unqualified = {word.lower() for word in re.findall(r'(?<![\w.])([A-Za-z_]\w*)(?!\s*[.(\w])', referenced_text)}
+        
+        collapsed = {}
+        for table in tables:
+            columns = {col.get('name', '').lower() for col in table_metadata[table].get('columns', [])}
+            referenced = {col.lower() for col in re.findall(rf'\b{table}\.(\w+)', referenced_text)}
+            referenced |= unqualified & columns
+            if join_keys[table] and referenced <= {key.lower() for key in join_keys[table]}:
+                collapsed[table] = join_keys[table]
+        return collapsed
+
+    def _node_state(self, base_url: str) -> NodeState:
+        """Return the connection state of a data node, creating it on first use."""
+        if base_url not in self._node_states:
+            self._node_states[base_url] = NodeState(self.settings)
+        return self._node_states[base_url]
+    
+    async def _send(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        """Send a request. A streamed response returns once the headers arrive; the caller reads and closes it."""
+        if not stream:
+            return await self.client.request(method, url, **kwargs)
+        return await self.client.send(self.client.build_request(method, url, **kwargs), stream=True)
+    
+    async def _send_hedged(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        """Send a request, racing a second copy against it if the first is slow to answer."""
+        if not self.settings.hedge_after_ms:
+            return await self._send(method, url, stream, **kwargs)
+        
+        attempts = [asyncio.ensure_future(self._send(method, url, stream, **kwargs))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.settings.hedge_after_ms / 1000)
+            if not done:
+                logger.info(f"Hedging slow request to {url}")
+                attempts.append(asyncio.ensure_future(self._send(method, url, stream, **kwargs)))
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        winner = attempt
+                        return attempt.result()
+            # Every copy failed; surface the first error
+            return attempts[0].result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+                # A streamed copy that lost the race still holds its connection
+                if stream and attempt is not winner and attempt.done() and not attempt.cancelled() \
+                        and attempt.exception() is None:
+                    await attempt.result().aclose()
+    
+    async def _request_node(self, base_url: str, method: str, path: str, idempotent: bool = True,
+                            attempts: Optional[int] = None, stream: bool = False, **kwargs) -> httpx.Response:
+        """Send a request to a data node through the shared client.
+        
+        Idempotent requests are retried on connection errors and 5xx responses with
+        exponential backoff and jitter. Failures feed the node's circuit breaker, and
+        requests to a node with an open circuit fail immediately. A streamed response
+        is returned unread and must be closed by the caller.
+        """
+        node = self._node_state(base_url)
+        url = f"{base_url}{path}"
+        if attempts is None:
+            attempts = self.settings.retry_attempts if idempotent else 1
+        # Propagate the trace so the data node's spans join the query's trace
+        span = current_span()
+        if span is not None:
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'traceparent': span.traceparent}
+        
+        for attempt in range(1, attempts + 1):
+            if not node.breaker.allow():
+                node.record_error('circuit_open')
+                raise NodeUnavailableError(f"Circuit open for data node {base_url}")
+            try:
+                node.outstanding += 1
+                try:
+                    async with node.semaphore:
+                        start_time = time.time()
+                        if idempotent:
+                            response = await self._send_hedged(method, url, stream, **kwargs)
+                        else:
+                            response = await self._send(method, url, stream, **kwargs)
+                        node.record_latency(time.time() - start_time)
+                        node.request_duration.observe(time.time() - start_time)
+                finally:
+                    node.outstanding -= 1
+                if stream and response.status_code >= 400:
+                    # Read the error body so it can be reported, which also releases the connection
+                    await response.aread()
+                if response.status_code < 500:
+                    # The node is healthy even if it rejected this particular request
+                    node.breaker.record_success()
+                    if response.status_code >= 400:
+                        node.record_error('4xx')
+                    response.raise_for_status()
+                    return response
+                node.record_error('5xx')
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500:
+                    raise
+                node.breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                logger.warning(f"Attempt {attempt} of {method} {url} failed: {str(e)}")
+            except httpx.TransportError as e:
+                node.record_error('transport')
+                node.breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                logger.warning(f"Attempt {attempt} of {method} {url} failed: {str(e)}")
+            except BaseException:
+                # Cancelled (a lost hedge, a LIMIT fetch no longer needed, a deleted job) or failed
+                # without a response: this says nothing about the node, but must not hold a trial
+                node.breaker.abandon_trial()
+                raise
+            
+            # Full-jitter exponential backoff
+            delay = min(self.settings.retry_backoff_max, self.settings.retry_backoff * 2 ** (attempt - 1))
+            await asyncio.sleep(random.uniform(0, delay))
+    
+    def _rank_replicas(self, base_urls: List[str]) -> List[str]:
+        """Order a shard's replicas by expected wait, skipping those with an open circuit or not ready.
+        Ties are broken randomly so equally loaded replicas share the traffic.
+        """
+        candidates = list(base_urls)
+        random.shuffle(candidates)
+        available = [url for url in candidates
+                     if self._node_state(url).breaker.available() and self._node_state(url).ready]
+        # With every circuit open, still try them all so the error reaches the caller
+        return sorted(available or candidates, key=lambda url: self._node_state(url).load_score())
+    
+    async def _request_shard(self, shard: ShardConfig, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request to the best replica of a shard, failing over to the others on error.
+        A shard with a single replica keeps the usual retries; with several, each replica
+        gets one attempt and failing over replaces retrying.
+        """
+        base_urls = self._rank_replicas(shard.base_urls())
+        if len(base_urls) == 1:
+            return await self._request_node(base_urls[0], method, path, **kwargs)
+        
+        for i, base_url in enumerate(base_urls):
+            try:
+                return await self._request_node(base_url, method, path, attempts=1, **kwargs)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500 or i == len(base_urls) - 1:
+                    raise
+                logger.warning(f"Replica {base_url} failed, failing over: {str(e)}")
+            except (httpx.TransportError, NodeUnavailableError) as e:
+                if i == len(base_urls) - 1:
+                    raise
+                logger.warning(f"Replica {base_url} failed, failing over: {str(e)}")
+    
+    async def _check_replica_health(self, base_url: str) -> None:
+        """Probe a data node's readiness, feeding its latency and circuit breaker.
+        A node that is up but still loading or warming up gets no traffic, without counting as failed.
+        """
+        node = self._node_state(base_url)
+        start_time = time.time()
+        try:
+            path = '/health/ready' if node.readiness_probe else '/'
+            response = await self.client.get(f"{base_url}{path}", timeout=self.settings.http_connect_timeout)
+            if response.status_code == 404 and node.readiness_probe:
+                logger.info(f"Data node {base_url} has no /health/ready, probing / instead")
+                node.readiness_probe = False
+                start_time = time.time()
+                response = await self.client.get(f"{base_url}/", timeout=self.settings.http_connect_timeout)
+            if response.status_code == 503 and node.readiness_probe:
+                if node.ready:
+                    logger.info(f"Data node {base_url} is not ready: {response.text}")
+                node.ready = False
+                return
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Health check of {base_url} failed: {str(e)}")
+            node.breaker.record_failure()
+            return
+        if not node.ready:
+            logger.info(f"Data node {base_url} is ready")
+        node.ready = True
+        node.record_latency(time.time() - start_time)
+        node.breaker.record_success()
+    
+    async def _health_check_loop(self) -> None:
+        """Periodically probe every data node, which also closes the circuit of a node that recovered."""
+        while True:
+            base_urls = {
+                base_url
+                for table_config in self.config.tables.values()
+                for shard in table_config.get_shards()
+                for base_url in shard.base_urls()
+            }
+            await asyncio.gather(*[self._check_replica_health(base_url) for base_url in base_urls])
+            await asyncio.sleep(self.settings.health_check_interval)
+    
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        """Run the data node health checks while the app is serving."""
+        task = None
+        if self.settings.health_check_interval > 0:
+            task = asyncio.create_task(self._health_check_loop())
+        try:
+            yield
+        finally:
+            if task:
+                task.cancel()
+            await asyncio.gather(*[self.cancel_job(job.job_id) for job in list(self._jobs.values())])
+            await self.client.aclose()
+    
+    def _normalize_sql(self, query: str) -> str:
+        """Normalize whitespace and case outside quoted literals so equivalent query texts match."""
+        parts = re.split(r"('(?:[^']|'')*'|\"[^\"]*\")", query.strip().rstrip(';').strip())
+        return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part).lower() for i, part in enumerate(parts))
+    
+    async def _get_shard_version(self, shard: ShardConfig) -> Optional[str]:
+        """Get the version token of a shard's data, re-checked at most every version_ttl seconds.
+        Returns None if the data container cannot report one.
+        """
+        current_time = time.time()
+        cached = self._version_cache.get(shard.base_url)
+        if cached and current_time - cached[1] < self.settings.version_ttl:
+            return cached[0]
+        
+        try:
+            response = await self._request_shard(shard, 'GET', '/version')
+            version = response.json().get('version')
+        except Exception as e:
+            logger.warning(f"Could not get data version from {shard.base_url}/version: {str(e)}")
+            version = None
+        
+        self._version_cache[shard.base_url] = (version, current_time)
+        return version
+    
+    async def _get_table_version(self, table: str) -> Optional[str]:
+        """Get a version token covering every shard of a table, or None if any shard has none."""
+        shards = self.config.tables[table].get_shards()
+        versions = await asyncio.gather(*[self._get_shard_version(shard) for shard in shards])
+        if any(version is None for version in versions):
+            return None
+        return '|'.join(versions)
+    
+    async def _result_cache_key(self, query: str, tables: List[str]) -> Optional[Tuple]:
+        """Build the result cache key from the normalized query and each source table's version.
+        Returns None if the result must not be cached.
+        """
+        if not self.result_cache.max_bytes or not tables or any(t not in self.config.tables for t in tables):
+            return None
+        versions = await asyncio.gather(*[self._get_table_version(table) for table in tables])
+        if any(version is None for version in versions):
+            return None
+        return self._normalize_sql(query), tuple(sorted(zip(tables, versions)))
+    
+    def _response_to_table(self, result: Dict) -> pa.Table:
+        """Convert a data container's JSON response to an Arrow table, keeping the columns of empty results.
+        Columns mixing types that Arrow cannot unify are kept as strings.
+        """
+        arrays = []
+        for column in result["columns"]:
+            values = [row.get(column) for row in result["results"]]
+            try:
+                arrays.append(pa.array(values))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                arrays.append(pa.array([None if value is None else str(value) for value in values], pa.string()))
+        return pa.Table.from_arrays(arrays, names=result["columns"])
+    
+    async def _read_arrow_response(self, response: httpx.Response) -> Tuple[pa.Table, int]:
+        """Read a data container's Arrow IPC stream response. Returns the table and the body size.
+        
+        A body larger than the spill threshold is written to a file in the spill directory as it
+        arrives and memory-mapped, so the fragment is paged in from disk rather than held in memory.
+        """
+        threshold = self.settings.spill_threshold_mb * 1024 * 1024
+        buffer = io.BytesIO()
+        spill = None
+        size = 0
+        try:
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if spill is None and threshold and size > threshold:
+                    spill = tempfile.NamedTemporaryFile(dir=self.spill_dir, prefix='fragment_', suffix='.arrows', delete=False)
+                    spill.write(buffer.getvalue())
+                    buffer = None
+                (buffer if spill is None else spill).write(chunk)
+        except BaseException:
+            if spill is not None:
+                spill.close()
+                os.remove(spill.name)
+            raise
+        if spill is None:
+            return pa.ipc.open_stream(buffer.getvalue()).read_all(), size
+        
+        spill.close()
+        try:
+            table = pa.ipc.open_stream(pa.memory_map(spill.name)).read_all()
+        finally:
+            # The mapping keeps the data readable; the disk space is freed along with the table
+            os.remove(spill.name)
+        logger.info(f"Spilled {size / 1024 / 1024:.1f} MB fragment to {self.spill_dir}")
+        return table, size
     
     async def _get_table_metadata(self, table: str) -> Dict:
-        """Get metadata about a table from its data container with caching."""
+        """Get metadata about a table from its data containers with caching.
+        The row count of a sharded table is the sum over its shards.
+        """
         # Check if we have cached metadata that's still valid
         current_time = time.time()
         if (table in self._metadata_cache and 
@@ -126,91 +1019,495 @@ class DistributedQueryServer:
             current_time - self._metadata_cache_time[table] < self._metadata_cache_ttl):
             return self._metadata_cache[table]
         
-        table_config = self.config.tables[table]
+        async def get_shard_metadata(shard: ShardConfig) -> Dict:
+            url = f"{shard.base_url}/metadata"
+            logger.info(f"Getting metadata from {url}")
+            try:
+                response = await self._request_shard(shard, 'GET', '/metadata')
+                return response.json()
+            except NodeUnavailableError as e:
+                raise self._node_query_error(url, e)
+            except Exception as e:
+                logger.error(f"Error getting metadata from {url}: {str(e)}")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Error getting metadata from {url}: {str(e)}"
+                )
         
-        # Ensure URL has http:// prefix
-        base_url = table_config.url
-        if not base_url.startswith(('http://', 'https://')):
-            base_url = f"http://{base_url}"
+        shard_metadata = await asyncio.gather(*[
+            get_shard_metadata(shard) for shard in self.config.tables[table].get_shards()
+        ])
+        metadata = dict(shard_metadata[0])
+        metadata['row_count'] = sum(shard.get('row_count', 0) for shard in shard_metadata)
         
-        url = f"{base_url}:{table_config.port}/metadata"
-        logger.info(f"Getting metadata from {url}")
+        # Cache the metadata
+        self._metadata_cache[table] = metadata
+        self._metadata_cache_time[table] = current_time
         
+        return metadata
+    
+    def _parse_literal(self, text: str) -> Tuple[bool, Union[int, float, str, None]]:
+        """Parse a SQL number or string literal. Returns (is_literal, value)."""
+        text = text.strip()
+        if re.fullmatch(r"'(?:[^']|'')*'", text):
+            return True, text[1:-1].replace("''", "'")
+        for parse in (int, float):
+            try:
+                return True, parse(text)
+            except ValueError:
+                pass
+        return False, None
+    
+    def _key_predicates(self, key: str, conditions: List[str]) -> List[Tuple[str, List]]:
+        """Extract (operator, literal values) pairs that the conditions place on a column.
+        An '=' predicate with several values comes from an IN list and matches any of them.
+        """
+        column = rf'(?:\w+\.)?{re.escape(key)}'
+        predicates = []
+        for condition in conditions:
+            for conjunct in self._split_conjuncts(condition):
+                conjunct = conjunct.strip()
+                comparison = re.fullmatch(rf'(?is){column}\s*(=|<=|>=|<|>)\s*(.+)', conjunct)
+                in_list = re.fullmatch(rf'(?is){column}\s+IN\s*\((.*)\)', conjunct)
+                between = re.fullmatch(rf'(?is){column}\s+BETWEEN\s+(.+?)\s+AND\s+(.+)', conjunct)
+                if comparison:
+                    is_literal, value = self._parse_literal(comparison.group(2))
+                    if is_literal:
+                        predicates.append((comparison.group(1), [value]))
+                elif in_list:
+                    parsed = [self._parse_literal(item) for item in self._split_top_level(in_list.group(1))]
+                    if parsed and all(is_literal for is_literal, _ in parsed):
+                        predicates.append(('=', [value for _, value in parsed]))
+                elif between:
+                    for operator, text in (('>=', between.group(1)), ('<=', between.group(2))):
+                        is_literal, value = self._parse_literal(text)
+                        if is_literal:
+                            predicates.append((operator, [value]))
+        return predicates
+    
+    def _hash_bucket(self, value, modulus: int) -> int:
+        """Hash bucket of a shard key value, matching hash(CAST(key AS VARCHAR)) % modulus in DuckDB."""
+        return self.conn.execute("SELECT hash(CAST(? AS VARCHAR)) % ?", [str(value), modulus]).fetchone()[0]
+    
+    def _shard_may_match(self, table_config: TableConfig, shard: ShardConfig, operator: str, values: List) -> bool:
+        """Return False only if no shard key value in the shard can satisfy the predicate."""
+        if operator == '=' and shard.hash_remainder is not None and table_config.hash_modulus:
+            return any(self._hash_bucket(value, table_config.hash_modulus) == shard.hash_remainder for value in values)
         try:
-            response = await self.client.get(url)
-            response.raise_for_status()
-            metadata = response.json()
-            
-            # Cache the metadata
-            self._metadata_cache[table] = metadata
-            self._metadata_cache_time[table] = current_time
-            
-            return metadata
-        except Exception as e:
-            logger.error(f"Error getting metadata from {url}: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error getting metadata from {url}: {str(e)}"
-            )
+            for value in values:
+                above_min = shard.key_min is None or {
+                    '=': shard.key_min <= value, '<': shard.key_min < value, '<=': shard.key_min <= value
+                }.get(operator, True)
+                below_max = shard.key_max is None or {
+                    '=': value <= shard.key_max, '>': value < shard.key_max, '>=': value <= shard.key_max
+                }.get(operator, True)
+                if above_min and below_max:
+                    return True
+            return False
+        except TypeError:
+            # The literal and the shard bounds are not comparable
+            return True
     
-    async def _execute_remote_query(self, table: str, query: str) -> pd.DataFrame:
-        """Execute a query on a remote data container."""
+    def _select_shards(self, table: str, where_conditions: List[str]) -> List[ShardConfig]:
+        """Return the shards of a table whose key range or hash bucket can match the conditions."""
         table_config = self.config.tables[table]
+        shards = table_config.get_shards()
+        if len(shards) == 1 or not table_config.shard_key:
+            return shards
         
-        # Ensure URL has http:// prefix but avoid double prefixes
-        base_url = table_config.url
-        if base_url.startswith(('http://', 'https://')):
-            # URL already has a prefix, use it as is
-            url = f"{base_url}:{table_config.port}/query"
+        predicates = self._key_predicates(table_config.shard_key, where_conditions)
+        selected = [
+            shard for shard in shards
+            if all(self._shard_may_match(table_config, shard, operator, values) for operator, values in predicates)
+        ]
+        if len(selected) < len(shards):
+            logger.info(f"Pruned {len(shards) - len(selected)} of {len(shards)} shards of {table}")
+        # A query no shard can answer still needs one (empty) result with the table's columns
+        return selected or shards[:1]
+    
+    def _shard_query(self, table: str, shard: ShardConfig, query: str) -> str:
+        """Point a fragment query at the table name the shard's data node serves."""
+        table_config = self.config.tables[table]
+        names = '|'.join(re.escape(name) for name in {table, table_config.table_name})
+        node_table = shard.table_name or table_config.table_name
+        return re.sub(rf'(?i)\bFROM\s+(?:{names})\b(?:\s+AS\s+\w+)?', f"FROM {node_table} AS {table}", query, count=1)
+    
+    async def _execute_remote_query(self, table: str, query: str, where_conditions: Optional[List[str]] = None,
+                                    session: Optional[QuerySession] = None,
+                                    limit: Optional[int] = None) -> pa.Table:
+        """Scatter a query to the table's shards in parallel and gather the results.
+        Shards that the WHERE conditions rule out are not queried. With a limit (for an
+        unordered LIMIT query) shards are asked progressively until enough rows arrived.
+        """
+        shards = self._select_shards(table, where_conditions or [])
+        if limit is not None and len(shards) > 1:
+            frames = await self._fetch_until_limit(table, shards, query, limit, session)
         else:
-            # URL needs a prefix
-            url = f"http://{base_url}:{table_config.port}/query"
+            frames = await asyncio.gather(*[self._execute_shard_query(table, shard, query, session) for shard in shards])
+        if len(frames) == 1:
+            result = frames[0]
+        else:
+            # Shards answering in JSON may disagree on the type of a column that is all NULL on some
+            result = pa.concat_tables([frame for frame in frames if frame.num_rows] or frames[:1],
+                                      promote_options='permissive')
+        # All-NULL columns carry no type; make them strings rather than the INTEGER DuckDB would pick
+        for i, field in enumerate(result.schema):
+            if pa.types.is_null(field.type):
+                result = result.set_column(i, field.name, result.column(i).cast(pa.string()))
+        return result
+    
+    async def _fetch_until_limit(self, table: str, shards: List[ShardConfig], query: str, limit: int,
+                                 session: Optional[QuerySession] = None) -> List[pa.Table]:
+        """Query shards a few at a time until they have returned limit rows between them,
+        then cancel the fetches still outstanding and leave the remaining shards alone.
+        """
+        frames = []
+        rows = 0
+        remaining = list(shards)
+        pending = set()
+        try:
+            while remaining or pending:
+                while remaining and len(pending) < self.settings.limit_fanout:
+                    shard = remaining.pop(0)
+                    pending.add(asyncio.ensure_future(self._execute_shard_query(table, shard, query, session)))
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    frames.append(task.result())
+                    rows += len(frames[-1])
+                if rows >= limit:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        if pending or remaining:
+            logger.info(f"LIMIT {limit} on {table} satisfied by {len(frames)} of {len(shards)} shards; "
+                        f"cancelled {len(pending)}, skipped {len(remaining)}")
+        return frames
+    
+    async def _execute_shard_query(self, table: str, shard: ShardConfig, query: str,
+                                   session: Optional[QuerySession] = None) -> pa.Table:
+        """Execute a query on one shard, reusing cached fragments of unchanged data.
+        Sessions being explained get a record of the fragment; dry runs stop there.
+        """
+        query = self._shard_query(table, shard, query)
+        fragment = None
+        if session is not None and session.fragments is not None:
+            fragment = {'table': table, 'shard': shard, 'node': shard.base_url, 'sql': query}
+            session.fragments.append(fragment)
+            if session.dry_run:
+                return pa.table({})
         
+        with self.tracer.span('fragment', table=table, node=shard.base_url, sql=query) as span:
+            start_time = time.time()
+            version = await self._get_shard_version(shard) if self.fragment_cache.max_bytes else None
+            cache_key = (shard.base_url, self._normalize_sql(query), version)
+            if version is not None:
+                cached = self.fragment_cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"Fragment cache hit for {shard.base_url}: {query}")
+                    if fragment is not None:
+                        fragment.update(cached=True, rows=cached.num_rows, bytes=0,
+                                        elapsed_ms=(time.time() - start_time) * 1000)
+                    span.attributes.update(cached=True, rows=cached.num_rows)
+                    return cached
+            
+            timeout = session.http_timeout if session is not None and session.http_timeout else httpx.USE_CLIENT_DEFAULT
+            try:
+                data = await self._fetch_remote_query(shard, query, fragment, timeout)
+            except asyncio.CancelledError:
+                if fragment is not None:
+                    fragment.update(cancelled=True, elapsed_ms=(time.time() - start_time) * 1000)
+                raise
+            if fragment is not None:
+                fragment.update(cached=False, rows=data.num_rows, elapsed_ms=(time.time() - start_time) * 1000)
+            span.attributes.update(cached=False, rows=data.num_rows)
+            if version is not None:
+                self.fragment_cache.put(cache_key, data)
+            return data
+    
+    async def _fetch_remote_query(self, shard: ShardConfig, query: str, fragment: Optional[Dict] = None,
+                                  timeout=httpx.USE_CLIENT_DEFAULT) -> pa.Table:
+        """Send a query to one of a shard's data containers.
+        If a fragment record is given, the replica that answered and the response size are noted in it.
+        """
+        url = f"{shard.base_url}/query"
         logger.info(f"Executing remote query on {url}: {query}")
         
         try:
-            response = await self.client.post(
-                url,
-                json={"query": query}
-            )
-            response.raise_for_status()
-            result = response.json()
+            # Fragment queries are read-only, so they are safe to retry and fail over. The body is
+            # streamed so that large Arrow results can go straight to disk
+            response = await self._request_shard(shard, 'POST', '/query', json={"query": query}, timeout=timeout,
+                                                 headers={'Accept': FRAGMENT_ACCEPT}, stream=True)
+            try:
+                if response.headers.get('content-type', '').startswith('application/vnd.apache.arrow.stream'):
+                    data, size = await self._read_arrow_response(response)
+                else:
+                    body = await response.aread()
+                    data, size = self._response_to_table(json.loads(body)), len(body)
+            finally:
+                await response.aclose()
             
-            # Convert the results to a pandas DataFrame
-            df = pd.DataFrame(result["results"])
-            if not df.empty:
-                df.columns = result["columns"]
-            return df
-        except httpx.HTTPError as e:
-            logger.error(f"HTTP error when querying {url}: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error connecting to data container at {url}: {str(e)}"
-            )
+            node = f"{response.url.scheme}://{response.url.netloc.decode()}"
+            if fragment is not None:
+                fragment['node'] = node
+                fragment['bytes'] = size
+            span = current_span()
+            if span is not None:
+                span.attributes.update(node=node, bytes=size)
+            node_state = self._node_state(node)
+            node_state.bytes_received += size
+            node_state.rows_received += data.num_rows
+            return data
         except Exception as e:
-            logger.error(f"Error when querying {url}: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Unexpected error when querying {url}: {str(e)}"
-            )
+            raise self._node_query_error(url, e)
+    
+    def _node_query_error(self, url: str, e: Exception) -> HTTPException:
+        """Map a failed data node query to the HTTP error the router answers with."""
+        if isinstance(e, NodeUnavailableError):
+            logger.error(str(e))
+            return HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, httpx.HTTPError):
+            logger.error(f"HTTP error when querying {url}: {str(e)}")
+            return HTTPException(status_code=500, detail=f"Error connecting to data container at {url}: {str(e)}")
+        logger.error(f"Error when querying {url}: {str(e)}")
+        return HTTPException(status_code=500, detail=f"Unexpected error when querying {url}: {str(e)}")
+    
+    async def _open_forward_stream(self, table: str, query: str, stream_format: str,
+                                   max_rows: Optional[int]) -> httpx.Response:
+        """Send a single-shard query to its data node, asking for the client's streaming format.
+        Returns the response once its headers arrive; the body is relayed by _relay_stream.
+        """
+        components = self._parse_query_components(query)
+        if max_rows is not None:
+            # The node stops at the row cap, so the relayed stream needs no counting
+            limit = components['limit']
+            components['limit'] = str(min(int(limit), max_rows)) if limit else str(max_rows)
+        where_conditions = [components['where']] if components['where'] else []
+        shard = self._select_shards(table, where_conditions)[0]
+        shard_query = self._shard_query(table, shard, self._build_container_query(components))
+        media_type = next(media for media, name in STREAM_MEDIA_TYPES.items() if name == stream_format)
+        
+        url = f"{shard.base_url}/query"
+        logger.info(f"Forwarding streamed query to {url}: {shard_query}")
+        with self.tracer.span('fragment', table=table, node=shard.base_url, sql=shard_query, streamed=True):
+            try:
+                return await self._request_shard(shard, 'POST', '/query', json={"query": shard_query},
+                                                 headers={'Accept': f"{media_type}, {FRAGMENT_ACCEPT}"}, stream=True)
+            except Exception as e:
+                raise self._node_query_error(url, e)
     
-    async def _optimize_join_query(self, query: str) -> Tuple[str, List[str]]:
-        """Optimize join query by querying smaller table first and pushing down WHERE clauses."""
+    async def _relay_stream(self, response: httpx.Response, stream_format: str):
+        """Pass a data node's streamed result on to the client as it arrives, so the router never
+        holds it. A node that answers in another format (e.g. JSON only) is read and re-encoded.
+        """
+        node = f"{response.url.scheme}://{response.url.netloc.decode()}"
+        media_type = next(media for media, name in STREAM_MEDIA_TYPES.items() if name == stream_format)
+        content_type = response.headers.get('content-type', '')
+        size = 0
+        try:
+            if content_type.startswith(media_type):
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    yield chunk
+            else:
+                if content_type.startswith('application/vnd.apache.arrow.stream'):
+                    data, size = await self._read_arrow_response(response)
+                else:
+                    body = await response.aread()
+                    data, size = self._response_to_table(json.loads(body)), len(body)
+                sink = io.BytesIO()
+                reader = data.to_reader(self.settings.stream_batch_rows)
+                writer = pa.ipc.new_stream(sink, data.schema) if stream_format == 'arrow' else None
+                while True:
+                    chunk = await self._run_db(self._read_chunk, reader, writer, sink, None)
+                    if chunk is None:
+                        break
+                    yield chunk[0]
+                if writer:
+                    writer.close()
+                    yield sink.getvalue()
+            logger.info(f"Relayed {size:,} bytes from {node}")
+        finally:
+            self._node_state(node).bytes_received += size
+            await response.aclose()
+    
+    def _store_broadcast_table(self, name: str, table: pa.Table) -> None:
+        """Replace a resident broadcast table; queries already reading the old copy keep their snapshot."""
+        cursor = self.conn.cursor()
+        try:
+            cursor.register(f"df_{name}", table)
+            cursor.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM df_{name}")
+            cursor.unregister(f"df_{name}")
+        finally:
+            cursor.close()
+    
+    def _drop_broadcast_tables(self) -> None:
+        cursor = self.conn.cursor()
+        try:
+            for resident in self._broadcast_tables.values():
+                cursor.execute(f"DROP TABLE IF EXISTS {resident['name']}")
+        finally:
+            cursor.close()
+        self._broadcast_tables.clear()
+    
+    async def _broadcast_version(self, table: str, metadata: Dict) -> Optional[str]:
+        """Return the version a resident copy of a table would have, or None if the table is
+        too large to broadcast or its data node reports no version to validate a copy against.
+        """
+        row_count = metadata.get('row_count')
+        if not self.settings.broadcast_max_rows or row_count is None or row_count > self.settings.broadcast_max_rows:
+            return None
+        return await self._get_table_version(table)
+    
+    async def _get_broadcast_table(self, table: str, metadata: Dict) -> Optional[str]:
+        """Return the local resident copy of a small table, loading or refreshing it when the
+        source's version token changes. Returns None if the table is not broadcast.
+        """
+        version = await self._broadcast_version(table, metadata)
+        if version is None:
+            return None
+        
+        resident = self._broadcast_tables.get(table)
+        if resident and resident['version'] == version:
+            return resident['name']
+        
+        # One refresh per table at a time; concurrent queries wait for it
+        lock = self._broadcast_locks.setdefault(table, asyncio.Lock())
+        async with lock:
+            resident = self._broadcast_tables.get(table)
+            if resident and resident['version'] == version:
+                return resident['name']
+            
+            logger.info(f"Loading broadcast copy of {table} (version {version})")
+            table_config = self.config.tables[table]
+            data = await self._execute_remote_query(table, f"SELECT * FROM {table_config.table_name} AS {table}")
+            name = f"broadcast_{table}"
+            await self._run_db(self._store_broadcast_table, name, data)
+            self._broadcast_tables[table] = {
+                'name': name,
+                'version': version,
+                'rows': data.num_rows,
+                'bytes': data.nbytes,
+                'loaded_at': datetime.now().isoformat()
+            }
+            return name
+    
+    def _join_keys(self, name: str, table: str, column: str, conditions: List[str],
+                   session: Optional[QuerySession] = None) -> Optional[List[str]]:
+        """Return the distinct join keys of a local table as SQL literals, or None if there are
+        too many or they are not plain integers or strings. Temporary tables are read through
+        the session that created them.
+        """
+        where_clause = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        max_keys = self.settings.semi_join_max_keys
+        cursor = session.cursor if session is not None else self.conn.cursor()
+        try:
+            rows = cursor.execute(
+                f"SELECT DISTINCT {column} FROM {name} AS {table}{where_clause} LIMIT {max_keys + 1}"
+            ).fetchall()
+        finally:
+            if session is None:
+                cursor.close()
+        if len(rows) > max_keys:
+            return None
+        
+        literals = []
+        for (value,) in rows:
+            if value is None:
+                continue  # NULL keys never match an equi-join
+            if isinstance(value, int) and not isinstance(value, bool):
+                literals.append(str(value))
+            elif isinstance(value, str):
+                literals.append("'" + value.replace("'", "''") + "'")
+            else:
+                return None
+        return literals
+    
+    async def _plan_semi_joins(self, tables: List[str], join_conditions: List[str], join_types: List[str],
+                               broadcast: Dict[str, str], table_where_conditions: Dict[str, List[str]]) -> List[str]:
+        """Restrict the fetched side of each equi-join with a broadcast table to the keys that the
+        broadcast side holds. Only applies to inner joins, where unmatched rows are dropped anyway,
+        and to conjuncts of the form small.x = large.y of join conditions without OR.
+        Returns the pushed predicates.
+        """
+        if any(join_type != 'INNER' for join_type in join_types):
+            return []
+        
+        pushed = []
+        for condition in join_conditions:
+            conjuncts = [conjunct.strip() for conjunct in self._split_conjuncts(condition)]
+            if any(re.search(r'(?i)\bOR\b', conjunct) for conjunct in conjuncts):
+                continue  # A row may match through another branch than the keys pushed
+            for conjunct in conjuncts:
+                match = re.fullmatch(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', conjunct)
+                if not match:
+                    continue
+                sides = [(match.group(1), match.group(2)), (match.group(3), match.group(4))]
+                for (small, small_column), (large, large_column) in (sides, sides[::-1]):
+                    if small not in broadcast or large not in tables or large in broadcast:
+                        continue
+                    if not table_where_conditions[small]:
+                        continue  # An unfiltered dimension table rarely rules out any rows
+                    keys = await self._run_db(self._join_keys, broadcast[small], small, small_column,
+                                              table_where_conditions[small])
+                    if keys is None:
+                        continue
+                    predicate = f"{large}.{large_column} IN ({', '.join(keys)})" if keys else "FALSE"
+                    table_where_conditions[large].append(predicate)
+                    pushed.append(predicate)
+        return pushed
+    
+    async def _push_join_keys(self, source: str, name: str, tables: List[str], join_conditions: List[str],
+                              table_where_conditions: Dict[str, List[str]], session: QuerySession) -> List[str]:
+        """Restrict the tables equi-joined to an already fetched table to the keys it holds.
+        Only conjuncts of the form source.x = other.y of join conditions without OR qualify.
+        Returns the pushed predicates.
+        """
+        pushed = []
+        for condition in join_conditions:
+            conjuncts = [conjunct.strip() for conjunct in self._split_conjuncts(condition)]
+            if any(re.search(r'(?i)\bOR\b', conjunct) for conjunct in conjuncts):
+                continue
+            for conjunct in conjuncts:
+                match = re.fullmatch(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', conjunct)
+                if not match:
+                    continue
+                sides = [(match.group(1), match.group(2)), (match.group(3), match.group(4))]
+                for (table, column), (other, other_column) in (sides, sides[::-1]):
+                    if table != source or other == source or other not in tables:
+                        continue
+                    keys = await self._run_db(self._join_keys, name, source, column, [], session)
+                    if keys is None:
+                        continue
+                    predicate = f"{other}.{other_column} IN ({', '.join(keys)})" if keys else "FALSE"
+                    table_where_conditions[other].append(predicate)
+                    pushed.append(predicate)
+        return pushed
+    
+    async def _optimize_join_query(self, query: str, session: QuerySession) -> str:
+        """Optimize join query by pushing down WHERE clauses and pre-aggregating join inputs.
+        Remote results are loaded into temporary tables on the session.
+        """
         # Parse the query components to extract tables, join conditions, and where clauses
         components = self._parse_query_components(query)
         tables, join_conditions, where_conditions = self._parse_join_conditions(query)
+        join_types = self._parse_join_types(query)
         
         if len(tables) < 2:
-            return query, []
+            return query
         
         # Get metadata for all tables (will use cache if available)
         table_metadata = {}
         for table in tables:
             try:
                 table_metadata[table] = await self._get_table_metadata(table)
+            except HTTPException:
+                raise
             except Exception as e:
                 logger.error(f"Error getting metadata for {table}: {str(e)}")
-                return query, []
+                return query
         
         # Extract column references from WHERE conditions
         table_where_conditions = {table: [] for table in tables}
@@ -218,7 +1515,7 @@ class DistributedQueryServer:
         
         # If there's a WHERE clause, analyze it
         if components['where']:
-            where_parts = components['where'].split(' AND ')
+            where_parts = self._split_conjuncts(components['where'])
             
             for condition in where_parts:
                 condition = condition.strip()
@@ -249,157 +1546,154 @@ class DistributedQueryServer:
                     if not assigned:
                         common_where_conditions.append(condition)
         
+        # Filters on the NULL-supplying side of an outer join also have to run after the
+        # join, where they drop the rows it padded with NULLs
+        if any(join_type != 'INNER' for join_type in join_types):
+            left_only = all(join_type in ('INNER', 'LEFT', 'LEFT OUTER') for join_type in join_types)
+            for table in (tables[1:] if left_only else tables):
+                common_where_conditions += [condition for condition in table_where_conditions[table]
+                                            if condition not in common_where_conditions]
+        
+        # Small tables are joined from resident copies instead of being fetched, and
+        # their join keys are pushed to the other side as a semi-join
+        broadcast = {}
+        unloaded = []
+        for table in tables:
+            if session.dry_run:
+                # Explaining decides from the row count and loads nothing; keys are only
+                # pushed from a copy that is already resident and current
+                version = await self._broadcast_version(table, table_metadata[table])
+                if version is not None:
+                    broadcast[table] = f"broadcast_{table}"
+                    resident = self._broadcast_tables.get(table)
+                    if not resident or resident['version'] != version:
+                        unloaded.append(table)
+                continue
+            resident = await self._get_broadcast_table(table, table_metadata[table])
+            if resident:
+                broadcast[table] = resident
+        semi_joins = await self._plan_semi_joins(
+            tables, join_conditions, join_types,
+            {table: name for table, name in broadcast.items() if table not in unloaded}, table_where_conditions
+        )
+        
+        # LEFT JOINs keep every row of the first table, so a LIMIT filtered and ordered on
+        # that table alone needs no more than LIMIT of its rows
+        driving = tables[0]
+        limit_pushdown = None
+        if (driving not in broadcast and not common_where_conditions
+                and all(join_type in ('LEFT', 'LEFT OUTER') for join_type in join_types)):
+            other_columns = {col.get('name', '') for table in tables[1:] for col in table_metadata[table].get('columns', [])}
+            limit_pushdown = self._plan_limit_pushdown(components, driving, other_columns)
+        
+        # Join inputs that only supply join keys are pre-aggregated on their data node,
+        # so they return one row per distinct key instead of every raw row
+        collapsed = self._plan_join_pre_aggregation(
+            components, tables, join_conditions, join_types, common_where_conditions, table_metadata
+        )
+        collapsed = {table: keys for table, keys in collapsed.items() if table not in broadcast}
+        aggregation = None
+        if collapsed:
+            multiplicity = ' * '.join(f"{table}.__rows" for table in collapsed)
+            aggregation = self._plan_partial_aggregation(components, multiplicity)
+            logger.info(f"Pre-aggregating join inputs on their data nodes: {', '.join(collapsed)}")
+        session.plan = {
+            'strategy': 'local_join',
+            'join_order': tables,
+            'join_types': join_types,
+            'join_conditions': join_conditions,
+            'pre_aggregated': list(collapsed),
+            'broadcast': list(broadcast),
+            'broadcast_unloaded': unloaded,
+            'semi_joins': semi_joins,
+            'limit_pushdown': limit_pushdown,
+            'router_where': common_where_conditions
+        }
+        
+        def build_remote_query(table: str) -> str:
+            container = self.config.tables[table]
+            
+            # Build WHERE clause for this table's remote query
+            table_conditions = table_where_conditions[table]
+            where_clause = ""
+            if table_conditions:
+                where_clause = f" WHERE {' AND '.join(table_conditions)}"
+            
+            # Create a remote query that includes the WHERE clause
+            if table in collapsed:
+                keys = ', '.join(collapsed[table])
+                return (f"SELECT {keys}, COUNT(*) AS __rows FROM {container.table_name} AS {table}"
+                        f"{where_clause} GROUP BY {keys}")
+            return f"SELECT * FROM {container.table_name} AS {table}{where_clause}"
+        
         # Create temporary tables for each data source with filtered data
-        temp_tables = []
         try:
-            # Prepare all remote queries first
-            remote_queries = []
-            for table in tables:
-                container = self.config.tables[table]
-                temp_table = f"temp_{table}"
-                temp_tables.append(temp_table)
-                
-                # Drop existing temporary table if it exists
-                self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-                
-                # Build WHERE clause for this table's remote query
-                table_conditions = table_where_conditions[table]
-                where_clause = ""
-                if table_conditions:
-                    where_clause = f" WHERE {' AND '.join(table_conditions)}"
-                
-                # Create a remote query that includes the WHERE clause
-                remote_query = f"SELECT * FROM {container.table_name}{where_clause}"
-                remote_queries.append((table, remote_query))
+            temp_tables = {}
+            if limit_pushdown:
+                # Fetch the first LIMIT rows of the driving table, then only the rows of the
+                # tables joined to it that match its keys
+                remote_query = self._limited_query(build_remote_query(driving), limit_pushdown)
+                limit = None if limit_pushdown['order_by'] else limit_pushdown['rows']
+                df = await self._execute_remote_query(driving, remote_query, table_where_conditions[driving],
+                                                      session, limit)
+                temp_tables[driving] = await self._run_db(self._create_temp_table, session, driving, df)
+                if not session.dry_run:
+                    semi_joins += await self._push_join_keys(driving, temp_tables[driving], tables, join_conditions,
+                                                             table_where_conditions, session)
             
-            # Execute all remote queries in parallel
-            async def execute_remote_query_wrapper(table_query):
-                table, query = table_query
-                return table, await self._execute_remote_query(table, query)
+            # Execute the remaining remote queries in parallel
+            async def execute_remote_query_wrapper(table):
+                return table, await self._execute_remote_query(table, build_remote_query(table),
+                                                               table_where_conditions[table], session)
             
-            # Execute all queries concurrently
-            results = await asyncio.gather(*[execute_remote_query_wrapper(q) for q in remote_queries])
+            results = await asyncio.gather(*[
+                execute_remote_query_wrapper(table) for table in tables
+                if table not in broadcast and table not in temp_tables
+            ])
             
             # Process results and create temporary tables
             for table, df in results:
-                temp_table = f"temp_{table}"
-                # Register the DataFrame as a table in DuckDB
-                self.conn.register(f"df_{temp_table}", df)
-                # Create the temporary table from the DataFrame
-                self.conn.execute(f"CREATE TABLE {temp_table} AS SELECT * FROM df_{temp_table}")
-            
-            # Build optimized query with the remaining WHERE conditions
-            remaining_where = ""
-            if common_where_conditions:
-                remaining_where = f" WHERE {' AND '.join(common_where_conditions)}"
-            
-            # Build the join part of the query using temporary table names
-            join_clause = ""
-            for i, (temp, cond) in enumerate(zip(temp_tables[1:], join_conditions)):
-                # Replace original table names with temporary table names in join conditions
-                for table in tables:
-                    cond = cond.replace(f"{table}.", f"temp_{table}.")
-                join_clause += f" JOIN {temp} ON {cond}"
+                temp_tables[table] = await self._run_db(self._create_temp_table, session, table, df)
+            # Broadcast tables are read from their resident copy with their own filters applied
+            for table, resident in broadcast.items():
+                if table_where_conditions[table]:
+                    temp_tables[table] = (f"(SELECT * FROM {resident} AS {table} "
+                                          f"WHERE {' AND '.join(table_where_conditions[table])})")
+                else:
+                    temp_tables[table] = resident
             
-            # Build the final query using temporary table names
-            optimized_query = f"SELECT * FROM {temp_tables[0]}{join_clause}{remaining_where}"
+            # Build the join over the temporary tables, aliased back to the original
+            # table names so the column references in the query still resolve
+            from_clause = f"{temp_tables[tables[0]]} AS {tables[0]}"
+            for table, join_type, cond in zip(tables[1:], join_types, join_conditions):
+                from_clause += f" {join_type} JOIN {temp_tables[table]} AS {table} ON {cond}"
             
-            return optimized_query, temp_tables
+            # Build the final query with the remaining WHERE conditions
+            return self._build_final_query(components, from_clause, common_where_conditions, aggregation)
+        except (HTTPException, NodeUnavailableError):
+            # The tables only exist on the data nodes, so the query cannot run without them
+            raise
         except Exception as e:
-            # Clean up any tables we created if there was an error
-            for temp_table in temp_tables:
-                try:
-                    self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-                except Exception as cleanup_error:
-                    logger.error(f"Error dropping temporary table {temp_table}: {str(cleanup_error)}")
-            
+            # Temporary tables created so far are dropped when the session is released
             logger.error(f"Error in query optimization: {str(e)}")
-            return query, []
+            return query
     
-    async def _execute_distributed_query_original(self, query: str) -> Tuple[str, List[pd.DataFrame]]:
-        """Original implementation of distributed query execution with WHERE clause push-down."""
-        # Parse the query to get involved tables and components
-        tables = self._parse_query(query)
-        self._validate_tables(tables)
-        components = self._parse_query_components(query)
-        
-        # Extract LIMIT if present
-        limit = self._extract_limit(query)
-        query_without_limit = self._remove_limit(query)
-        
-        # For each table, create a subquery to get the required data
-        dfs = []
-        for table in tables:
-            table_config = self.config.tables[table]
-            
-            # Extract the columns needed for this table
-            # This is a simplified version - in practice, you'd need a proper SQL parser
-            table_pattern = rf'(?i)SELECT\s+(.*?)\s+FROM\s+{table}'
-            match = re.search(table_pattern, query_without_limit)
-            if match:
-                columns = match.group(1)
-            else:
-                columns = "*"
-            
-            # Determine if any WHERE conditions can be applied to this table
-            where_clause = ""
-            if components['where']:
-                # Try to find conditions that apply to this table
-                table_conditions = []
-                
-                # Simple approach: check if the condition mentions the table name
-                # or if it's a simple column comparison that might be applicable
-                where_parts = components['where'].split(' AND ')
-                for condition in where_parts:
-                    condition = condition.strip()
-                    if table + '.' in condition or condition.split()[0] in columns:
-                        table_conditions.append(condition)
-                
-                if table_conditions:
-                    where_clause = f" WHERE {' AND '.join(table_conditions)}"
-            
-            # Create and execute the subquery with WHERE clause if applicable
-            subquery = f"SELECT {columns} FROM {table_config.table_name}{where_clause}"
-            logger.info(f"Forwarding query to container: {subquery}")
-            logger.info(f"Connecting to container at: http://{table_config.url}:{table_config.port}")
-            df = await self._execute_remote_query(table, subquery)
-            
-            # Create a temporary table in DuckDB
-            temp_table = f"temp_{table}"
-            # Drop if exists
-            self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-            # Register the DataFrame
-            self.conn.register(f"df_{temp_table}", df)
-            # Create the table
-            self.conn.execute(f"CREATE TABLE {temp_table} AS SELECT * FROM df_{temp_table}")
-            dfs.append((table, df))
-        
-        # Execute the join in DuckDB
-        # Replace table names in the original query with temp table names
-        modified_query = query_without_limit
-        for table, _ in dfs:
-            # Use word boundaries to avoid partial replacements
-            # For example, avoid replacing 'table1' in 'table10'
-            modified_query = re.sub(rf'\b{table}\b', f"temp_{table}", modified_query)
-        
-        # Add back the LIMIT clause if it was present
-        if limit:
-            modified_query += f" LIMIT {limit}"
-        
-        return modified_query, dfs
-    
-    async def _execute_distributed_query(self, query: str) -> pd.DataFrame:
+    async def _execute_distributed_query(self, query: str) -> pa.Table:
         """Execute a query across multiple data containers."""
-        temp_tables = []
+        async with self._session() as session:
+            modified_query, _ = await self._prepare_query(query, session)
+            return await self._run_db(self._execute_local_query, session, modified_query)
+    
+    def _execute_local_query(self, session: QuerySession, query: str) -> pa.Table:
+        """Run the router's query over the session's temporary tables."""
         try:
-            # Try to optimize the join query
-            modified_query, temp_tables = await self._optimize_join_query(query)
-            
             # Execute the modified query
-            logger.info(f"Executing optimized query: {modified_query}")
+            logger.info(f"Executing optimized query: {query}")
             
             # Execute the query directly
-            result = self.conn.execute(modified_query).fetchdf()
+            with self.tracer.span('execute_local', sql=query) as span:
+                result = session.cursor.execute(query).fetch_arrow_table()
+                span.attributes['rows'] = result.num_rows
             
             return result
         except Exception as e:
@@ -408,29 +1702,85 @@ class DistributedQueryServer:
                 status_code=500,
                 detail=f"Error executing query: {str(e)}"
             )
-        finally:
-            # Clean up any temporary tables we created
-            for temp_table in temp_tables:
-                try:
-                    self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-                except Exception as cleanup_error:
-                    logger.error(f"Error dropping temporary table {temp_table}: {str(cleanup_error)}")
+    
+    def _drop_temp_tables(self, session: QuerySession) -> None:
+        """Drop the session's temporary tables, logging rather than raising on failure."""
+        for temp_table in session.temp_tables:
+            try:
+                session.cursor.execute(f"DROP TABLE IF EXISTS {temp_table}")
+            except Exception as cleanup_error:
+                logger.error(f"Error dropping temporary table {temp_table}: {str(cleanup_error)}")
+        session.temp_tables.clear()
+    
+    async def _prepare_query(self, query: str, session: QuerySession) -> Tuple[str, List[str]]:
+        """Fetch the remote data a query needs into temporary tables on the session.
+        Returns the local query to run over them and the source tables.
+        """
+        with self.tracer.span('plan') as span:
+            local_query, tables = await self._plan_and_fetch(query, session)
+            span.attributes.update(strategy=session.plan.get('strategy'), local_query=local_query)
+            return local_query, tables
+    
+    async def _plan_and_fetch(self, query: str, session: QuerySession) -> Tuple[str, List[str]]:
+        """Plan a query and fetch its fragments; see _prepare_query."""
+        tables, _, _ = self._parse_join_conditions(query)
+        if len(tables) != 1:
+            return await self._optimize_join_query(query, session), tables
+        
+        table = tables[0]
+        if table not in self.config.tables:
+            raise ValueError(f"No data container found for table '{table}'")
+        components = self._parse_query_components(query)
+        where_conditions = [components['where']] if components['where'] else []
+        if len(self._select_shards(table, where_conditions)) == 1:
+            # The data node runs the whole query; the router only relays its rows
+            session.plan = {'strategy': 'forward'}
+            df = await self._execute_remote_query(table, self._build_container_query(components),
+                                                  where_conditions, session)
+            temp_table = await self._run_db(self._create_temp_table, session, table, df)
+            return f"SELECT * FROM {temp_table}", tables
+        
+        # Several shards aggregate their own rows and the router merges the partial aggregates
+        aggregation = self._plan_partial_aggregation(components)
+        if aggregation:
+            session.plan = {'strategy': 'partial_aggregation', 'group_keys': aggregation['group_keys']}
+            return await self._prepare_partial_aggregation(table, components, aggregation, session), tables
+        
+        # Otherwise gather their matching rows and finish the query here. A LIMIT
+        # is pushed to the shards too, as a top-N if the query is ordered
+        pushdown = self._plan_limit_pushdown(components, table)
+        session.plan = {'strategy': 'gather', 'limit_pushdown': pushdown}
+        table_config = self.config.tables[table]
+        remote_query = f"SELECT * FROM {table_config.table_name} AS {table}"
+        if components['where']:
+            remote_query += f" WHERE {components['where']}"
+        remote_query = self._limited_query(remote_query, pushdown)
+        limit = pushdown['rows'] if pushdown and not pushdown['order_by'] else None
+        df = await self._execute_remote_query(table, remote_query, where_conditions, session, limit)
+        temp_table = await self._run_db(self._create_temp_table, session, table, df)
+        return self._build_final_query(components, f"{temp_table} AS {table}", []), tables
     
     def _parse_query_components(self, query: str) -> Dict:
-        """Parse a SQL query into its components (SELECT, FROM, WHERE, LIMIT)."""
+        """Parse a SQL query into its components (SELECT, FROM, WHERE, GROUP BY, HAVING, ORDER BY, LIMIT)."""
         # Initialize components
         components = {
             'select': '*',
             'from': None,
             'where': None,
-            'limit': None
+            'group_by': None,
+            'having': None,
+            'order_by': None,
+            'limit': None,
+            'offset': None
         }
         
         # Use a case-insensitive regex for SQL keywords but preserve the original query
         # for extracting actual values
+        query = query.strip().rstrip(';')
+        clause_end = r'(?=\s+group\s+by\s|\s+having\s|\s+order\s+by\s|\s+limit\s+\d+|\s*$)'
         
         # Extract SELECT clause
-        select_match = re.search(r'(?i)select\s+(.*?)\s+from', query)
+        select_match = re.search(r'(?is)select\s+(.*?)\s+from\s', query)
         if select_match:
             components['select'] = select_match.group(1)
         
@@ -440,14 +1790,30 @@ class DistributedQueryServer:
             components['from'] = from_match.group(1)
         
         # Extract WHERE clause
-        where_match = re.search(r'(?i)where\s+(.*?)(?:\s+limit\s+\d+)?$', query)
+        where_match = re.search(r'(?is)\swhere\s+(.*?)' + clause_end, query)
         if where_match:
             components['where'] = where_match.group(1)
         
+        # Extract GROUP BY clause
+        group_match = re.search(r'(?is)\sgroup\s+by\s+(.*?)(?=\s+having\s|\s+order\s+by\s|\s+limit\s+\d+|\s*$)', query)
+        if group_match:
+            components['group_by'] = group_match.group(1)
+        
+        # Extract HAVING clause
+        having_match = re.search(r'(?is)\shaving\s+(.*?)(?=\s+order\s+by\s|\s+limit\s+\d+|\s*$)', query)
+        if having_match:
+            components['having'] = having_match.group(1)
+        
+        # Extract ORDER BY clause
+        order_match = re.search(r'(?is)\sorder\s+by\s+(.*?)(?=\s+limit\s+\d+|\s*$)', query)
+        if order_match:
+            components['order_by'] = order_match.group(1)
+        
         # Extract LIMIT clause
-        limit_match = re.search(r'(?i)limit\s+(\d+)', query)
+        limit_match = re.search(r'(?i)limit\s+(\d+)(?:\s+offset\s+(\d+))?', query)
         if limit_match:
             components['limit'] = limit_match.group(1)
+            components['offset'] = limit_match.group(2)
         
         return components
 
@@ -466,73 +1832,709 @@ class DistributedQueryServer:
         if components['where']:
             query_parts.append(f"WHERE {components['where']}")
         
-        # Add LIMIT clause
+        # Add GROUP BY, HAVING and ORDER BY clauses
+        if components.get('group_by'):
+            query_parts.append(f"GROUP BY {components['group_by']}")
+        if components.get('having'):
+            query_parts.append(f"HAVING {components['having']}")
+        if components.get('order_by'):
+            query_parts.append(f"ORDER BY {components['order_by']}")
+        
+        # Add LIMIT and OFFSET clauses
         if components['limit']:
             query_parts.append(f"LIMIT {components['limit']}")
+        if components.get('offset'):
+            query_parts.append(f"OFFSET {components['offset']}")
         
         return ' '.join(query_parts)
 
-    async def execute_query(self, query_request: QueryRequest) -> QueryResponse:
-        """Execute a distributed query and return the results."""
+    def _split_top_level(self, text: str, separator: str = ',') -> List[str]:
+        """Split text on a separator that is not nested in parentheses or string literals."""
+        items = []
+        depth = 0
+        in_string = False
+        start = 0
+        for i, ch in enumerate(text):
+            if ch == "'":
+                in_string = not in_string
+            elif not in_string:
+                if ch == '(':
+                    depth += 1
+                elif ch == ')':
+                    depth -= 1
+                elif ch == separator and depth == 0:
+                    items.append(text[start:i].strip())
+                    start = i + 1
+        items.append(text[start:].strip())
+        return [item for item in items if item]
+
+    def _split_conjuncts(self, where: str) -> List[str]:
+        """Split a WHERE clause on top-level AND, leaving BETWEEN ... AND ... intact."""
+        conjuncts = []
+        depth = 0
+        in_string = False
+        in_between = False
+        start = 0
+        for match in re.finditer(r"'|\(|\)|(?i:\bBETWEEN\b)|(?i:\bAND\b)", where):
+            token = match.group(0).upper()
+            if token == "'":
+                in_string = not in_string
+            elif in_string:
+                continue
+            elif token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and token == 'BETWEEN':
+                in_between = True
+            elif depth == 0 and token == 'AND':
+                if in_between:
+                    in_between = False
+                else:
+                    conjuncts.append(where[start:match.start()].strip())
+                    start = match.end()
+        conjuncts.append(where[start:].strip())
+        return [conjunct for conjunct in conjuncts if conjunct]
+
+    def _find_aggregate_calls(self, expression: str) -> List[Tuple[int, int, str, str]]:
+        """Locate aggregate function calls in an expression.
+        Returns a list of tuples (start, end, function, argument).
+        """
+        calls = []
+        quoted = [m.span() for m in re.finditer(r"'[^']*'|\"[^\"]*\"", expression)]
+        position = 0
+        while True:
+            match = AGGREGATE_CALL_PATTERN.search(expression, position)
+            if not match:
+                break
+            if any(start <= match.start() < end for start, end in quoted):
+                position = match.end()
+                continue
+            depth = 1
+            in_string = False
+            i = match.end()
+            while i < len(expression) and depth:
+                ch = expression[i]
+                if ch == "'":
+                    in_string = not in_string
+                elif not in_string:
+                    if ch == '(':
+                        depth += 1
+                    elif ch == ')':
+                        depth -= 1
+                i += 1
+            if depth:
+                break
+            calls.append((match.start(), i, match.group(1).upper(), expression[match.end():i - 1].strip()))
+            position = i
+        return calls
+
+    def _rewrite_aggregates(self, expression: Optional[str], rewrite) -> Optional[str]:
+        """Replace every aggregate call in an expression with rewrite(function, argument)."""
+        if not expression:
+            return expression
+        for start, end, func, arg in reversed(self._find_aggregate_calls(expression)):
+            expression = expression[:start] + rewrite(func, arg) + expression[end:]
+        return expression
+
+    def _default_column_name(self, expression: str) -> str:
+        """Return the name DuckDB gives an unaliased select item, e.g. count_star() for COUNT(*).
+        The name is the parsed expression printed back, which needs no schema to compute.
+        """
+        try:
+            sql = self.conn.execute("SELECT json_deserialize_sql(json_serialize_sql(?))",
+                                    [f"SELECT {expression}"]).fetchone()[0]
+            return sql[len('SELECT '):]
+        except duckdb.Error:
+            return expression
+
+    def _select_aliases(self, select: str) -> Optional[List[str]]:
+        """Return the alias of each select item ('' if it has none) as DuckDB parses them,
+        which also finds aliases given without AS. None if the select list does not parse.
+        """
+        try:
+            parsed = json.loads(self.conn.execute("SELECT json_serialize_sql(?)", [f"SELECT {select}"]).fetchone()[0])
+        except duckdb.Error:
+            return None
+        if parsed.get('error') or len(parsed.get('statements', [])) != 1:
+            return None
+        return [item.get('alias', '') for item in parsed['statements'][0]['node'].get('select_list', [])]
+
+    def _alias_select_items(self, select: str) -> str:
+        """Name unaliased aggregate select items as DuckDB would have, so a merged result has
+        the same columns as the query run in one place.
+        """
+        items = []
+        split_items = self._split_top_level(select)
+        aliases = self._select_aliases(select)
+        if not aliases or len(aliases) != len(split_items):
+            aliases = [re.search(r'(?i)\sAS\s+("[^"]+"|\w+)$', item) for item in split_items]
+        for item, alias in zip(split_items, aliases):
+            if self._find_aggregate_calls(item) and not alias:
+                name = self._default_column_name(item).replace('"', '""')
+                item = f'{item} AS "{name}"'
+            items.append(item)
+        return ', '.join(items)
+
+    def _plan_partial_aggregation(self, components: Dict, multiplicity: Optional[str] = None) -> Optional[Dict]:
+        """Split a grouped query into partial aggregates and a final merge step.
+        
+        Without a multiplicity the partial aggregates run on the data nodes and the
+        returned 'final' expressions merge them in the router. With a multiplicity
+        (the row count column of a pre-aggregated join input) the aggregates are
+        rewritten to weight each joined row by that count instead.
+        Returns None if the query has no aggregates or they are not decomposable.
+        """
+        clauses = [components['select'], components.get('having'), components.get('order_by')]
+        calls = [call for clause in clauses if clause for call in self._find_aggregate_calls(clause)]
+        if not calls:
+            return None
+        if any(re.match(r'(?i)DISTINCT\b', arg) for _, _, _, arg in calls):
+            return None
+        
+        group_keys = self._split_top_level(components['group_by']) if components.get('group_by') else []
+        # GROUP BY 1 names the first select item, which the data nodes need spelled out
+        select_items = self._split_top_level(components['select'])
+        for i, key in enumerate(group_keys):
+            if key.isdigit():
+                if not 1 <= int(key) <= len(select_items):
+                    return None
+                column = re.fullmatch(r'(?i)(?!DISTINCT\b)((?:\w+\.)?\w+)(?:\s+(?:AS\s+)?("[^"]+"|\w+))?', select_items[int(key) - 1])
+                if not column:
+                    return None
+                group_keys[i] = column.group(1)
+        if any(not re.fullmatch(r'(\w+\.)?\w+', key) for key in group_keys):
+            return None
+        
+        partial_columns = []
+        merged = {}
+        
+        def merge(func: str, arg: str) -> str:
+            key = (func, ' '.join(arg.split()).lower())
+            if key in merged:
+                return merged[key]
+            if multiplicity:
+                if func == 'COUNT':
+                    weight = multiplicity if arg == '*' else f"CASE WHEN ({arg}) IS NOT NULL THEN {multiplicity} ELSE 0 END"
+                    expression = f"CAST(COALESCE(SUM({weight}), 0) AS BIGINT)"
+                elif func == 'SUM':
+                    expression = f"SUM(({arg}) * {multiplicity})"
+                elif func == 'AVG':
+                    expression = (f"(CAST(SUM(({arg}) * {multiplicity}) AS DOUBLE) / "
+                                  f"NULLIF(SUM(CASE WHEN ({arg}) IS NOT NULL THEN {multiplicity} ELSE 0 END), 0))")
+                else:
+                    expression = f"{func}({arg})"
+            else:
+                alias = f"__agg_{len(partial_columns)}"
+                if func == 'AVG':
+                    partial_columns.append(f"SUM({arg}) AS {alias}_sum")
+                    partial_columns.append(f"COUNT({arg}) AS {alias}_count")
+                    expression = f"(CAST(SUM({alias}_sum) AS DOUBLE) / NULLIF(SUM({alias}_count), 0))"
+                else:
+                    partial_columns.append(f"{func}({arg}) AS {alias}")
+                    if func == 'COUNT':
+                        expression = f"CAST(COALESCE(SUM({alias}), 0) AS BIGINT)"
+                    elif func == 'SUM':
+                        expression = f"SUM({alias})"
+                    else:
+                        expression = f"{func}({alias})"
+            merged[key] = expression
+            return expression
+        
+        return {
+            'group_keys': group_keys,
+            'partial_columns': partial_columns,
+            'select': self._rewrite_aggregates(self._alias_select_items(components['select']), merge),
+            'having': self._rewrite_aggregates(components.get('having'), merge),
+            'order_by': self._rewrite_aggregates(components.get('order_by'), merge)
+        }
+
+    def _plan_limit_pushdown(self, components: Dict, table: str, other_columns: Set[str] = frozenset()) -> Optional[Dict]:
+        """Decide whether a LIMIT can be pushed into a table's fragments.
+
+        The router still applies the query's ORDER BY and LIMIT, so each fragment only
+        needs to return the first LIMIT + OFFSET rows - ordered the same way if the query
+        has an ORDER BY, which must then be on plain columns of this table (not on select
+        aliases or columns of other_columns). Grouped, aggregated, DISTINCT and windowed
+        queries do not qualify. Returns {'rows': ..., 'order_by': ...} or None.
+        """
+        if not components.get('limit') or components.get('group_by') or components.get('having'):
+            return None
+        select = components['select']
+        if (re.match(r'(?i)\s*DISTINCT\b', select) or re.search(r'(?i)\bOVER\s*\(', select)
+                or self._find_aggregate_calls(select)):
+            return None
+
+        order_by = components.get('order_by')
+        if order_by:
+            aliases = set()
+            for item in self._split_top_level(select):
+                alias = re.search(r'(?i)(?:\bAS\s+|\s)"?(\w+)"?$', item)
+                if alias:
+                    aliases.add(alias.group(1).lower())
+            other_columns = {column.lower() for column in other_columns}
+            for item in self._split_top_level(order_by):
+                match = re.fullmatch(r'(?i)(?:(\w+)\.)?(\w+)(?:\s+(?:ASC|DESC))?(?:\s+NULLS\s+(?:FIRST|LAST))?', item)
+                if not match or match.group(2).isdigit():
+                    return None
+                qualifier, column = match.group(1), match.group(2).lower()
+                if qualifier is not None and qualifier != table:
+                    return None
+                if qualifier is None and (column in aliases or column in other_columns):
+                    return None
+
+        return {'rows': int(components['limit']) + int(components.get('offset') or 0), 'order_by': order_by}
+
+    def _limited_query(self, query: str, pushdown: Optional[Dict]) -> str:
+        """Append a pushed-down ORDER BY and LIMIT to a fragment query."""
+        if not pushdown:
+            return query
+        if pushdown['order_by']:
+            query += f" ORDER BY {pushdown['order_by']}"
+        return query + f" LIMIT {pushdown['rows']}"
+
+    def _build_final_query(self, components: Dict, from_clause: str, where_conditions: List[str],
+                           aggregation: Optional[Dict] = None) -> str:
+        """Build the query the router runs over its temporary tables."""
+        source = aggregation or components
+        query_parts = [f"SELECT {source['select']}", f"FROM {from_clause}"]
+        if where_conditions:
+            query_parts.append(f"WHERE {' AND '.join(where_conditions)}")
+        if components.get('group_by'):
+            query_parts.append(f"GROUP BY {components['group_by']}")
+        if source.get('having'):
+            query_parts.append(f"HAVING {source['having']}")
+        if source.get('order_by'):
+            query_parts.append(f"ORDER BY {source['order_by']}")
+        if components.get('limit'):
+            query_parts.append(f"LIMIT {components['limit']}")
+        if components.get('offset'):
+            query_parts.append(f"OFFSET {components['offset']}")
+        return ' '.join(query_parts)
+
+    async def _prepare_partial_aggregation(self, table: str, components: Dict, aggregation: Dict,
+                                           session: QuerySession) -> str:
+        """Run partial aggregates on the data node and build the router's merge query."""
+        container = self.config.tables[table]
+        group_keys = aggregation['group_keys']
+        
+        # Build the partial aggregation query for the data node
+        remote_query = (f"SELECT {', '.join(group_keys + aggregation['partial_columns'])} "
+                        f"FROM {container.table_name} AS {table}")
+        if components['where']:
+            remote_query += f" WHERE {components['where']}"
+        if group_keys:
+            remote_query += f" GROUP BY {', '.join(group_keys)}"
+        
+        where_conditions = [components['where']] if components['where'] else []
+        df = await self._execute_remote_query(table, remote_query, where_conditions, session)
+        temp_table = await self._run_db(self._create_temp_table, session, table, df)
+        
+        # Merge the partial aggregates
+        final_query = self._build_final_query(components, f"{temp_table} AS {table}", [], aggregation)
+        logger.info(f"Merging partial aggregates: {final_query}")
+        return final_query
+
+    async def _estimate_fragment_rows(self, shard: ShardConfig, query: str) -> Optional[int]:
+        """Ask a data node's DuckDB planner for the estimated row count of a fragment.
+        Returns None if the node cannot explain the query.
+        """
+        try:
+            response = await self._request_shard(shard, 'POST', '/query', json={"query": f"EXPLAIN (FORMAT JSON) {query}"})
+            plan = json.loads(response.json()['results'][0]['explain_value'])
+            return int(plan[0]['extra_info']['Estimated Cardinality'])
+        except Exception as e:
+            logger.debug(f"Could not estimate rows of fragment on {shard.base_url}: {str(e)}")
+            return None
+    
+    async def explain_query(self, query_request: QueryRequest, analyze: bool = False) -> ExplainResponse:
+        """Return the plan of a distributed query: the SQL pushed to each node, the strategy
+        used to combine it and the data nodes' row estimates. With analyze the query runs,
+        adding per-fragment timings, sizes and row counts and DuckDB's local profile.
+        """
         try:
             start_time = time.time()
-            print(f"\nExecuting distributed query at {datetime.now().isoformat()}")
-            print(f"Query: {query_request.query}")
+            with self.tracer.span('explain', query=query_request.query, analyze=analyze):
+                async with self._session(record_fragments=True, dry_run=not analyze) as session:
+                    local_query, tables = await self._prepare_query(query_request.query, session)
+                    fetch_ms = (time.time() - start_time) * 1000
+                    
+                    profile = None
+                    local_ms = None
+                    if analyze:
+                        local_start = time.time()
+                        rows = await self._run_db(lambda: session.cursor.execute(f"EXPLAIN ANALYZE {local_query}").fetchall())
+                        local_ms = (time.time() - local_start) * 1000
+                        profile = '\n'.join(row[1] for row in rows)
+            
+            estimates = await asyncio.gather(*[
+                self._estimate_fragment_rows(fragment['shard'], fragment['sql']) for fragment in session.fragments
+            ])
+            fragments = [
+                FragmentPlan(**{key: value for key, value in fragment.items() if key != 'shard'}, estimated_rows=estimate)
+                for fragment, estimate in zip(session.fragments, estimates)
+            ]
+            
+            return ExplainResponse(
+                query=query_request.query,
+                strategy=session.plan.get('strategy'),
+                details={key: value for key, value in session.plan.items() if key != 'strategy'},
+                fragments=fragments,
+                local_query=local_query,
+                analyze=analyze,
+                fetch_ms=fetch_ms if analyze else None,
+                register_ms=session.register_seconds * 1000 if analyze else None,
+                local_ms=local_ms,
+                total_ms=(time.time() - start_time) * 1000 if analyze else None,
+                profile=profile,
+                source_tables=tables
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error explaining query: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    def _is_forwardable(self, table: str, query: str) -> bool:
+        """Return whether a single-table query can be answered entirely by one data container."""
+        if table not in self.config.tables:
+            raise ValueError(f"No data container found for table '{table}'")
+        components = self._parse_query_components(query)
+        where_conditions = [components['where']] if components['where'] else []
+        return len(self._select_shards(table, where_conditions)) == 1
+
+    def _purge_jobs(self) -> None:
+        """Forget finished jobs older than job_ttl and delete their result files."""
+        cutoff = time.time() - self.settings.job_ttl
+        for job in list(self._jobs.values()):
+            if job.finished_at and job.finished_at < cutoff:
+                self._delete_job(job)
+    
+    def _delete_job(self, job: QueryJob) -> None:
+        self._jobs.pop(job.job_id, None)
+        if os.path.exists(job.path):
+            os.remove(job.path)
+    
+    def _get_job(self, job_id: str) -> QueryJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+        return job
+    
+    def _spool_to_parquet(self, session: QuerySession, query: str, path: str) -> None:
+        """Write a query's result to a Parquet file without materializing it in Python."""
+        escaped_path = path.replace("'", "''")
+        session.cursor.execute(f"COPY ({query}) TO '{escaped_path}' (FORMAT PARQUET)")
+    
+    async def _run_job(self, job: QueryJob) -> None:
+        """Execute a job's query and spool the result, recording progress on the job."""
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            with self.tracer.span('job', job_id=job.job_id, query=job.query):
+                async with self._session(record_fragments=True, http_timeout=self.settings.job_http_timeout) as session:
+                    job.session = session
+                    job.fragments = session.fragments
+                    final_query, job.tables = await self._prepare_query(job.query, session)
+                    await self._run_db(self._spool_to_parquet, session, final_query, job.path)
+            job.result_rows = pq.ParquetFile(job.path).metadata.num_rows
+            job.status = 'succeeded'
+            logger.info(f"Job {job.job_id} finished with {job.result_rows:,} rows")
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            if os.path.exists(job.path):
+                os.remove(job.path)
+            logger.info(f"Job {job.job_id} cancelled")
+        except Exception as e:
+            job.status = 'failed'
+            job.error = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Job {job.job_id} failed: {job.error}")
+        finally:
+            job.finished_at = time.time()
+            job.session = None
+    
+    def submit_job(self, query_request: QueryRequest) -> JobStatus:
+        """Start a query in the background and return its job status."""
+        self._purge_jobs()
+        job = QueryJob(query_request.query, self.job_spool_dir)
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run_job(job))
+        logger.info(f"Submitted job {job.job_id}: {job.query}")
+        return job.to_status()
+    
+    def get_job_status(self, job_id: str) -> JobStatus:
+        return self._get_job(job_id).to_status()
+    
+    async def cancel_job(self, job_id: str) -> JobStatus:
+        """Cancel a running job, aborting its in-flight data node requests and local
+        DuckDB work, or delete the results of a finished one. Returns once the job has
+        stopped, its cursor is back in the pool and its partial result is removed.
+        """
+        job = self._get_job(job_id)
+        if job.finished_at is None:
+            if job.session is not None:
+                job.session.cursor.interrupt()
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+        else:
+            self._delete_job(job)
+        return job.to_status()
+    
+    async def get_job_result(self, job_id: str, offset: int, limit: int, stream_format: Optional[str] = None):
+        """Return a page of a finished job's results, or stream all of them as NDJSON or Arrow IPC."""
+        job = self._get_job(job_id)
+        if job.status != 'succeeded':
+            detail = f"Job '{job_id}' is {job.status}"
+            if job.error:
+                detail += f": {job.error}"
+            raise HTTPException(status_code=409, detail=detail)
+        
+        if offset < 0 or limit < 1:
+            raise HTTPException(status_code=400, detail="offset must be >= 0 and limit >= 1")
+        
+        escaped_path = job.path.replace("'", "''")
+        if stream_format:
+            session = await self._acquire_session()
+            media_type = next(media for media, name in STREAM_MEDIA_TYPES.items() if name == stream_format)
+            return StreamingResponse(
+                self._stream_results(session, f"SELECT * FROM read_parquet('{escaped_path}')", stream_format, None),
+                media_type=media_type,
+                headers={'X-Source-Tables': ','.join(job.tables)}
+            )
+        
+        async with self._session() as session:
+            page = await self._run_db(lambda: session.cursor.execute(
+                f"SELECT * FROM read_parquet('{escaped_path}') LIMIT {int(limit)} OFFSET {int(offset)}"
+            ).fetch_arrow_table())
+        next_offset = offset + page.num_rows
+        return JobResultPage(
+            job_id=job_id,
+            results=page.to_pylist(),
+            columns=page.column_names,
+            offset=offset,
+            total_rows=job.result_rows,
+            next_offset=next_offset if next_offset < job.result_rows else None
+        )
+    
+    def negotiate_stream_format(self, accept: Optional[str]) -> Optional[str]:
+        """Return the streaming format requested by an Accept header, or None for JSON."""
+        for media_type in (accept or '').split(','):
+            media_type = media_type.split(';')[0].strip().lower()
+            if media_type == 'application/json':
+                return None
+            if media_type in STREAM_MEDIA_TYPES:
+                return STREAM_MEDIA_TYPES[media_type]
+        return None
+
+    def _read_chunk(self, reader, writer, sink: io.BytesIO, max_rows: Optional[int]) -> Optional[Tuple[bytes, int]]:
+        """Pull the next record batch and encode it. Returns None at the end of the result."""
+        try:
+            batch = reader.read_next_batch()
+        except StopIteration:
+            return None
+        if max_rows is not None and batch.num_rows > max_rows:
+            batch = batch.slice(0, max_rows)
+        
+        if writer:
+            writer.write_batch(batch)
+            chunk = sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        else:
+            chunk = ''.join(json.dumps(row, default=str) + '\n' for row in batch.to_pylist()).encode()
+        return chunk, batch.num_rows
+
+    async def _stream_results(self, session: QuerySession, query: str, stream_format: str, max_rows: Optional[int]):
+        """Pull record batches from DuckDB and encode them one at a time.
+        
+        Stops pulling as soon as the row cap is reached, so DuckDB never computes
+        rows that would not be sent. The session is released when the stream ends.
+        """
+        sink = io.BytesIO()
+        writer = None
+        rows_sent = 0
+        try:
+            logger.info(f"Streaming query results: {query}")
+            reader = await self._run_db(
+                lambda: session.cursor.execute(query).fetch_record_batch(self.settings.stream_batch_rows)
+            )
+            if stream_format == 'arrow':
+                writer = pa.ipc.new_stream(sink, reader.schema)
             
-            # Parse the query to understand what tables are involved
-            tables, join_conditions, where_conditions = self._parse_join_conditions(query_request.query)
+            while max_rows is None or rows_sent < max_rows:
+                remaining = None if max_rows is None else max_rows - rows_sent
+                chunk = await self._run_db(self._read_chunk, reader, writer, sink, remaining)
+                if chunk is None:
+                    break
+                rows_sent += chunk[1]
+                yield chunk[0]
             
-            if len(tables) == 1:
-                # Single table query - forward to appropriate container
-                table = tables[0]
-                container = self.config.tables.get(table)
-                if not container:
-                    raise ValueError(f"No data container found for table '{table}'")
+            if writer:
+                writer.close()
+                writer = None
+                yield sink.getvalue()
+            logger.info(f"Streamed {rows_sent:,} rows")
+        finally:
+            await self._release_session(session)
+
+    async def execute_query_stream(self, query_request: QueryRequest, stream_format: str,
+                                   traceparent: Optional[str] = None) -> StreamingResponse:
+        """Execute a distributed query and stream the results as NDJSON or Arrow IPC.
+        The trace covers fetching the query's fragments, not the streaming itself.
+        """
+        # The tighter of the request's and the server's row caps applies
+        caps = [cap for cap in (query_request.max_rows, self.settings.max_stream_rows) if cap is not None]
+        max_rows = min(caps) if caps else None
+        media_type = next(media for media, name in STREAM_MEDIA_TYPES.items() if name == stream_format)
+        
+        session = None
+        try:
+            with self.tracer.span('query', traceparent, query=query_request.query, streamed=True) as root_span:
+                logger.info(f"Streaming distributed query: {query_request.query}")
+                with self.tracer.span('parse'):
+                    tables, _, _ = self._parse_join_conditions(query_request.query)
+                cache_key = await self._result_cache_key(query_request.query, tables)
+                cached = self.result_cache.get(cache_key) if cache_key else None
+                if cached is None and len(tables) == 1 and self._is_forwardable(tables[0], query_request.query):
+                    # One data node runs the whole query; its stream is relayed as it arrives
+                    with self.tracer.span('plan', strategy='forward'):
+                        response = await self._open_forward_stream(tables[0], query_request.query, stream_format, max_rows)
+                    return StreamingResponse(
+                        self._relay_stream(response, stream_format),
+                        media_type=media_type,
+                        headers={'X-Source-Tables': ','.join(tables), 'X-Trace-Id': root_span.trace_id}
+                    )
                 
-                # Parse the query components
-                components = self._parse_query_components(query_request.query)
+                session = await self._acquire_session()
+                if cached is not None:
+                    logger.info("Streaming query result from result cache")
+                    temp_table = await self._run_db(self._create_temp_table, session, 'cached', cached)
+                    final_query = f"SELECT * FROM {temp_table}"
+                else:
+                    final_query, tables = await self._prepare_query(query_request.query, session)
+        except Exception as e:
+            self.query_errors += 1
+            if session is not None:
+                await self._release_session(session)
+            if isinstance(e, HTTPException):
+                raise
+            logger.error(f"Error executing query: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        return StreamingResponse(
+            self._stream_results(session, final_query, stream_format, max_rows),
+            media_type=media_type,
+            headers={'X-Source-Tables': ','.join(tables), 'X-Trace-Id': root_span.trace_id}
+        )
+
+    async def execute_query(self, query_request: QueryRequest, traceparent: Optional[str] = None) -> QueryResponse:
+        """Execute a distributed query and return the results.
+        The query is traced, continuing the caller's trace if a traceparent header is given.
+        """
+        start_time = time.time()
+        try:
+            with self.tracer.span('query', traceparent, query=query_request.query) as root_span:
+                print(f"\nExecuting distributed query at {datetime.now().isoformat()}")
+                print(f"Query: {query_request.query}")
                 
-                # Build the container query
-                container_query = self._build_container_query(components)
-                print(f"Forwarding query to container: {container_query}")
+                # Parse the query to understand what tables are involved
+                with self.tracer.span('parse'):
+                    tables, join_conditions, where_conditions = self._parse_join_conditions(query_request.query)
                 
-                # Forward the query to the data container
-                async with httpx.AsyncClient() as client:
-                    container_url = f"{container.url}:{container.port}"
-                    print(f"Connecting to container at: {container_url}")
-                    response = await client.post(
-                        f"{container_url}/query",
-                        json={"query": container_query}
-                    )
-                    response.raise_for_status()
-                    response_data = response.json()
-                    # Add source_tables to the response
-                    response_data['source_tables'] = [table]
-                    return response_data
-            else:
-                # Multi-table query - use optimization
-                result = await self._execute_distributed_query(query_request.query)
+                # Repeated queries over unchanged data are served from the result cache
+                cache_key = await self._result_cache_key(query_request.query, tables)
+                result = self.result_cache.get(cache_key) if cache_key else None
+                root_span.attributes['result_cache_hit'] = result is not None
                 
-                # Convert results to list of dictionaries
-                results = result.to_dict('records')
-                columns = list(result.columns)
+                if result is not None:
+                    logger.info("Serving query result from result cache")
+                elif len(tables) == 1 and self._is_forwardable(tables[0], query_request.query):
+                    # Single table query on one data container - forward it as is
+                    with self.tracer.span('plan', strategy='forward'):
+                        components = self._parse_query_components(query_request.query)
+                        container_query = self._build_container_query(components)
+                        print(f"Forwarding query to container: {container_query}")
+                        where_conditions = [components['where']] if components['where'] else []
+                        result = await self._execute_remote_query(tables[0], container_query, where_conditions)
+                else:
+                    # Aggregates, sharded tables and joins are finished in the router
+                    result = await self._execute_distributed_query(query_request.query)
                 
-                execution_time = (time.time() - start_time) * 1000  # Convert to milliseconds
-                print(f"\nQuery Execution Stats:")
-                print(f"  Execution time: {execution_time:.2f}ms")
-                print(f"  Rows returned: {len(results):,}")
-                print(f"  Columns: {', '.join(columns)}")
+                if cache_key:
+                    self.result_cache.put(cache_key, result)
                 
-                return QueryResponse(
-                    results=results,
-                    columns=columns,
-                    execution_time_ms=execution_time,
-                    timestamp=datetime.now().isoformat(),
-                    source_tables=tables
-                )
+                # Convert results to list of dictionaries
+                results = result.to_pylist()
+                columns = result.column_names
+                root_span.attributes['rows'] = len(results)
+            
+            execution_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+            self.query_duration.observe(execution_time / 1000)
+            print(f"\nQuery Execution Stats:")
+            print(f"  Execution time: {execution_time:.2f}ms")
+            print(f"  Rows returned: {len(results):,}")
+            print(f"  Columns: {', '.join(columns)}")
+            
+            return QueryResponse(
+                results=results,
+                columns=columns,
+                execution_time_ms=execution_time,
+                timestamp=datetime.now().isoformat(),
+                source_tables=tables,
+                trace_id=root_span.trace_id
+            )
+        except HTTPException:
+            self.query_errors += 1
+            raise
         except Exception as e:
+            self.query_errors += 1
             logger.error(f"Error executing query: {str(e)}")
             raise HTTPException(status_code=400, detail=str(e))
+    
+    def render_metrics(self) -> str:
+        """Render query and per-node request metrics in the Prometheus text format."""
+        lines = [
+            '# HELP distributed_query_duration_seconds Latency of queries answered by the router.',
+            '# TYPE distributed_query_duration_seconds histogram',
+            *self.query_duration.render('distributed_query_duration_seconds'),
+            '# HELP distributed_query_errors_total Queries that failed.',
+            '# TYPE distributed_query_errors_total counter',
+            f'distributed_query_errors_total {self.query_errors}',
+            '# HELP distributed_query_node_request_duration_seconds Latency of requests to each data node.',
+            '# TYPE distributed_query_node_request_duration_seconds histogram'
+        ]
+        for base_url, node in self._node_states.items():
+            lines += node.request_duration.render('distributed_query_node_request_duration_seconds', f'node="{base_url}"')
+        
+        lines += ['# HELP distributed_query_node_errors_total Failed requests to each data node by kind.',
+                  '# TYPE distributed_query_node_errors_total counter']
+        for base_url, node in self._node_states.items():
+            lines += [f'distributed_query_node_errors_total{{node="{base_url}",kind="{kind}"}} {count}'
+                      for kind, count in node.errors.items()]
+        
+        per_node = [
+            ('node_outstanding_requests', 'gauge', 'Requests to each data node in flight.', lambda node: node.outstanding),
+            ('node_received_bytes_total', 'counter', 'Response bytes received from each data node.',
+             lambda node: node.bytes_received),
+            ('node_received_rows_total', 'counter', 'Rows received from each data node.', lambda node: node.rows_received),
+            ('node_circuit_open', 'gauge', 'Whether the circuit of each data node is open.',
+             lambda node: int(node.breaker.state == 'open')),
+            ('node_ready', 'gauge', 'Whether each data node last reported itself ready.', lambda node: int(node.ready))
+        ]
+        for name, metric_type, description, value in per_node:
+            lines += [f'# HELP distributed_query_{name} {description}', f'# TYPE distributed_query_{name} {metric_type}']
+            lines += [f'distributed_query_{name}{{node="{base_url}"}} {value(node)}'
+                      for base_url, node in self._node_states.items()]
+        
+        for name, cache in (('result', self.result_cache), ('fragment', self.fragment_cache)):
+            stats = cache.stats()
+            lines += [
+                f'# TYPE distributed_query_{name}_cache_hits_total counter',
+                f'distributed_query_{name}_cache_hits_total {stats["hits"]}',
+                f'# TYPE distributed_query_{name}_cache_misses_total counter',
+                f'distributed_query_{name}_cache_misses_total {stats["misses"]}'
+            ]
+        return '\n'.join(lines) + '\n'
 
 def main():
     parser = argparse.ArgumentParser(description='Start a distributed query server')
@@ -540,22 +2542,78 @@ def main():
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=8000, help='Port to bind the server to')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--max-stream-rows', type=int, help='Maximum rows returned by a streamed query (default: no cap)')
+    parser.add_argument('--stream-batch-rows', type=int, default=10000, help='Rows per record batch when streaming results')
+    parser.add_argument('--duckdb-threads', type=int, help='DuckDB worker threads (default: number of cores)')
+    parser.add_argument('--duckdb-memory-limit', help='DuckDB memory limit, e.g. 4GB; larger joins spill to the temp directory')
+    parser.add_argument('--duckdb-temp-directory', help='Directory DuckDB and large fragments spill to (default: a temp directory)')
+    parser.add_argument('--spill-threshold-mb', type=int, default=64, help='Spool Arrow fragments larger than this to disk (0 never)')
+    parser.add_argument('--duckdb-sessions', type=int, default=8, help='Pooled DuckDB cursors, i.e. queries executing at once')
+    parser.add_argument('--duckdb-workers', type=int, help='Threads running DuckDB calls off the event loop (default: --duckdb-sessions)')
+    parser.add_argument('--result-cache-mb', type=int, default=256, help='Memory for cached query results in MB (0 disables)')
+    parser.add_argument('--fragment-cache-mb', type=int, default=256, help='Memory for cached remote fragments in MB (0 disables)')
+    parser.add_argument('--version-ttl', type=float, default=5.0, help='Seconds to trust a data node\'s version token')
+    parser.add_argument('--no-http2', action='store_true', help='Use HTTP/1.1 only for data node requests')
+    parser.add_argument('--http-timeout', type=float, default=30.0, help='Data node request timeout in seconds')
+    parser.add_argument('--node-max-concurrency', type=int, default=16, help='In-flight requests per data node')
+    parser.add_argument('--retry-attempts', type=int, default=3, help='Attempts per idempotent data node request')
+    parser.add_argument('--hedge-after-ms', type=float, help='Send a duplicate request when a data node has not answered after this delay')
+    parser.add_argument('--breaker-failure-threshold', type=int, default=5, help='Consecutive failures that open a node\'s circuit')
+    parser.add_argument('--breaker-reset-timeout', type=float, default=30.0, help='Seconds before retrying a node with an open circuit')
+    parser.add_argument('--health-check-interval', type=float, default=10.0, help='Seconds between data node health checks (0 disables)')
+    parser.add_argument('--job-spool-dir', help='Directory for background job results (default: a temp directory)')
+    parser.add_argument('--job-ttl', type=float, default=3600.0, help='Seconds to keep a finished job\'s results')
+    parser.add_argument('--job-http-timeout', type=float, default=600.0, help='Data node request timeout for background jobs in seconds')
+    parser.add_argument('--broadcast-max-rows', type=int, default=10000,
+                        help='Keep joined tables of up to this many rows resident in router memory (0 disables)')
+    parser.add_argument('--semi-join-max-keys', type=int, default=1000, help='Largest key list pushed from a broadcast table into a join')
+    parser.add_argument('--limit-fanout', type=int, default=2, help='Shards asked at once for the rows of a LIMIT query without ORDER BY')
+    parser.add_argument('--trace-buffer', type=int, default=100, help='Traces of recent queries kept for /traces (0 keeps none)')
     
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     
+    # Create distributed query server
+    settings = ServerSettings(
+        max_stream_rows=args.max_stream_rows,
+        stream_batch_rows=args.stream_batch_rows,
+        duckdb_threads=args.duckdb_threads,
+        duckdb_memory_limit=args.duckdb_memory_limit,
+        duckdb_temp_directory=args.duckdb_temp_directory,
+        spill_threshold_mb=args.spill_threshold_mb,
+        duckdb_sessions=args.duckdb_sessions,
+        duckdb_workers=args.duckdb_workers,
+        result_cache_mb=args.result_cache_mb,
+        fragment_cache_mb=args.fragment_cache_mb,
+        version_ttl=args.version_ttl,
+        http2=not args.no_http2,
+        http_timeout=args.http_timeout,
+        node_max_concurrency=args.node_max_concurrency,
+        retry_attempts=args.retry_attempts,
+        hedge_after_ms=args.hedge_after_ms,
+        breaker_failure_threshold=args.breaker_failure_threshold,
+        breaker_reset_timeout=args.breaker_reset_timeout,
+        health_check_interval=args.health_check_interval,
+        job_spool_dir=args.job_spool_dir,
+        job_ttl=args.job_ttl,
+        job_http_timeout=args.job_http_timeout,
+        broadcast_max_rows=args.broadcast_max_rows,
+        semi_join_max_keys=args.semi_join_max_keys,
+        limit_fanout=args.limit_fanout,
+        trace_buffer=args.trace_buffer
+    )
+    server = DistributedQueryServer(args.config, settings)
+    
     # Create FastAPI app
     app = FastAPI(
         title="Distributed DuckDB Query API",
         description="API for querying data across multiple DuckDB containers",
-        version="1.0.0"
+        version="1.0.0",
+        lifespan=server.lifespan
     )
     
-    # Create distributed query server
-    server = DistributedQueryServer(args.config)
-    
     @app.get("/")
     async def root():
         return {
@@ -565,9 +2623,75 @@ def main():
             "available_tables": list(server.config.tables.keys())
         }
     
+    @app.get("/nodes")
+    async def node_status():
+        return {
+            base_url: {
+                "circuit": node.breaker.state,
+                "ready": node.ready,
+                "consecutive_failures": node.breaker.failures,
+                "outstanding_requests": node.outstanding,
+                "latency_ms": round(node.latency * 1000, 2) if node.latency is not None else None
+            }
+            for base_url, node in server._node_states.items()
+        }
+    
+    @app.post("/explain", response_model=ExplainResponse)
+    async def explain_query(query_request: QueryRequest, analyze: bool = False):
+        return await server.explain_query(query_request, analyze)
+    
+    @app.get("/cache")
+    async def cache_stats():
+        return {
+            "result_cache": server.result_cache.stats(),
+            "fragment_cache": server.fragment_cache.stats(),
+            "broadcast_tables": server._broadcast_tables
+        }
+    
+    @app.delete("/cache")
+    async def clear_cache():
+        server.result_cache.clear()
+        server.fragment_cache.clear()
+        server._drop_broadcast_tables()
+        return {"message": "Caches cleared"}
+    
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        return PlainTextResponse(server.render_metrics(), media_type='text/plain; version=0.0.4')
+    
+    @app.get("/traces")
+    async def recent_traces():
+        return server.tracer.recent()
+    
+    @app.get("/traces/{trace_id}")
+    async def get_trace(trace_id: str):
+        return server.tracer.get_trace(trace_id)
+    
     @app.post("/query", response_model=QueryResponse)
-    async def execute_query(query_request: QueryRequest):
-        return await server.execute_query(query_request)
+    async def execute_query(query_request: QueryRequest, accept: Optional[str] = Header(None),
+                            traceparent: Optional[str] = Header(None)):
+        # Stream NDJSON or Arrow IPC when the client asks for it
+        stream_format = server.negotiate_stream_format(accept)
+        if stream_format:
+            return await server.execute_query_stream(query_request, stream_format, traceparent)
+        return await server.execute_query(query_request, traceparent)
+    
+    @app.post("/jobs", response_model=JobStatus, status_code=202)
+    async def submit_job(query_request: QueryRequest):
+        return server.submit_job(query_request)
+    
+    @app.get("/jobs/{job_id}", response_model=JobStatus)
+    async def job_status(job_id: str):
+        return server.get_job_status(job_id)
+    
+    @app.delete("/jobs/{job_id}", response_model=JobStatus)
+    async def cancel_job(job_id: str):
+        return await server.cancel_job(job_id)
+    
+    @app.get("/jobs/{job_id}/result")
+    async def job_result(job_id: str, offset: int = 0, limit: int = 10000, accept: Optional[str] = Header(None)):
+        # Pages of JSON by default; the whole result as NDJSON or Arrow IPC when asked for
+        return await server.get_job_result(job_id, offset, limit, server.negotiate_stream_format(accept))
     
     # Start the server
     logger.info(f"Starting distributed query server on {args.host}:{args.port}")
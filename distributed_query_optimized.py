@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import json
 import re
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 import httpx
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
@@ -35,11 +39,108 @@ class TableConfig(BaseModel):
 class Config(BaseModel):
     tables: Dict[str, TableConfig]
 
+class QuerySession:
+    """Per-query state: a DuckDB cursor of its own and the temporary tables created on it,
+    so concurrent queries never see or drop each other's tables.
+    """
+    
+    def __init__(self, cursor: duckdb.DuckDBPyConnection):
+        self.cursor = cursor
+        self.query_id = uuid.uuid4().hex[:12]
+        self.temp_tables: List[str] = []
+        self.lock = threading.Lock()  # Concurrent steps of the query use the cursor one at a time
+    
+    def temp_table(self, table: str) -> str:
+        """Return a temporary table name unique to this query."""
+        temp_table = f"temp_{table}_{self.query_id}"
+        self.temp_tables.append(temp_table)
+        return temp_table
+    
+    def drop_temp_tables(self) -> None:
+        """Drop the session's temporary tables, logging rather than raising on failure."""
+        for temp_table in self.temp_tables:
+            try:
+                self.cursor.execute(f"DROP TABLE IF EXISTS {temp_table}")
+            except Exception as cleanup_error:
+                logger.error(f"Error dropping temporary table {temp_table}: {str(cleanup_error)}")
+        self.temp_tables.clear()
+
 class DistributedQueryServer:
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, node_max_concurrency: int = 8, duckdb_workers: int = 8):
         self.config = self._load_config(config_path)
         self.conn = duckdb.connect(database=':memory:')
         self.client = httpx.AsyncClient(timeout=30.0)  # 30 second timeout
+        self.node_max_concurrency = node_max_concurrency
+        self._node_semaphores = {}  # Base URL -> semaphore capping in-flight requests to that node
+        self._db_executor = ThreadPoolExecutor(max_workers=duckdb_workers, thread_name_prefix='duckdb')
+    
+    async def _run_db(self, session: QuerySession, func, *args):
+        """Run a blocking DuckDB call on a session's cursor in a worker thread instead of the
+        event loop. If the caller is cancelled, it still waits for the call to finish, so the
+        cursor is not dropped or closed under it.
+        """
+        def run():
+            with session.lock:
+                return func(*args)
+        
+        future = asyncio.get_running_loop().run_in_executor(self._db_executor, run)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+    
+    def _create_temp_table(self, session: QuerySession, temp_table: str, df: pd.DataFrame) -> None:
+        """Copy a fetched DataFrame into a temporary table of the session."""
+        session.cursor.register(f"df_{temp_table}", df)
+        try:
+            session.cursor.execute(f"CREATE TEMP TABLE {temp_table} AS SELECT * FROM df_{temp_table}")
+        finally:
+            session.cursor.unregister(f"df_{temp_table}")
+    
+    def _fetch_local(self, session: QuerySession, query: str) -> pd.DataFrame:
+        """Run a query over the session's temporary tables."""
+        return session.cursor.execute(query).fetchdf()
+    
+    def _base_url(self, table: str) -> str:
+        """Base URL of the data container serving a table."""
+        table_config = self.config.tables[table]
+        
+        # Ensure URL has http:// prefix
+        base_url = table_config.url
+        if not base_url.startswith(('http://', 'https://')):
+            base_url = f"http://{base_url}"
+        return f"{base_url}:{table_config.port}"
+    
+    def _node_semaphore(self, base_url: str) -> asyncio.Semaphore:
+        # Created on first use so it belongs to the server's event loop
+        if base_url not in self._node_semaphores:
+            self._node_semaphores[base_url] = asyncio.Semaphore(self.node_max_concurrency)
+        return self._node_semaphores[base_url]
+    
+    async def _schedule(self, steps: Dict[str, Tuple[List[str], Callable[..., Awaitable[Any]]]]) -> Dict[str, Any]:
+        """Run fetch steps concurrently, each starting as soon as the steps it depends on finish.
+        
+        steps maps a step name to (names of the steps it depends on, coroutine function).
+        The coroutine function is called with the results of its dependencies in order.
+        Returns the result of every step by name.
+        """
+        tasks = {}
+        
+        async def run_step(name: str):
+            dependencies, func = steps[name]
+            results = [await tasks[dependency] for dependency in dependencies]
+            return await func(*results)
+        
+        for name in steps:
+            tasks[name] = asyncio.ensure_future(run_step(name))
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except Exception:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return dict(zip(tasks, results))
         
     def _load_config(self, config_path: str) -> Config:
         """Load configuration from JSON file."""
@@ -78,8 +179,8 @@ class DistributedQueryServer:
         # Combine both types of joins
         all_joins = []
         for join in joins:
-            # Format: (joined_table, left_column, right_column)
-            all_joins.append((join[0], join[1], join[2], join[3], join[4]))
+            # Format: (left_table, left_column, right_table, right_column); drop the joined table name
+            all_joins.append((join[1], join[2], join[3], join[4]))
         
         for join in where_joins:
             # Format: (left_table, left_column, right_table, right_column)
@@ -101,18 +202,13 @@ class DistributedQueryServer:
     
     async def _get_table_metadata(self, table: str) -> Dict:
         """Get metadata about a table from its data container."""
-        table_config = self.config.tables[table]
-        
-        # Ensure URL has http:// prefix
-        base_url = table_config.url
-        if not base_url.startswith(('http://', 'https://')):
-            base_url = f"http://{base_url}"
-        
-        url = f"{base_url}:{table_config.port}/metadata"
+        base_url = self._base_url(table)
+        url = f"{base_url}/metadata"
         logger.info(f"Getting metadata from {url}")
         
         try:
-            response = await self.client.get(url)
+            async with self._node_semaphore(base_url):
+                response = await self.client.get(url)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -124,21 +220,16 @@ class DistributedQueryServer:
     
     async def _execute_remote_query(self, table: str, query: str) -> pd.DataFrame:
         """Execute a query on a remote data container."""
-        table_config = self.config.tables[table]
-        
-        # Ensure URL has http:// prefix
-        base_url = table_config.url
-        if not base_url.startswith(('http://', 'https://')):
-            base_url = f"http://{base_url}"
-        
-        url = f"{base_url}:{table_config.port}/query"
+        base_url = self._base_url(table)
+        url = f"{base_url}/query"
         logger.info(f"Executing remote query on {url}: {query}")
         
         try:
-            response = await self.client.post(
-                url,
-                json={"query": query}
-            )
+            async with self._node_semaphore(base_url):
+                response = await self.client.post(
+                    url,
+                    json={"query": query}
+                )
             response.raise_for_status()
             result = response.json()
             
@@ -160,7 +251,7 @@ class DistributedQueryServer:
                 detail=f"Unexpected error when querying {url}: {str(e)}"
             )
     
-    async def _optimize_join_query(self, query: str) -> Tuple[str, List[pd.DataFrame]]:
+    async def _optimize_join_query(self, query: str, session: QuerySession) -> Tuple[str, List[pd.DataFrame]]:
         """Optimize a join query by first querying the smaller table and then using those IDs
         to query only the necessary rows from the larger table."""
         
@@ -193,8 +284,8 @@ class DistributedQueryServer:
             df = await self._execute_remote_query(table, subquery)
             
             # Create a temporary table in DuckDB
-            temp_table = f"temp_{table}"
-            self.conn.execute(f"CREATE TABLE {temp_table} AS SELECT * FROM df")
+            temp_table = session.temp_table(table)
+            await self._run_db(session, self._create_temp_table, session, temp_table, df)
             
             # Return the modified query and the list of dataframes
             modified_query = query_without_limit.replace(table, temp_table)
@@ -208,12 +299,11 @@ class DistributedQueryServer:
         # If we can't parse join conditions, fall back to the original approach
         if not join_conditions:
             logger.warning("Could not parse join conditions, falling back to original approach")
-            return await self._execute_distributed_query_original(query)
+            return await self._execute_distributed_query_original(query, session)
         
         # Get metadata for all tables to determine which one is smaller
-        table_metadata = {}
-        for table in tables:
-            table_metadata[table] = await self._get_table_metadata(table)
+        metadata_list = await asyncio.gather(*[self._get_table_metadata(table) for table in tables])
+        table_metadata = dict(zip(tables, metadata_list))
         
         # Determine the smallest table to start with
         smallest_table = min(tables, key=lambda t: table_metadata[t]["row_count"])
@@ -232,22 +322,52 @@ class DistributedQueryServer:
         subquery = f"SELECT {columns} FROM {smallest_table_config.table_name}"
         if limit:
             subquery += f" LIMIT {limit}"
-        logger.info(f"Executing subquery for smallest table {smallest_table}: {subquery}")
-        smallest_df = await self._execute_remote_query(smallest_table, subquery)
+        temp_smallest_table = session.temp_table(smallest_table)
         
-        # Create a temporary table for the smallest table
-        temp_smallest_table = f"temp_{smallest_table}"
-        self.conn.execute(f"CREATE TABLE {temp_smallest_table} AS SELECT * FROM smallest_df")
+        async def fetch_smallest_table() -> pd.DataFrame:
+            logger.info(f"Executing subquery for smallest table {smallest_table}: {subquery}")
+            smallest_df = await self._execute_remote_query(smallest_table, subquery)
+            
+            # Create a temporary table for the smallest table
+            await self._run_db(session, self._create_temp_table, session, temp_smallest_table, smallest_df)
+            return smallest_df
         
-        # For each join condition, extract the IDs from the smallest table and use them to query the other table
-        dfs = [(smallest_table, smallest_df)]
-        modified_query = query_without_limit.replace(smallest_table, temp_smallest_table)
+        def semi_join_fetch(other_table: str, other_column: str, smallest_column: str):
+            """Build the fetch of another table restricted to the smallest table's join keys."""
+            async def fetch_other_table(smallest_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+                # Extract the IDs from the smallest table
+                id_query = f"SELECT DISTINCT {smallest_column} FROM {temp_smallest_table}"
+                id_df = await self._run_db(session, self._fetch_local, session, id_query)
+                
+                if id_df.empty:
+                    logger.warning(f"No IDs found in {smallest_table}.{smallest_column}")
+                    return None
+                
+                # Convert IDs to a list for the IN clause
+                ids = id_df[smallest_column].tolist()
+                id_list = ", ".join([f"'{id}'" if isinstance(id, str) else str(id) for id in ids])
+                
+                # Limit the number of IDs to avoid overly long queries
+                if len(ids) > 1000:
+                    logger.warning(f"Too many IDs ({len(ids)}), limiting to 1000")
+                    id_list = ", ".join([f"'{id}'" if isinstance(id, str) else str(id) for id in ids[:1000]])
+                
+                # Create and execute the subquery for the other table
+                other_table_config = self.config.tables[other_table]
+                other_subquery = f"SELECT * FROM {other_table_config.table_name} WHERE {other_column} IN ({id_list})"
+                # Note: We don't apply LIMIT here because we want all matching rows from the second table
+                logger.info(f"Executing subquery for {other_table} with {len(ids)} IDs")
+                return await self._execute_remote_query(other_table, other_subquery)
+            return fetch_other_table
         
+        # The smallest table is fetched first; the tables joined to it only depend on its
+        # keys, so they are fetched concurrently with each other once it arrives
+        steps = {smallest_table: ([], fetch_smallest_table)}
         for join in join_conditions:
             # Determine which table is the other table in this join
             if join[0] == smallest_table:
-                other_table = join[3]
-                other_column = join[4]
+                other_table = join[2]
+                other_column = join[3]
                 smallest_column = join[1]
             else:
                 other_table = join[0]
@@ -255,36 +375,21 @@ class DistributedQueryServer:
                 smallest_column = join[3]
             
             # Skip if we've already processed this table
-            if any(table == other_table for table, _ in dfs):
+            if other_table in steps:
                 continue
-            
-            # Extract the IDs from the smallest table
-            id_query = f"SELECT DISTINCT {smallest_column} FROM {temp_smallest_table}"
-            id_df = self.conn.execute(id_query).fetchdf()
-            
-            if id_df.empty:
-                logger.warning(f"No IDs found in {smallest_table}.{smallest_column}")
+            steps[other_table] = ([smallest_table], semi_join_fetch(other_table, other_column, smallest_column))
+        
+        fetched = await self._schedule(steps)
+        
+        dfs = [(smallest_table, fetched.pop(smallest_table))]
+        modified_query = query_without_limit.replace(smallest_table, temp_smallest_table)
+        for other_table, other_df in fetched.items():
+            if other_df is None:
                 continue
             
-            # Convert IDs to a list for the IN clause
-            ids = id_df[smallest_column].tolist()
-            id_list = ", ".join([f"'{id}'" if isinstance(id, str) else str(id) for id in ids])
-            
-            # Limit the number of IDs to avoid overly long queries
-            if len(ids) > 1000:
-                logger.warning(f"Too many IDs ({len(ids)}), limiting to 1000")
-                id_list = ", ".join([f"'{id}'" if isinstance(id, str) else str(id) for id in ids[:1000]])
-            
-            # Create and execute the subquery for the other table
-            other_table_config = self.config.tables[other_table]
-            other_subquery = f"SELECT * FROM {other_table_config.table_name} WHERE {other_column} IN ({id_list})"
-            # Note: We don't apply LIMIT here because we want all matching rows from the second table
-            logger.info(f"Executing subquery for {other_table} with {len(ids)} IDs")
-            other_df = await self._execute_remote_query(other_table, other_subquery)
-            
             # Create a temporary table for the other table
-            temp_other_table = f"temp_{other_table}"
-            self.conn.execute(f"CREATE TABLE {temp_other_table} AS SELECT * FROM other_df")
+            temp_other_table = session.temp_table(other_table)
+            await self._run_db(session, self._create_temp_table, session, temp_other_table, other_df)
             
             # Update the modified query
             modified_query = modified_query.replace(other_table, temp_other_table)
@@ -298,7 +403,7 @@ class DistributedQueryServer:
         
         return modified_query, dfs
     
-    async def _execute_distributed_query_original(self, query: str) -> Tuple[str, List[pd.DataFrame]]:
+    async def _execute_distributed_query_original(self, query: str, session: QuerySession) -> Tuple[str, List[pd.DataFrame]]:
         """Original implementation of distributed query execution."""
         # Parse the query to get involved tables
         tables = self._parse_query(query)
@@ -309,7 +414,7 @@ class DistributedQueryServer:
         query_without_limit = self._remove_limit(query)
         
         # For each table, create a subquery to get the required data
-        dfs = []
+        subqueries = {}
         for table in tables:
             table_config = self.config.tables[table]
             
@@ -322,21 +427,23 @@ class DistributedQueryServer:
             else:
                 columns = "*"
             
-            # Create and execute the subquery
-            subquery = f"SELECT {columns} FROM {table_config.table_name}"
-            logger.info(f"Executing subquery for table {table}: {subquery}")
-            df = await self._execute_remote_query(table, subquery)
-            
-            # Create a temporary table in DuckDB
-            temp_table = f"temp_{table}"
-            self.conn.execute(f"CREATE TABLE {temp_table} AS SELECT * FROM df")
-            dfs.append((table, df))
+            # Create the subquery
+            subqueries[table] = f"SELECT {columns} FROM {table_config.table_name}"
+            logger.info(f"Executing subquery for table {table}: {subqueries[table]}")
+        
+        # The subqueries are independent, so they all run at once
+        results = await asyncio.gather(*[self._execute_remote_query(table, subquery)
+                                         for table, subquery in subqueries.items()])
         
-        # Execute the join in DuckDB
-        # Replace table names in the original query with temp table names
+        dfs = []
         modified_query = query_without_limit
-        for table, _ in dfs:
-            temp_table = f"temp_{table}"
+        for table, df in zip(subqueries, results):
+            # Create a temporary table in DuckDB
+            temp_table = session.temp_table(table)
+            await self._run_db(session, self._create_temp_table, session, temp_table, df)
+            dfs.append((table, df))
+            
+            # Replace the table name in the original query with the temp table name
             modified_query = modified_query.replace(table, temp_table)
         
         # Add back the LIMIT clause if it was present
@@ -346,38 +453,31 @@ class DistributedQueryServer:
         return modified_query, dfs
     
     async def _execute_distributed_query(self, query: str) -> pd.DataFrame:
-        """Execute a query across multiple data containers."""
+        """Execute a query across multiple data containers on a cursor of its own."""
+        session = QuerySession(self.conn.cursor())
         try:
-            # Try to optimize the join query
-            modified_query, dfs = await self._optimize_join_query(query)
-            
-            # Execute the modified query
-            logger.info(f"Executing optimized query: {modified_query}")
-            result = self.conn.execute(modified_query).fetchdf()
-            
+            try:
+                # Try to optimize the join query
+                modified_query, dfs = await self._optimize_join_query(query, session)
+                
+                # Execute the modified query
+                logger.info(f"Executing optimized query: {modified_query}")
+                return await self._run_db(session, self._fetch_local, session, modified_query)
+            except Exception as e:
+                logger.error(f"Error in optimized query execution: {str(e)}")
+                logger.info("Falling back to original approach")
+                await self._run_db(session, session.drop_temp_tables)
+                
+                # Fall back to the original approach
+                modified_query, dfs = await self._execute_distributed_query_original(query, session)
+                
+                # Execute the modified query
+                logger.info(f"Executing original query: {modified_query}")
+                return await self._run_db(session, self._fetch_local, session, modified_query)
+        finally:
             # Clean up temporary tables
-            for table, _ in dfs:
-                temp_table = f"temp_{table}"
-                self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-            
-            return result
-        except Exception as e:
-            logger.error(f"Error in optimized query execution: {str(e)}")
-            logger.info("Falling back to original approach")
-            
-            # Fall back to the original approach
-            modified_query, dfs = await self._execute_distributed_query_original(query)
-            
-            # Execute the modified query
-            logger.info(f"Executing original query: {modified_query}")
-            result = self.conn.execute(modified_query).fetchdf()
-            
-            # Clean up temporary tables
-            for table, _ in dfs:
-                temp_table = f"temp_{table}"
-                self.conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
-            
-            return result
+            await self._run_db(session, session.drop_temp_tables)
+            session.cursor.close()
     
     async def execute_query(self, query_request: QueryRequest) -> QueryResponse:
         """Execute a distributed query and return the results."""
@@ -413,6 +513,8 @@ def main():
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=8000, help='Port to bind the server to')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--node-max-concurrency', type=int, default=8, help='In-flight requests per data node')
+    parser.add_argument('--duckdb-workers', type=int, default=8, help='Threads running DuckDB work off the event loop')
     
     args = parser.parse_args()
     
@@ -427,7 +529,7 @@ def main():
     )
     
     # Create distributed query server
-    server = DistributedQueryServer(args.config)
+    server = DistributedQueryServer(args.config, args.node_max_concurrency, args.duckdb_workers)
     
     @app.get("/")
     async def root():
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Local stand-in for a query_s3.py data node.
+
+Serves /query, /metadata and /version over a local Parquet or CSV file (or a
+generated synthetic table) instead of a file downloaded from S3, with optional
+injected latency and bandwidth limits so the distributed router can be tested
+and benchmarked without network access.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+import uvicorn
+import duckdb
+import pyarrow as pa
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Countries used by the synthetic tables
+COUNTRIES = ['US', 'UK', 'DE', 'FR', 'JP', 'SE', 'NL', 'CA', 'AU', 'BR']
+
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+class QueryRequest(BaseModel):
+    query: str
+
+class ColumnMetadata(BaseModel):
+    name: str
+    type: str
+
+class DatasetMetadata(BaseModel):
+    s3_url: str
+    view_name: str
+    columns: List[ColumnMetadata]
+    row_count: int
+    column_count: int
+    local_cache_path: Optional[str] = None
+    last_modified: Optional[str] = None
+    cache_status: Optional[str] = None
+    data_version: Optional[str] = None
+
+class DataVersion(BaseModel):
+    table_name: str
+    version: Optional[str] = None
+    last_modified: Optional[str] = None
+    cache_status: Optional[str] = None
+
+class NodeStats(BaseModel):
+    queries: int
+    bytes_sent: int
+    rows_sent: int
+
+class MockDataNode:
+    """A DuckDB view over a local file, served like a query_s3.py container."""
+
+    def __init__(self, table_name: str, source: str, where: Optional[str] = None,
+                 latency_ms: float = 0.0, jitter_ms: float = 0.0, bandwidth_mbps: Optional[float] = None):
+        self.table_name = table_name
+        self.source = source
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.bandwidth_mbps = bandwidth_mbps
+        self.conn = duckdb.connect(database=':memory:')
+
+        # Serve only a slice of the file when acting as one shard of a table
+        escaped_source = source.replace("'", "''")
+        reader = f"read_parquet('{escaped_source}')" if source.endswith('.parquet') else f"read_csv_auto('{escaped_source}')"
+        where_clause = f" WHERE {where}" if where else ""
+        self.conn.execute(f"CREATE VIEW {table_name} AS SELECT * FROM {reader}{where_clause}")
+
+        stat = os.stat(source)
+        self.last_modified = datetime.fromtimestamp(stat.st_mtime).isoformat()
+        self.version = f"{stat.st_size:x}-{stat.st_mtime_ns:x}" + (f"-{hashlib.sha1(where.encode()).hexdigest()[:8]}" if where else "")
+
+        self.queries = 0
+        self.bytes_sent = 0
+        self.rows_sent = 0
+        self._lock = threading.Lock()
+
+    def _execute(self, query: str) -> pa.Table:
+        """Run a query on a cursor of its own so concurrent requests do not share one."""
+        cursor = self.conn.cursor()
+        try:
+            return cursor.execute(query).fetch_arrow_table()
+        finally:
+            cursor.close()
+
+    async def _delay(self, response_bytes: int) -> None:
+        """Wait out the injected latency and the transfer time at the configured bandwidth."""
+        delay = self.latency_ms / 1000
+        if self.jitter_ms:
+            delay += random.uniform(0, self.jitter_ms) / 1000
+        if self.bandwidth_mbps:
+            delay += response_bytes / (self.bandwidth_mbps * 125000)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def query(self, query: str, arrow: bool = False) -> Response:
+        """Answer a query as JSON, or as an Arrow IPC stream like query_s3.py when asked for one."""
+        start_time = time.time()
+        loop = asyncio.get_running_loop()
+        try:
+            table = await loop.run_in_executor(None, self._execute, query)
+        except Exception as e:
+            logger.error(f"Error executing query: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if arrow:
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            body = sink.getvalue().to_pybytes()
+            media_type = ARROW_STREAM_MEDIA_TYPE
+        else:
+            result = {
+                'results': table.to_pylist(),
+                'columns': table.column_names,
+                'execution_time_ms': (time.time() - start_time) * 1000,
+                'timestamp': datetime.now().isoformat()
+            }
+            body = json.dumps(result, default=str).encode()
+            media_type = 'application/json'
+        await self._delay(len(body))
+
+        with self._lock:
+            self.queries += 1
+            self.bytes_sent += len(body)
+            self.rows_sent += table.num_rows
+        return Response(content=body, media_type=media_type)
+
+    def metadata(self) -> DatasetMetadata:
+        columns = self.conn.execute(f"DESCRIBE {self.table_name}").fetchall()
+        row_count = self.conn.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+        return DatasetMetadata(
+            s3_url=f"file://{os.path.abspath(self.source)}",
+            view_name=self.table_name,
+            columns=[ColumnMetadata(name=column[0], type=column[1]) for column in columns],
+            row_count=row_count,
+            column_count=len(columns),
+            local_cache_path=self.source,
+            last_modified=self.last_modified,
+            cache_status='local',
+            data_version=self.version
+        )
+
+def generate_synthetic_table(kind: str, rows: int, path: str, seed: int = 42, label_rows: int = 1000) -> None:
+    """Write a deterministic synthetic labels or artists table to a Parquet or CSV file."""
+    countries = ', '.join(f"'{country}'" for country in COUNTRIES)
+    if kind == 'labels':
+        select = f"""
+            SELECT i AS id,
+                   'Label ' || i AS name,
+                   [{countries}][1 + (hash(i, {seed}) % {len(COUNTRIES)})::INTEGER] AS country,
+                   (1950 + hash(i, {seed} + 1) % 75)::INTEGER AS founded
+            FROM range({rows}) t(i)"""
+    elif kind == 'artists':
+        select = f"""
+            SELECT i AS id,
+                   'Artist ' || i AS name,
+                   (hash(i, {seed}) % {label_rows})::BIGINT AS label_id,
+                   [{countries}][1 + (hash(i, {seed} + 2) % {len(COUNTRIES)})::INTEGER] AS country,
+                   (hash(i, {seed} + 3) % 10000)::INTEGER / 100.0 AS score
+            FROM range({rows}) t(i)"""
+    else:
+        raise ValueError(f"Unknown synthetic table '{kind}' (expected labels or artists)")
+
+    file_format = 'PARQUET' if path.endswith('.parquet') else 'CSV, HEADER'
+    escaped_path = path.replace("'", "''")
+    duckdb.connect(database=':memory:').execute(f"COPY ({select}) TO '{escaped_path}' (FORMAT {file_format})")
+
+def create_app(node: MockDataNode) -> FastAPI:
+    app = FastAPI(
+        title="Mock DuckDB Data Node",
+        description="Local stand-in for the S3-backed query API",
+        version="1.0.0"
+    )
+
+    @app.get("/")
+    async def root():
+        return {
+            "message": "Mock DuckDB data node is running",
+            "table_name": node.table_name,
+            "source": node.source
+        }
+
+    @app.get("/metadata", response_model=DatasetMetadata)
+    async def get_metadata():
+        return node.metadata()
+
+    @app.get("/version", response_model=DataVersion)
+    async def get_version():
+        return DataVersion(
+            table_name=node.table_name,
+            version=node.version,
+            last_modified=node.last_modified,
+            cache_status='local'
+        )
+
+    @app.post("/query")
+    async def execute_query(query_request: QueryRequest, accept: Optional[str] = Header(None)):
+        return await node.query(query_request.query, ARROW_STREAM_MEDIA_TYPE in (accept or ''))
+
+    @app.get("/stats", response_model=NodeStats)
+    async def get_stats():
+        return NodeStats(queries=node.queries, bytes_sent=node.bytes_sent, rows_sent=node.rows_sent)
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local Parquet or CSV file like a query_s3.py data node')
+    parser.add_argument('--table-name', required=True, help='Name of the table to serve')
+    parser.add_argument('--source', help='Local Parquet or CSV (optionally gzipped) file to serve')
+    parser.add_argument('--generate', choices=['labels', 'artists'], help='Generate a synthetic table into --source first')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows of the generated table')
+    parser.add_argument('--label-rows', type=int, default=1000, help='Number of labels that generated artists refer to')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the generated table')
+    parser.add_argument('--where', help='Serve only rows matching this condition (e.g. to act as a shard)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency added to every query response')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra latency of up to this many ms')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Simulated link bandwidth in megabits per second')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to bind the server to')
+    parser.add_argument('--port', type=int, default=8001, help='Port to bind the server to')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.generate:
+        args.source = args.source or f"{args.table_name}.parquet"
+        if not os.path.exists(args.source):
+            logger.info(f"Generating {args.rows:,} synthetic {args.generate} rows into {args.source}")
+            generate_synthetic_table(args.generate, args.rows, args.source, args.seed, args.label_rows)
+    if not args.source:
+        parser.error('--source or --generate is required')
+
+    node = MockDataNode(args.table_name, args.source, args.where,
+                        args.latency_ms, args.jitter_ms, args.bandwidth_mbps)
+
+    print(f"\nStarting mock data node on {args.host}:{args.port}")
+    print(f"Serving {args.source} as table '{args.table_name}'")
+    uvicorn.run(create_app(node), host=args.host, port=args.port, log_level='warning')
+
+if __name__ == "__main__":
+    main()
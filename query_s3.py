@@ -2,20 +2,36 @@
 import argparse
 import duckdb
 import boto3
+from botocore.config import Config
 import os
 import sys
 import time
 import hashlib
 import shutil
+import uuid
+import contextlib
+import io
+import decimal
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 from urllib.parse import urlparse
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+import pyarrow as pa
 import uvicorn
-from typing import Optional, List, Dict
+from typing import Any, Optional, List, Dict, Tuple
 import logging
 import pathlib
 import re
+import json
+import glob
+import fnmatch
+import threading
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from s3_download import download_object
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +45,39 @@ logging.getLogger('s3transfer').setLevel(logging.WARNING)
 # Enable DuckDB query logging
 logging.getLogger('duckdb').setLevel(logging.DEBUG)
 
+# W3C trace context header sent by the router: version-trace_id-parent_span_id-flags
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+MAX_TRACES = 100  # Traces of recent queries kept for /traces/{trace_id}
+# Literals bound as query parameters: strings anywhere; numbers in IN-lists, as BETWEEN bounds and
+# where compared with something, so LIMIT counts, ORDER BY positions and type arguments stay constants.
+# Typed date and time literals become casts of a parameter; intervals stay constants
+SQL_STRING = r"'(?:[^']|'')*'"
+SQL_NUMBER = r"(?<![\w.])(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?![\w.])"
+SQL_LITERAL = rf"(?:{SQL_STRING}|-?\s*{SQL_NUMBER})"
+LITERAL_PATTERN = re.compile(rf"""
+    (?P<skip>"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|\bINTERVAL\s+{SQL_STRING})
+    |\b(?P<type>DATE|TIMESTAMPTZ|TIMESTAMP|TIME)\s+(?P<typed>{SQL_STRING})
+    |\bIN\s*\(\s*{SQL_LITERAL}(?:\s*,\s*{SQL_LITERAL})*\s*\)
+    |\bBETWEEN\s+-?\s*{SQL_NUMBER}\s+AND\s+-?\s*{SQL_NUMBER}
+    |(?:<>|!=|<=|>=|=|<|>)\s*-?\s*{SQL_NUMBER}
+    |{SQL_STRING}
+    """, re.VERBOSE | re.IGNORECASE | re.DOTALL)
+LITERAL_ITEM_PATTERN = re.compile(rf"{SQL_STRING}|{SQL_NUMBER}")
+CACHE_DIR = '/data/cache'
+STORAGE_FORMATS = ('duckdb', 'parquet', 'csv')  # How the cached file is queried; csv reads the gzip directly
+STORAGE_EXTENSIONS = {'duckdb': 'duckdb', 'parquet': 'parquet', 'csv': 'csv.gz'}  # Of each version's copy
+HISTOGRAM_BUCKETS = 16  # Equi-depth buckets of the per-column histograms
+# Column types with a meaningful order for min/max and histograms
+HISTOGRAM_TYPE_PATTERN = re.compile(r'^(U?(TINY|SMALL|BIG|HUGE)?INT(EGER)?|FLOAT|DOUBLE|REAL|DECIMAL.*|DATE|TIMESTAMP.*|TIME)$')
+# A multi-file dataset is partitioned by the date in each object's filename, e.g. best_amer.out.20250504.csv.gz
+PARTITION_COLUMN = 'effective_date'
+FILENAME_DATE_PATTERN = re.compile(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)')
+# Media types /query streams its results as instead of a JSON document
+STREAM_MEDIA_TYPES = {
+    'application/x-ndjson': 'ndjson',
+    'application/vnd.apache.arrow.stream': 'arrow'
+}
+
 class QueryRequest(BaseModel):
     query: str
 
@@ -51,6 +100,56 @@ class DatasetMetadata(BaseModel):
     local_cache_path: Optional[str] = None
     last_modified: Optional[str] = None
     cache_status: Optional[str] = None
+    data_version: Optional[str] = None
+    storage_format: Optional[str] = None
+    storage_path: Optional[str] = None
+    last_checked: Optional[str] = None
+    refresh_error: Optional[str] = None
+    file_count: Optional[int] = None  # Objects of a multi-file dataset
+    index_columns: List[str] = []  # Lookup columns the data is sorted and indexed on
+
+class ColumnStatistics(BaseModel):
+    name: str
+    type: str
+    min: Optional[Any] = None
+    max: Optional[Any] = None
+    null_count: int
+    distinct_count: int  # Approximate (HyperLogLog)
+    histogram: Optional[List[Any]] = None  # Equi-depth bucket boundaries, from min to max
+
+class TableStatistics(BaseModel):
+    table_name: str
+    data_version: Optional[str] = None
+    row_count: int
+    columns: List[ColumnStatistics]
+    computed_at: str
+    compute_time_ms: float
+
+class StatementCacheStats(BaseModel):
+    queries: int
+    cached_statements: int
+    max_cached_statements: int
+    parses: int  # Statements parsed (cache misses)
+    binds: int  # Runs of a cached parsed statement with the query's literals bound; each is planned anew
+    evictions: int
+    uncached: int  # Queries that could not be cached and were parsed on every run
+
+class DataVersion(BaseModel):
+    table_name: str
+    version: Optional[str] = None
+    last_modified: Optional[str] = None
+    cache_status: Optional[str] = None
+
+class HealthStatus(BaseModel):
+    status: str  # starting, caching, converting, statistics, warming, ready or failed
+    ready: bool
+    table_name: Optional[str] = None
+    data_version: Optional[str] = None
+    cache_status: Optional[str] = None
+    warmup_queries: int = 0
+    warmup_errors: int = 0  # Warm-up queries that failed; they do not keep the node from becoming ready
+    warmup_time_ms: Optional[float] = None
+    error: Optional[str] = None
 
 # Global variables for DuckDB connection and view name
 conn = None
@@ -60,6 +159,380 @@ load_time_ms = None
 local_cache_path = None
 last_modified = None
 cache_status = None
+data_version = None  # Token that changes whenever the served data changes
+storage_format = 'duckdb'
+storage_path = None  # Columnar copy of the cached file that queries run against
+s3_client = None
+last_checked = None  # When S3 was last asked whether the object changed
+refresh_error = None  # Why the last refresh failed, if it did
+table_statistics = None  # Statistics of the served data version
+dataset_paths = None  # Partition files of a multi-file dataset, None when serving a single object
+cursor_pool = None  # Cursors of the current connection that queries run on
+query_executor = None  # Worker threads that run queries off the event loop
+statement_cache_size = 256  # Per cursor
+query_workers = 4
+query_timeout = 120.0  # Seconds before a query is interrupted (0 for no limit)
+queue_timeout = 30.0  # Seconds a query waits for a free cursor before it is turned away (0 for no limit)
+stream_batch_rows = 10000  # Rows per record batch of streamed results
+index_columns = []  # Lookup columns the converted data is sorted on and, in DuckDB storage, indexed on
+duckdb_threads = None
+duckdb_memory_limit = None
+startup_phase = 'starting'  # What the node is doing before it can serve: caching, converting, statistics, warming
+startup_error = None  # Why setting up the data failed, if it did
+warmup_queries = []  # Run on every cursor before the node reports ready, and on each refreshed version before the swap
+warmup_errors = 0
+warmup_time_ms = None
+download_concurrency = 8  # Ranged GETs in flight when downloading the file
+download_part_size = 16 * 1024 * 1024
+recent_traces = OrderedDict()  # Trace ID -> spans recorded on this node
+
+class StatementCache:
+    """LRU cache of parsed statements on one connection, keyed by the parameterized SQL.
+    
+    Queries of the same shape with different literals are parsed once; every run binds its
+    literals as typed parameters, so it is planned with their values and still prunes
+    partitions, zone maps and indexes on them. A refresh that swaps the connection starts a
+    new cache.
+    """
+    def __init__(self, connection: duckdb.DuckDBPyConnection, max_size: int):
+        self.connection = connection
+        self.max_size = max_size
+        self.statements = OrderedDict()  # Parameterized SQL -> parsed statement
+        self.queries = 0
+        self.parses = 0
+        self.binds = 0
+        self.evictions = 0
+        self.uncached = 0
+    
+    def execute(self, query: str, params: List) -> duckdb.DuckDBPyConnection:
+        self.queries += 1
+        statement = self.statements.get(query)
+        if statement is None:
+            try:
+                statements = self.connection.extract_statements(query)
+            except duckdb.Error:
+                statements = []
+            if not statements:
+                # A syntax error or no statement at all: run it as is, which reports the error
+                self.uncached += 1
+                return self.connection.execute(query, params)
+            if len(statements) > 1 or not self.max_size:
+                # DuckDB binds parameters to the last of several statements only; run each with its own
+                self.uncached += 1
+                for statement in statements:
+                    count = len(statement.named_parameters)
+                    result = self.connection.execute(statement, params[:count])
+                    params = params[count:]
+                return result
+            statement = statements[0]
+            self.parses += 1
+            self.statements[query] = statement
+            if len(self.statements) > self.max_size:
+                self.statements.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.statements.move_to_end(query)
+        
+        self.binds += 1
+        return self.connection.execute(statement, params)
+    
+    def stats(self) -> StatementCacheStats:
+        return StatementCacheStats(
+            queries=self.queries,
+            cached_statements=len(self.statements),
+            max_cached_statements=self.max_size,
+            parses=self.parses,
+            binds=self.binds,
+            evictions=self.evictions,
+            uncached=self.uncached
+        )
+
+class PoolExhaustedError(Exception):
+    """No cursor of the pool became free within the queue timeout."""
+
+class CursorPool:
+    """Cursors of one connection, each with its own statement cache, lent to one query at a
+    time. A refresh that swaps the connection creates a new pool; queries running on the old
+    one keep their cursor until they finish.
+    """
+    def __init__(self, connection: duckdb.DuckDBPyConnection, size: int, statement_cache_size: int):
+        self.connection = connection
+        self.caches = [StatementCache(connection.cursor(), statement_cache_size) for _ in range(size)]
+        self.idle = queue.Queue()
+        for cache in self.caches:
+            self.idle.put(cache)
+        self.waiters = deque()  # (loop, future) of requests waiting for a cursor
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> StatementCache:
+        """Borrow a cursor with its statement cache, blocking while all of them are lent."""
+        return self.idle.get()
+    
+    async def lease(self) -> StatementCache:
+        """Borrow a cursor with its statement cache, waiting on the event loop rather than in a
+        worker thread while all of them are lent.
+        """
+        with self.lock:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            self.waiters.append((loop, waiter))
+        return await waiter
+    
+    def release(self, cache: StatementCache) -> None:
+        """Return a cursor, handing it to the longest waiting request if there is one."""
+        with self.lock:
+            if not self.waiters:
+                self.idle.put(cache)
+                return
+            loop, waiter = self.waiters.popleft()
+        loop.call_soon_threadsafe(self._hand_over, waiter, cache)
+    
+    def _hand_over(self, waiter: asyncio.Future, cache: StatementCache) -> None:
+        if waiter.done():
+            # The request gave up waiting
+            self.release(cache)
+        else:
+            waiter.set_result(cache)
+    
+    @contextlib.contextmanager
+    def cursor(self):
+        """Borrow a cursor with its statement cache for one query."""
+        cache = self.acquire()
+        try:
+            yield cache
+        finally:
+            self.release(cache)
+    
+    def stats(self) -> StatementCacheStats:
+        """Statement cache counters summed over the pool's cursors."""
+        stats = [cache.stats() for cache in self.caches]
+        return StatementCacheStats(**{
+            field: sum(getattr(cache_stats, field) for cache_stats in stats)
+            for field in StatementCacheStats.model_fields
+        })
+
+class ResultStream:
+    """A query result read one record batch at a time from a pooled cursor, which counts against
+    the pool's bound until the stream is closed. A batch still being read when the stream is
+    closed, e.g. by an interrupted request, returns the cursor once it has stopped.
+    """
+    def __init__(self, pool: CursorPool, cache: StatementCache, reader: pa.RecordBatchReader):
+        self.pool = pool
+        self.cache = cache
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.reading = False
+        self.closed = False
+    
+    def read(self, writer, sink: io.BytesIO) -> Optional[Tuple[bytes, int]]:
+        """Read and encode the next batch in a worker thread; see read_chunk."""
+        with self.lock:
+            if self.closed:
+                return None
+            self.reading = True
+        try:
+            return read_chunk(self.reader, writer, sink)
+        finally:
+            with self.lock:
+                self.reading = False
+                release = self.closed
+            if release:
+                self.pool.release(self.cache)
+    
+    def close(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            release = not self.reading
+        if release:
+            self.pool.release(self.cache)
+    
+    def __del__(self):
+        # A response dropped before it started streaming never runs stream_results' cleanup
+        self.close()
+
+async def run_on_pooled_cursor(pool: CursorPool, work, timeout: Optional[float], keep: bool = False):
+    """Run work on a cursor of the pool in a worker thread and return its result.
+    
+    The event loop stays free for other requests meanwhile, and waiting for a cursor holds no
+    worker, so requests waiting for one cannot starve the streams holding them. Waiting longer
+    than the queue timeout raises PoolExhaustedError; the timeout of the work starts once it
+    has a cursor. The cursor goes back to the pool when the work is done, unless keep is true
+    and the work returns a ResultStream that takes it over. Work that exceeds the timeout, or
+    whose request is cancelled, is interrupted so it releases its worker.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        cache = await asyncio.wait_for(pool.lease(), queue_timeout or None)
+    except asyncio.TimeoutError:
+        raise PoolExhaustedError(f"All {len(pool.caches)} query workers stayed busy for {queue_timeout:g}s")
+    deadline = loop.time() + timeout if timeout else None
+    cancelled = threading.Event()
+    
+    def run():
+        if cancelled.is_set():
+            raise duckdb.InterruptException("Query cancelled before it started")
+        return work(cache)
+    
+    def done(future):
+        # The outcome of interrupted work is not awaited; retrieving it keeps it from being logged as lost
+        if not keep or future.cancelled() or future.exception() is not None:
+            pool.release(cache)
+        elif cancelled.is_set():
+            future.result().close()
+    
+    future = loop.run_in_executor(query_executor, run)
+    future.add_done_callback(done)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), deadline - loop.time() if deadline else None)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        cancelled.set()
+        if not future.done():
+            cache.connection.interrupt()
+        elif keep and not future.cancelled() and future.exception() is None:
+            # Nobody is left to read the stream
+            future.result().close()
+        raise
+
+async def run_query(query: str, params: List, timeout: Optional[float]):
+    """Run a parameterized query on a pooled cursor in a worker thread and fetch it as a DataFrame."""
+    return await run_on_pooled_cursor(cursor_pool, lambda cache: cache.execute(query, params).fetchdf(), timeout)
+
+async def run_on_cursor(cursor: duckdb.DuckDBPyConnection, work, timeout: Optional[float]):
+    """Run work that uses a cursor in a worker thread, interrupting the cursor if it exceeds
+    the timeout or the request is cancelled.
+    """
+    future = asyncio.get_running_loop().run_in_executor(query_executor, work)
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout or None)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        cursor.interrupt()
+        raise
+
+async def open_result_stream(query: str, params: List, timeout: Optional[float]) -> ResultStream:
+    """Run a parameterized query on a pooled cursor and return a stream over its result."""
+    pool = cursor_pool
+    
+    def run(cache: StatementCache) -> ResultStream:
+        return ResultStream(pool, cache, cache.execute(query, params).fetch_record_batch(stream_batch_rows))
+    
+    return await run_on_pooled_cursor(pool, run, timeout, keep=True)
+
+def read_chunk(reader: pa.RecordBatchReader, writer, sink: io.BytesIO) -> Optional[Tuple[bytes, int]]:
+    """Pull the next record batch and encode it. Returns None at the end of the result."""
+    try:
+        batch = reader.read_next_batch()
+    except StopIteration:
+        return None
+    
+    if writer:
+        writer.write_batch(batch)
+        chunk = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    else:
+        chunk = ''.join(json.dumps(row, default=str) + '\n' for row in batch.to_pylist()).encode()
+    return chunk, batch.num_rows
+
+async def stream_results(stream: ResultStream, stream_format: str, trace: 'RequestTrace', query: str,
+                         start_time: float):
+    """Encode a result one record batch at a time as NDJSON or an Arrow IPC stream.
+    Each batch is pulled in a worker thread, so a slow client holds no worker between batches.
+    The stream is closed when it ends, fails or the client goes away.
+    """
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, stream.reader.schema) if stream_format == 'arrow' else None
+    rows_sent = 0
+    bytes_sent = 0
+    try:
+        while True:
+            chunk = await run_on_cursor(stream.cache.connection, lambda: stream.read(writer, sink), query_timeout)
+            if chunk is None:
+                break
+            rows_sent += chunk[1]
+            bytes_sent += len(chunk[0])
+            yield chunk[0]
+    
+        if writer:
+            writer.close()
+            bytes_sent += len(sink.getvalue())
+            yield sink.getvalue()
+    except Exception as e:
+        # Too late for an error status; the client sees the stream end early
+        logger.error(f"Error streaming query results: {str(e)}")
+        trace.finish('node_query', status='error', query=query, error=str(e), streamed=True)
+        raise
+    finally:
+        stream.close()
+    
+    execution_time = (time.time() - start_time) * 1000
+    print(f"\nQuery Stream Stats:")
+    print(f"  Execution time: {execution_time:.2f}ms")
+    print(f"  Rows streamed: {rows_sent:,} as {stream_format} ({bytes_sent / 1024 / 1024:.2f} MB)")
+    trace.finish('node_query', query=query, rows=rows_sent, streamed=True)
+
+class RequestTrace:
+    """Spans of one request, recorded as children of the caller's span when the request
+    carries a traceparent header so they join the router's trace.
+    """
+    def __init__(self, traceparent: Optional[str]):
+        match = TRACEPARENT_PATTERN.match(traceparent or '')
+        self.trace_id, self.parent_id = match.groups() if match else (uuid.uuid4().hex, None)
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start_time = time.time()
+        self.spans = []
+    
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time a block as a child of the request's span; yields its attributes to fill in."""
+        start_time = time.time()
+        try:
+            yield attributes
+        finally:
+            self.spans.append({
+                'name': name,
+                'trace_id': self.trace_id,
+                'span_id': uuid.uuid4().hex[:16],
+                'parent_id': self.span_id,
+                'start_time': datetime.fromtimestamp(start_time).isoformat(),
+                'duration_ms': (time.time() - start_time) * 1000,
+                'attributes': attributes
+            })
+    
+    def finish(self, name: str, status: str = 'ok', **attributes) -> None:
+        """Record the request's own span and keep the trace for /traces."""
+        duration_ms = (time.time() - self.start_time) * 1000
+        self.spans.insert(0, {
+            'name': name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': datetime.fromtimestamp(self.start_time).isoformat(),
+            'duration_ms': duration_ms,
+            'status': status,
+            'attributes': {'table': view_name, **attributes}
+        })
+        recent_traces.setdefault(self.trace_id, []).extend(self.spans)
+        recent_traces.move_to_end(self.trace_id)
+        while len(recent_traces) > MAX_TRACES:
+            recent_traces.popitem(last=False)
+        logger.info(f"Trace {self.trace_id} span {self.span_id} ({name}): {duration_ms:.2f}ms, {status}")
+
+def negotiate_stream_format(accept: Optional[str]) -> Optional[str]:
+    """Return the streaming format requested by an Accept header, or None for JSON."""
+    for media_type in (accept or '').split(','):
+        media_type = media_type.split(';')[0].strip().lower()
+        if media_type == 'application/json':
+            return None
+        if media_type in STREAM_MEDIA_TYPES:
+            return STREAM_MEDIA_TYPES[media_type]
+    return None
 
 def parse_s3_url(s3_url):
     """Parse S3 URL into bucket and key."""
@@ -71,33 +544,94 @@ def parse_s3_url(s3_url):
     return bucket, key
 
 def get_dataset_metadata() -> DatasetMetadata:
-    """Get metadata about the dataset."""
+    """Get metadata about the dataset from its precomputed statistics."""
+    statistics = table_statistics
+    if statistics is None:
+        raise HTTPException(status_code=503, detail="Table statistics not computed yet")
+    return DatasetMetadata(
+        s3_url=s3_url,
+        view_name=view_name,
+        columns=[ColumnMetadata(name=column.name, type=column.type) for column in statistics.columns],
+        row_count=statistics.row_count,
+        column_count=len(statistics.columns),
+        local_cache_path=local_cache_path,
+        last_modified=last_modified,
+        cache_status=cache_status,
+        data_version=statistics.data_version,
+        storage_format=storage_format,
+        storage_path=storage_path,
+        last_checked=last_checked,
+        refresh_error=refresh_error,
+        file_count=len(dataset_paths) if dataset_paths is not None else None,
+        index_columns=index_columns if storage_format != 'csv' else []
+    )
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def json_value(value):
+    """Represent a DuckDB value in JSON; dates, decimals and the like become strings."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+def compute_table_statistics(connection: duckdb.DuckDBPyConnection, table_name: str, version: str) -> TableStatistics:
+    """Compute row count and per-column statistics of a table in a single scan."""
+    start_time = time.time()
+    columns = connection.execute(f"DESCRIBE {table_name}").fetchall()
+    
+    aggregates = ["COUNT(*)"]
+    for name, column_type, *_ in columns:
+        quoted = quote_identifier(name)
+        aggregates += [f"COUNT(*) - COUNT({quoted})", f"approx_count_distinct({quoted})"]
+        if HISTOGRAM_TYPE_PATTERN.match(column_type) or column_type in ('VARCHAR', 'BOOLEAN'):
+            aggregates += [f"MIN({quoted})", f"MAX({quoted})"]
+        if HISTOGRAM_TYPE_PATTERN.match(column_type):
+            quantiles = ', '.join(str(i / HISTOGRAM_BUCKETS) for i in range(1, HISTOGRAM_BUCKETS))
+            aggregates.append(f"approx_quantile({quoted}, [{quantiles}])")
+    values = iter(connection.execute(f"SELECT {', '.join(aggregates)} FROM {table_name}").fetchone())
+    
+    row_count = next(values)
+    column_statistics = []
+    for name, column_type, *_ in columns:
+        statistics = ColumnStatistics(name=name, type=column_type, null_count=next(values), distinct_count=next(values))
+        if HISTOGRAM_TYPE_PATTERN.match(column_type) or column_type in ('VARCHAR', 'BOOLEAN'):
+            statistics.min, statistics.max = json_value(next(values)), json_value(next(values))
+        if HISTOGRAM_TYPE_PATTERN.match(column_type):
+            quantiles = next(values)
+            if quantiles is not None:
+                statistics.histogram = [statistics.min] + [json_value(value) for value in quantiles] + [statistics.max]
+        column_statistics.append(statistics)
+    
+    compute_time_ms = (time.time() - start_time) * 1000
+    print(f"Computed statistics of {table_name} ({row_count:,} rows, {len(columns)} columns) in {compute_time_ms:.2f}ms")
+    return TableStatistics(
+        table_name=table_name,
+        data_version=version,
+        row_count=row_count,
+        columns=column_statistics,
+        computed_at=datetime.now(timezone.utc).isoformat(),
+        compute_time_ms=compute_time_ms
+    )
+
+def load_table_statistics(connection: duckdb.DuckDBPyConnection, table_name: str, version: str) -> TableStatistics:
+    """Statistics of a data version, read from the cache directory if they were computed before."""
+    path = f"{local_cache_path}.stats.json"
     try:
-        # Get column information without loading all data
-        column_info = conn.execute(f"DESCRIBE {view_name}").fetchdf()
-        
-        # Get row count using a count query
-        row_count = conn.execute(f"SELECT COUNT(*) as count FROM {view_name}").fetchone()[0]
-        
-        # Create column metadata
-        columns = [
-            ColumnMetadata(name=row["column_name"], type=row["column_type"])
-            for _, row in column_info.iterrows()
-        ]
-        
-        return DatasetMetadata(
-            s3_url=s3_url,
-            view_name=view_name,
-            columns=columns,
-            row_count=row_count,
-            column_count=len(columns),
-            local_cache_path=local_cache_path,
-            last_modified=last_modified,
-            cache_status=cache_status
-        )
-    except Exception as e:
-        logger.error(f"Error getting metadata: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        with open(path) as f:
+            statistics = TableStatistics.model_validate_json(f.read())
+        if statistics.data_version == version and statistics.table_name == table_name:
+            logger.info(f"Using cached statistics: {path}")
+            return statistics
+    except (OSError, ValueError) as e:
+        logger.debug(f"No usable cached statistics at {path}: {str(e)}")
+    
+    statistics = compute_table_statistics(connection, table_name, version)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(statistics.model_dump_json())
+    os.replace(tmp_path, path)
+    return statistics
 
 def get_s3_file_metadata(bucket: str, key: str, s3_client) -> Dict:
     """Get metadata about an S3 file using HEAD operation."""
@@ -112,26 +646,550 @@ def get_s3_file_metadata(bucket: str, key: str, s3_client) -> Dict:
         logger.error(f"Error getting S3 file metadata: {str(e)}")
         return None
 
-def download_s3_file(bucket: str, key: str, local_path: str, s3_client) -> bool:
-    """Download a file from S3 to a local path."""
-    try:
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        
-        # Download the file
-        logger.info(f"Downloading S3 file s3://{bucket}/{key} to {local_path}")
-        s3_client.download_file(bucket, key, local_path)
+def get_cache_file_version(path: str) -> Dict:
+    """Derive a version token for a cached file from its size and modification time."""
+    stat = os.stat(path)
+    return {
+        'last_modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+        'version': f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    }
+
+def cache_matches(path: str, cached_metadata: Optional[Dict], s3_metadata: Dict) -> bool:
+    """Whether a cached file is the current version of the S3 object, by ETag and size.
+    A cached file without saved metadata (from an older release) is matched by size alone.
+    """
+    if os.path.getsize(path) != s3_metadata['size']:
+        return False
+    if cached_metadata is None:
         return True
+    return cached_metadata.get('etag') == s3_metadata['etag']
+
+def read_cache_file_metadata(path: str) -> Optional[Dict]:
+    """Load the S3 metadata saved next to a cached file when it was downloaded."""
+    try:
+        with open(f"{path}.meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cache_file_metadata(path: str, metadata: Dict) -> None:
+    with open(f"{path}.meta.json", 'w') as f:
+        json.dump(metadata, f)
+
+def csv_reader(path: str) -> str:
+    """DuckDB table function reading a cached gzipped CSV file."""
+    escaped_path = path.replace("'", "''")
+    return f"""read_csv_auto('{escaped_path}',
+            compression='gzip',
+            auto_detect=true,
+            header=true,
+            sample_size=-1,
+            quote='"',
+            escape='"'
+        )"""
+
+def converted_path(csv_path: str, version: str, fmt: str) -> str:
+    """Path of the converted copy of a version of a cached CSV. Copies laid out for other
+    lookup columns have other paths, so changing --index-column converts the file again.
+    """
+    extension = STORAGE_EXTENSIONS[fmt]
+    safe_version = re.sub(r'[^0-9A-Za-z_-]', '_', version)
+    if index_columns and fmt != 'csv':
+        safe_version += '.by_' + re.sub(r'[^0-9A-Za-z_-]', '_', '_'.join(index_columns))
+    return f"{csv_path}.{safe_version}.{extension}"
+
+def ingest_cache_file(csv_path: str, table_name: str, version: str, fmt: str, remove_outdated: bool = True) -> str:
+    """Convert a cached gzipped CSV into a DuckDB database or Parquet file keyed by its version.
+    
+    The CSV is decompressed and parsed once; later starts reuse the converted file as long as
+    the version (the S3 ETag) matches. Converted copies of other versions are removed unless
+    remove_outdated is false. Returns the path of the converted file.
+    
+    The rows are sorted on the lookup columns, so the min/max of each block (DuckDB's zone maps,
+    Parquet's row group statistics) lets a lookup on the first of them skip all but a few blocks.
+    A DuckDB database also gets an ART index on each lookup column, which answers equality and
+    IN-list lookups on any of them without a scan.
+    """
+    path = converted_path(csv_path, version, fmt)
+    if os.path.exists(path):
+        logger.info(f"Using converted {fmt} file: {path}")
+        return path
+    
+    start_time = time.time()
+    logger.info(f"Converting {csv_path} to {fmt}: {path}")
+    # Write to a temporary path so an interrupted conversion is never mistaken for a complete one
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    order_by = f" ORDER BY {', '.join(map(quote_identifier, index_columns))}" if index_columns else ''
+    if fmt == 'duckdb':
+        ingest_conn = duckdb.connect(database=tmp_path)
+        try:
+            ingest_conn.execute(f"CREATE TABLE {table_name} AS SELECT * FROM {csv_reader(csv_path)}{order_by}")
+            for column in index_columns:
+                index_name = quote_identifier(f"{table_name}_{column}_idx")
+                ingest_conn.execute(f"CREATE INDEX {index_name} ON {table_name} ({quote_identifier(column)})")
+            ingest_conn.execute("CHECKPOINT")
+        finally:
+            ingest_conn.close()
+    else:
+        escaped_tmp_path = tmp_path.replace("'", "''")
+        duckdb.connect(database=':memory:').execute(
+            f"COPY (SELECT * FROM {csv_reader(csv_path)}{order_by}) TO '{escaped_tmp_path}' (FORMAT PARQUET)"
+        )
+    os.replace(tmp_path, path)
+    
+    # Converted copies of older versions of the file are no longer needed
+    if remove_outdated:
+        remove_outdated_copies(csv_path, {path})
+    layout = f", sorted on {', '.join(index_columns)}" if index_columns else ''
+    print(f"Converted {csv_path} to {fmt}{layout} in {(time.time() - start_time) * 1000:.2f}ms")
+    return path
+
+def snapshot_cache_file(csv_path: str, version: str, remove_outdated: bool = True) -> str:
+    """Hard-link a version of a cached CSV under a name of its own for --storage csv to query.
+    A refresh replaces the cached file with a new one, so the snapshot keeps serving the bytes
+    of its version until the new one is swapped in. Falls back to a copy where links are not
+    supported. Returns the snapshot's path.
+    """
+    path = converted_path(csv_path, version, 'csv')
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(csv_path, tmp_path)
+        except OSError:
+            shutil.copyfile(csv_path, tmp_path)
+        os.replace(tmp_path, path)
+    if remove_outdated:
+        remove_outdated_copies(csv_path, {path})
+    return path
+
+def remove_outdated_copies(csv_path: str, keep: set) -> None:
+    """Remove the converted copies and snapshots of a cached CSV other than those in keep."""
+    for extension in set(STORAGE_EXTENSIONS.values()):
+        for old_path in glob.glob(f"{glob.escape(csv_path)}.*.{extension}"):
+            if old_path not in keep:
+                logger.info(f"Removing outdated converted file: {old_path}")
+                os.remove(old_path)
+
+def download_s3_file(bucket: str, key: str, local_path: str, s3_client) -> None:
+    """Download a file from S3 to a local path with parallel ranged GETs, replacing an existing
+    copy only once complete and verified. An interrupted download resumes on the next attempt.
+    """
+    # Create directory if it doesn't exist
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    
+    # Download the file
+    logger.info(f"Downloading S3 file s3://{bucket}/{key} to {local_path}")
+    download_object(s3_client, bucket, key, local_path, download_part_size, download_concurrency)
+
+def connect_duckdb() -> duckdb.DuckDBPyConnection:
+    """Open an in-memory connection with the configured threads and memory limit."""
+    connection = duckdb.connect(database=':memory:')
+    
+    # Enable query logging and progress bar
+    connection.execute("SET enable_progress_bar=true")
+    if duckdb_threads:
+        connection.execute(f"SET threads={int(duckdb_threads)}")
+    if duckdb_memory_limit:
+        connection.execute("SET memory_limit = ?", [duckdb_memory_limit])
+    return connection
+
+def open_storage(csv_path: str, table_name: str, version: str, fmt: str,
+                 remove_outdated: bool = True) -> Tuple[duckdb.DuckDBPyConnection, str]:
+    """Open a new connection with the table's view over a version of a cached file, converting
+    it first unless it is queried as CSV. Copies of other versions are removed unless
+    remove_outdated is false. Returns the connection and the path queries read.
+    """
+    connection = connect_duckdb()
+    
+    if fmt == 'csv':
+        # Create a view that will lazily load the data from this version's snapshot only
+        path = snapshot_cache_file(csv_path, version, remove_outdated)
+        logger.info(f"Creating lazy-loaded view from local cache: {path}")
+        if index_columns:
+            logger.warning("Lookup columns are neither sorted nor indexed with --storage csv")
+        connection.execute(f"CREATE VIEW {table_name} AS SELECT * FROM {csv_reader(path)}")
+        return connection, path
+    
+    # Query a columnar copy with zone maps and parallel scans instead of re-parsing the gzip
+    path = ingest_cache_file(csv_path, table_name, version, fmt, remove_outdated)
+    escaped_path = path.replace("'", "''")
+    logger.info(f"Creating view over {fmt} file: {path}")
+    if fmt == 'duckdb':
+        connection.execute(f"ATTACH '{escaped_path}' AS storage (READ_ONLY)")
+        connection.execute(f"CREATE VIEW {table_name} AS SELECT * FROM storage.{table_name}")
+    else:
+        connection.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{escaped_path}')")
+    return connection, path
+
+def is_dataset_key(key: str) -> bool:
+    """Whether an S3 key is a prefix (ending in /) or glob matching several objects."""
+    return key == '' or key.endswith('/') or any(char in key for char in '*?[')
+
+def list_dataset_objects(bucket: str, pattern: str, s3_client) -> List[Dict]:
+    """List the objects under a prefix or matching a glob, with the date in each filename.
+    Objects without a date in their filename are skipped.
+    """
+    wildcard = re.search(r'[*?\[]', pattern)
+    prefix = pattern[:wildcard.start()] if wildcard else pattern
+    objects = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            key = item['Key']
+            if key.endswith('/') or (wildcard and not fnmatch.fnmatchcase(key, pattern)):
+                continue
+            match = FILENAME_DATE_PATTERN.search(key.split('/')[-1])
+            if not match:
+                logger.warning(f"Skipping s3://{bucket}/{key}: no date in its filename")
+                continue
+            objects.append({
+                'key': key,
+                'etag': item.get('ETag', '').strip('"'),
+                'size': item['Size'],
+                'last_modified': item['LastModified'].isoformat(),
+                'effective_date': '-'.join(match.groups())
+            })
+    return sorted(objects, key=lambda obj: obj['key'])
+
+def dataset_download_path(obj: Dict) -> str:
+    """Where an object of the dataset is downloaded, in a hive-style partition of its date."""
+    partition = os.path.join(local_cache_path, f"{PARTITION_COLUMN}={obj['effective_date']}")
+    return os.path.join(partition, obj['key'].split('/')[-1])
+
+def dataset_file_path(obj: Dict) -> str:
+    """The Parquet file an object of the dataset is queried from."""
+    return converted_path(dataset_download_path(obj), obj['etag'], 'parquet')
+
+def dataset_version(paths: List[str]) -> str:
+    """Version token of a dataset; the cached file names include each object's ETag."""
+    return hashlib.sha1('\n'.join(sorted(paths)).encode()).hexdigest()[:16]
+
+def sync_dataset(bucket: str, objects: List[Dict], table_name: str) -> Tuple[List[str], int]:
+    """Download and convert to Parquet the objects not cached yet. Only the Parquet file of each
+    object is kept. Returns the paths of all the dataset's files and how many were downloaded.
+    """
+    paths = []
+    downloaded = 0
+    for obj in objects:
+        path = dataset_file_path(obj)
+        if not os.path.exists(path):
+            csv_path = dataset_download_path(obj)
+            download_s3_file(bucket, obj['key'], csv_path, s3_client)
+            # The previous version stays until no query can be reading it; see prune_dataset_files
+            ingest_cache_file(csv_path, table_name, obj['etag'], 'parquet', remove_outdated=False)
+            os.remove(csv_path)
+            downloaded += 1
+        paths.append(path)
+    return paths, downloaded
+
+def read_dataset_manifest() -> Optional[Dict]:
+    """Load the files and last modification time of the dataset version served last."""
+    try:
+        with open(f"{local_cache_path}.manifest.json") as f:
+            manifest = json.load(f)
+        manifest['paths'] = [os.path.join(local_cache_path, path) for path in manifest['paths']]
+        return manifest
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_dataset_manifest(paths: List[str], modified: Optional[str]) -> None:
+    """Save the files of the served version, which can be told apart from outdated ones
+    still on disk only this way.
+    """
+    manifest = {'paths': [os.path.relpath(path, local_cache_path) for path in paths], 'last_modified': modified}
+    tmp_path = f"{local_cache_path}.manifest.json.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, f"{local_cache_path}.manifest.json")
+
+def prune_dataset_files(keep: set) -> None:
+    """Remove cached files of objects that are no longer part of the dataset, or changed."""
+    for path in glob.glob(os.path.join(glob.escape(local_cache_path), '*', '*.parquet')):
+        if path not in keep:
+            logger.info(f"Removing outdated dataset file: {path}")
+            os.remove(path)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(path))
+
+def open_dataset(paths: List[str], table_name: str) -> duckdb.DuckDBPyConnection:
+    """Open a new connection with the table's view over a dataset's Parquet files.
+    
+    The partition column is read from the directory names, so DuckDB skips the files
+    whose date cannot match a query's predicates on it.
+    """
+    if not paths:
+        raise ValueError(f"No objects with a date in their filename match {s3_url}")
+    connection = connect_duckdb()
+    files = ', '.join("'" + path.replace("'", "''") + "'" for path in paths)
+    logger.info(f"Creating view over {len(paths)} partitioned Parquet files in {local_cache_path}")
+    connection.execute(f"""CREATE VIEW {table_name} AS SELECT * FROM read_parquet([{files}],
+            hive_partitioning=true,
+            hive_types={{'{PARTITION_COLUMN}': DATE}},
+            union_by_name=true
+        )""")
+    return connection
+
+def warm_up(pool: CursorPool) -> None:
+    """Run the warm-up queries on every cursor of a pool, so the data has been read from disk and
+    each cursor has their statements parsed before real queries arrive. A failing warm-up query
+    is logged and skipped.
+    """
+    global warmup_errors, warmup_time_ms
+    
+    start_time = time.time()
+    errors = 0
+    for warmup_query in warmup_queries:
+        query, params = extract_literals(warmup_query)
+        try:
+            for _ in pool.caches:
+                with pool.cursor() as cache:
+                    cache.execute(query, params).fetchall()
+        except duckdb.Error as e:
+            logger.warning(f"Warm-up query failed: {warmup_query}: {str(e)}")
+            errors += 1
+    warmup_errors = errors
+    warmup_time_ms = (time.time() - start_time) * 1000
+    if warmup_queries:
+        print(f"Ran {len(warmup_queries)} warm-up queries on {len(pool.caches)} cursors in {warmup_time_ms:.2f}ms "
+              f"({errors} failed)")
+
+def publish_version(new_pool: CursorPool, new_storage_path: str, new_statistics: TableStatistics,
+                    modified: str, version: str) -> None:
+    """Swap in a refreshed connection. Queries already running finish on the connection they started
+    with; new ones see the new data. The connection is swapped before the version so a version is
+    never reported ahead of its data.
+    """
+    global conn, storage_path, table_statistics, cursor_pool, last_modified, data_version, cache_status, refresh_error
+    
+    conn, storage_path, table_statistics = new_pool.connection, new_storage_path, new_statistics
+    cursor_pool = new_pool
+    last_modified = modified
+    data_version = version
+    cache_status = "REFRESHED"
+    refresh_error = None
+
+def refresh_dataset() -> bool:
+    """Check whether objects of a multi-file dataset were added, changed or removed and, if so,
+    fetch the new ones and swap in the new set of files. Returns whether the served data changed.
+    """
+    global dataset_paths, last_checked, refresh_error
+    
+    bucket, pattern = parse_s3_url(s3_url)
+    try:
+        objects = list_dataset_objects(bucket, pattern, s3_client)
+    except Exception as e:
+        logger.error(f"Error listing {s3_url}: {str(e)}")
+        last_checked = datetime.now(timezone.utc).isoformat()
+        refresh_error = str(e)
+        return False
+    last_checked = datetime.now(timezone.utc).isoformat()
+    version = dataset_version([dataset_file_path(obj) for obj in objects])
+    if version == data_version:
+        refresh_error = None
+        return False
+    
+    logger.info(f"Objects matching {s3_url} changed, refreshing")
+    start_time = time.time()
+    try:
+        paths, downloaded = sync_dataset(bucket, objects, view_name)
+        new_conn = open_dataset(paths, view_name)
+        new_statistics = load_table_statistics(new_conn, view_name, version)
+        new_pool = CursorPool(new_conn, query_workers, statement_cache_size)
+        warm_up(new_pool)
+    except Exception as e:
+        logger.error(f"Error refreshing dataset: {str(e)}")
+        refresh_error = str(e)
+        return False
+    
+    previous_paths = dataset_paths or []
+    modified = max(obj['last_modified'] for obj in objects)
+    write_dataset_manifest(paths, modified)
+    dataset_paths = paths
+    publish_version(new_pool, local_cache_path, new_statistics, modified, version)
+    # Queries still running on the previous version may read its files
+    prune_dataset_files(set(paths) | set(previous_paths))
+    print(f"Refreshed {view_name} to version {data_version} ({len(paths)} files, {downloaded} new) "
+          f"in {(time.time() - start_time) * 1000:.2f}ms")
+    return True
+
+def refresh_cache() -> bool:
+    """Check whether the S3 object changed and, if so, download, convert and swap in the new
+    version. Returns whether the served data changed.
+    """
+    global last_checked, refresh_error
+    
+    if dataset_paths is not None:
+        return refresh_dataset()
+    
+    bucket, key = parse_s3_url(s3_url)
+    s3_metadata = get_s3_file_metadata(bucket, key, s3_client)
+    last_checked = datetime.now(timezone.utc).isoformat()
+    if s3_metadata is None:
+        refresh_error = "Could not get S3 object metadata"
+        return False
+    if s3_metadata['etag'] == data_version:
+        refresh_error = None
+        return False
+    
+    logger.info(f"S3 object {s3_url} changed (ETag {data_version} -> {s3_metadata['etag']}), refreshing")
+    start_time = time.time()
+    try:
+        # The download replaces the cached file only once complete; queries keep reading the
+        # current version's own copy, which stays until the next refresh
+        download_s3_file(bucket, key, local_cache_path, s3_client)
+        write_cache_file_metadata(local_cache_path, s3_metadata)
+        new_conn, new_storage_path = open_storage(local_cache_path, view_name, s3_metadata['etag'], storage_format,
+                                                  remove_outdated=False)
+        new_statistics = load_table_statistics(new_conn, view_name, s3_metadata['etag'])
+        new_pool = CursorPool(new_conn, query_workers, statement_cache_size)
+        warm_up(new_pool)
     except Exception as e:
-        logger.error(f"Error downloading S3 file: {str(e)}")
+        logger.error(f"Error refreshing cached file: {str(e)}")
+        refresh_error = str(e)
         return False
+    
+    previous_storage_path = storage_path
+    publish_version(new_pool, new_storage_path, new_statistics, s3_metadata['last_modified'], s3_metadata['etag'])
+    # Queries still running on the previous version may read its copy
+    remove_outdated_copies(local_cache_path, {new_storage_path, previous_storage_path})
+    print(f"Refreshed {view_name} to version {data_version} in {(time.time() - start_time) * 1000:.2f}ms")
+    return True
+
+def start_cache_refresher(interval: float) -> None:
+    """Check S3 for a new version of the object every interval seconds in a background thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh_cache()
+            except Exception as e:
+                logger.error(f"Error in cache refresher: {str(e)}")
+    
+    threading.Thread(target=run, name='cache-refresher', daemon=True).start()
+    logger.info(f"Checking {s3_url} for changes every {interval:.0f}s")
 
-def setup_duckdb(url: str, table_name: str) -> None:
+def setup_cached_object(bucket: str, key: str, fmt: str, force_download: bool) -> Tuple[duckdb.DuckDBPyConnection, str]:
+    """Validate or download the cached copy of a single object and open the view over it."""
+    global local_cache_path, last_modified, cache_status, data_version, last_checked, startup_phase
+    
+    # Use the original filename from S3
+    filename = key.split('/')[-1]  # Get the last part of the S3 path
+    local_cache_path = os.path.join(CACHE_DIR, filename)
+    
+    # Validate a cached copy against the object's ETag and size
+    s3_metadata = get_s3_file_metadata(bucket, key, s3_client)
+    last_checked = datetime.now(timezone.utc).isoformat()
+    if not os.path.exists(local_cache_path):
+        logger.info(f"No cached file found at: {local_cache_path}")
+        need_download = True
+        cache_status = "MISS"
+    elif force_download:
+        logger.info(f"Forcing download over cached file: {local_cache_path}")
+        need_download = True
+        cache_status = "MISS"
+    elif s3_metadata is None:
+        logger.warning(f"Could not validate cached file against S3, using it as is: {local_cache_path}")
+        need_download = False
+        cache_status = "UNVALIDATED"
+        cached_metadata = read_cache_file_metadata(local_cache_path)
+        if cached_metadata:
+            last_modified = cached_metadata['last_modified']
+            data_version = cached_metadata['etag']
+    elif cache_matches(local_cache_path, read_cache_file_metadata(local_cache_path), s3_metadata):
+        logger.info(f"Using cached file: {local_cache_path}")
+        need_download = False
+        cache_status = "HIT"
+        last_modified = s3_metadata['last_modified']
+        data_version = s3_metadata['etag']
+        write_cache_file_metadata(local_cache_path, s3_metadata)
+    else:
+        logger.info(f"Cached file is out of date (S3 ETag {s3_metadata['etag']}): {local_cache_path}")
+        need_download = True
+        cache_status = "STALE"
+    
+    # Download the file if needed
+    if need_download:
+        try:
+            download_s3_file(bucket, key, local_cache_path, s3_client)
+            cache_status = "DOWNLOADED"
+            if s3_metadata:
+                last_modified = s3_metadata['last_modified']
+                data_version = s3_metadata['etag']
+                write_cache_file_metadata(local_cache_path, s3_metadata)
+        except Exception as e:
+            error_msg = str(e)
+            if '403' in error_msg:
+                raise ValueError(
+                    f"Access denied to S3 object '{key}' in bucket '{bucket}'. "
+                    "Please check your AWS credentials and object permissions. "
+                    f"Error: {error_msg}"
+                )
+            elif '404' in error_msg:
+                raise ValueError(f"S3 object '{key}' not found in bucket '{bucket}'. Please check the object path.")
+            else:
+                raise ValueError(f"Error downloading from S3: {error_msg}")
+    
+    # Without S3 metadata for the cached copy, version it by its size and modification time
+    if data_version is None:
+        file_version = get_cache_file_version(local_cache_path)
+        last_modified = file_version['last_modified']
+        data_version = file_version['version']
+    
+    # Create DuckDB connection
+    startup_phase = 'converting'
+    return open_storage(local_cache_path, view_name, data_version, fmt)
+
+def setup_dataset(bucket: str, pattern: str, force_download: bool) -> Tuple[duckdb.DuckDBPyConnection, str]:
+    """Cache the objects under a prefix or matching a glob and open the view over all of them."""
+    global local_cache_path, last_modified, cache_status, data_version, last_checked, storage_format, dataset_paths
+    
+    local_cache_path = os.path.join(CACHE_DIR, view_name)
+    # Each object is converted to Parquet so the files can be pruned by date
+    storage_format = 'parquet'
+    if force_download and os.path.exists(local_cache_path):
+        logger.info(f"Forcing download over cached dataset: {local_cache_path}")
+        shutil.rmtree(local_cache_path)
+    
+    try:
+        objects = list_dataset_objects(bucket, pattern, s3_client)
+    except Exception as e:
+        logger.warning(f"Could not list {s3_url}, using the cached files as they are: {str(e)}")
+        objects = None
+    last_checked = datetime.now(timezone.utc).isoformat()
+    
+    if objects is None:
+        manifest = read_dataset_manifest()
+        if manifest is None:
+            raise ValueError(f"Could not list {s3_url} and no dataset is cached at {local_cache_path}")
+        dataset_paths = [path for path in manifest['paths'] if os.path.exists(path)]
+        cache_status = "UNVALIDATED"
+        last_modified = manifest['last_modified']
+    else:
+        logger.info(f"{len(objects)} objects match {s3_url}")
+        try:
+            dataset_paths, downloaded = sync_dataset(bucket, objects, view_name)
+        except Exception as e:
+            raise ValueError(f"Error downloading from S3: {str(e)}")
+        prune_dataset_files(set(dataset_paths))
+        cache_status = "DOWNLOADED" if downloaded else "HIT"
+        last_modified = max((obj['last_modified'] for obj in objects), default=None)
+        write_dataset_manifest(dataset_paths, last_modified)
+    data_version = dataset_version(dataset_paths)
+    
+    return open_dataset(dataset_paths, view_name), local_cache_path
+
+def setup_duckdb(url: str, table_name: str, fmt: str = 'duckdb', force_download: bool = False) -> None:
     """Set up DuckDB connection and load data from S3 or local cache"""
-    global conn, view_name, s3_url, load_time_ms, local_cache_path, last_modified, cache_status
+    global conn, view_name, s3_url, load_time_ms, storage_format, storage_path, s3_client, table_statistics
+    global cursor_pool, query_executor, startup_phase
     
+    startup_phase = 'caching'
     s3_url = url
     view_name = table_name
+    storage_format = fmt
     
     start_time = time.time()
     
@@ -166,7 +1224,8 @@ def setup_duckdb(url: str, table_name: str) -> None:
             aws_access_key_id=aws_access_key,
             aws_secret_access_key=aws_secret_key,
             aws_session_token=aws_session_token,
-            region_name=aws_region
+            region_name=aws_region,
+            config=Config(max_pool_connections=max(10, download_concurrency))
         )
         
         # Test S3 access by listing bucket contents
@@ -185,83 +1244,49 @@ def setup_duckdb(url: str, table_name: str) -> None:
             raise ValueError(f"Error accessing S3: {error_msg}")
     
     # Create cache directory
-    cache_dir = os.path.join('/data/cache')
+    cache_dir = CACHE_DIR
     os.makedirs(cache_dir, exist_ok=True)
     
-    # Use the original filename from S3
-    filename = key.split('/')[-1]  # Get the last part of the S3 path
-    local_cache_path = os.path.join(cache_dir, filename)
-    
-    # Check if we have the file cached
-    if os.path.exists(local_cache_path):
-        logger.info(f"Using cached file: {local_cache_path}")
-        need_download = False
-        cache_status = "HIT"
+    if is_dataset_key(key):
+        # A prefix or glob: one table over all the matching objects
+        conn, storage_path = setup_dataset(bucket, key, force_download)
     else:
-        logger.info(f"No cached file found at: {local_cache_path}")
-        need_download = True
-        cache_status = "MISS"
-    
-    # Download the file if needed
-    if need_download:
-        try:
-            logger.info(f"Downloading S3 file s3://{bucket}/{key} to {local_cache_path}")
-            s3_client.download_file(bucket, key, local_cache_path)
-            cache_status = "DOWNLOADED"
-        except Exception as e:
-            error_msg = str(e)
-            if '403' in error_msg:
-                raise ValueError(
-                    f"Access denied to S3 object '{key}' in bucket '{bucket}'. "
-                    "Please check your AWS credentials and object permissions. "
-                    f"Error: {error_msg}"
-                )
-            elif '404' in error_msg:
-                raise ValueError(f"S3 object '{key}' not found in bucket '{bucket}'. Please check the object path.")
-            else:
-                raise ValueError(f"Error downloading from S3: {error_msg}")
-    
-    # Create DuckDB connection
-    conn = duckdb.connect(database=':memory:')
-    
-    # Enable query logging and progress bar
-    conn.execute("SET enable_progress_bar=true")
-    
-    # Create a view that will lazily load the data from local cache only
-    logger.info(f"Creating lazy-loaded view from local cache: {local_cache_path}")
-    
-    # First, create a temporary table to store the schema
-    conn.execute(f"""
-        CREATE TEMP TABLE {view_name}_schema AS 
-        SELECT * FROM read_csv_auto('{local_cache_path}',
-            compression='gzip',
-            auto_detect=true,
-            header=true,
-            sample_size=-1,
-            quote='"',
-            escape='"'
-        ) LIMIT 0
-    """)
+        conn, storage_path = setup_cached_object(bucket, key, fmt, force_download)
+    cursor_pool = CursorPool(conn, query_workers, statement_cache_size)
+    if query_executor is None:
+        query_executor = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix='query')
     
-    # Then create the view that reads from the local file
-    conn.execute(f"""
-        CREATE VIEW {view_name} AS 
-        SELECT * FROM read_csv_auto('{local_cache_path}',
-            compression='gzip',
-            auto_detect=true,
-            header=true,
-            sample_size=-1,
-            quote='"',
-            escape='"'
-        )
-    """)
-    
-    # Drop the temporary schema table
-    conn.execute(f"DROP TABLE {view_name}_schema")
+    # Computed once per data version so /metadata and /statistics never scan the data
+    startup_phase = 'statistics'
+    table_statistics = load_table_statistics(conn, view_name, data_version)
     
     load_time_ms = (time.time() - start_time) * 1000
     logger.info(f"View created in {load_time_ms:.2f}ms (Cache status: {cache_status})")
 
+def load_data(url: str, table_name: str, fmt: str, force_download: bool, refresh_interval: float) -> None:
+    """Set up the data and run the warm-up queries, then report ready and start checking for new
+    versions. Runs in the background so the health endpoints answer meanwhile.
+    """
+    global startup_phase, startup_error
+    
+    try:
+        setup_duckdb(url, table_name, fmt, force_download)
+        startup_phase = 'warming'
+        warm_up(cursor_pool)
+    except Exception as e:
+        logger.error(f"Error loading data: {str(e)}")
+        startup_error = str(e)
+        startup_phase = 'failed'
+        return
+    startup_phase = 'ready'
+    
+    print(f"\nData available in table '{table_name}'")
+    print(f"Cache status: {cache_status}")
+    print(f"Local cache path: {local_cache_path}")
+    print(f"Storage: {storage_format} ({storage_path})")
+    if refresh_interval > 0:
+        start_cache_refresher(refresh_interval)
+
 app = FastAPI(
     title="DuckDB S3 Query API",
     description="API for querying gzipped CSV files stored in S3 using DuckDB",
@@ -284,11 +1309,78 @@ async def get_metadata():
     """Get metadata about the dataset."""
     return get_dataset_metadata()
 
+@app.get("/statistics", response_model=TableStatistics)
+async def get_statistics():
+    """Get the row count and per-column statistics of the served data version."""
+    if table_statistics is None:
+        raise HTTPException(status_code=503, detail="Table statistics not computed yet")
+    return table_statistics
+
+@app.get("/stats", response_model=StatementCacheStats)
+async def get_stats():
+    """Get the statement cache counters of the current data version."""
+    if not cursor_pool:
+        raise HTTPException(status_code=503, detail=f"Data not loaded yet ({startup_phase})")
+    return cursor_pool.stats()
+
+def get_health_status() -> HealthStatus:
+    return HealthStatus(
+        status=startup_phase,
+        ready=startup_phase == 'ready',
+        table_name=view_name,
+        data_version=data_version,
+        cache_status=cache_status,
+        warmup_queries=len(warmup_queries),
+        warmup_errors=warmup_errors,
+        warmup_time_ms=warmup_time_ms,
+        error=startup_error
+    )
+
+@app.get("/health/live", response_model=HealthStatus)
+async def health_live():
+    """Liveness: the server is up, even while it is still loading data. Fails only if loading failed."""
+    status = get_health_status()
+    if startup_phase == 'failed':
+        return JSONResponse(status_code=503, content=status.model_dump())
+    return status
+
+@app.get("/health/ready", response_model=HealthStatus)
+async def health_ready():
+    """Readiness: the data is cached, converted and its statistics computed, and the warm-up
+    queries have run. Until then it answers 503 so routers and load balancers send no queries.
+    """
+    status = get_health_status()
+    if not status.ready:
+        return JSONResponse(status_code=503, content=status.model_dump())
+    return status
+
+@app.get("/version", response_model=DataVersion)
+async def get_version():
+    """Get the version token of the served data without scanning it."""
+    return DataVersion(
+        table_name=view_name,
+        version=data_version,
+        last_modified=last_modified,
+        cache_status=cache_status
+    )
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Get the spans this node recorded for a trace."""
+    if trace_id not in recent_traces:
+        raise HTTPException(status_code=404, detail=f"Trace {trace_id} not found")
+    return recent_traces[trace_id]
+
 @app.post("/query", response_model=QueryResponse)
-async def execute_query(query_request: QueryRequest):
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database connection not initialized")
+async def execute_query(query_request: QueryRequest, accept: Optional[str] = Header(None),
+                        traceparent: Optional[str] = Header(None)):
+    # Queries wait for the statistics and warm-up too, like the readiness probe
+    if startup_phase != 'ready':
+        raise HTTPException(status_code=503, detail=f"Data not loaded yet ({startup_phase})")
     
+    # Stream NDJSON or Arrow IPC when the client asks for it
+    stream_format = negotiate_stream_format(accept)
+    trace = RequestTrace(traceparent)
     try:
         start_time = time.time()
         print(f"\nExecuting query at {datetime.now().isoformat()}")
@@ -297,17 +1389,42 @@ async def execute_query(query_request: QueryRequest):
         # Execute the query with lazy loading from local cache
         logger.debug(f"Executing DuckDB query: {query_request.query}")
         
-        # Preserve case in string literals by using parameterized queries
-        query, params = extract_string_literals(query_request.query)
+        # Bind literals as parameters so queries of the same shape share a cached statement
+        with trace.span('parameterize'):
+            query, params = extract_literals(query_request.query)
         logger.debug(f"Parameterized query: {query}")
         logger.debug(f"Parameters: {params}")
         
-        result = conn.execute(query, params).fetchdf()
+        with trace.span('execute') as attributes:
+            try:
+                if stream_format:
+                    stream = await open_result_stream(query, params, query_timeout)
+                else:
+                    result = await run_query(query, params, query_timeout)
+            except PoolExhaustedError as e:
+                attributes['queue_timed_out'] = True
+                logger.warning(f"{str(e)}, turning away: {query_request.query}")
+                raise HTTPException(status_code=503, detail=str(e), headers={'Retry-After': '1'})
+            except asyncio.TimeoutError:
+                attributes['timed_out'] = True
+                logger.error(f"Query interrupted after {query_timeout:g}s: {query_request.query}")
+                raise HTTPException(status_code=504, detail=f"Query exceeded the {query_timeout:g}s timeout and was interrupted")
+            if not stream_format:
+                attributes['rows'] = len(result)
+        
+        if stream_format:
+            # Record batches go out as DuckDB produces them, without a row-by-row JSON document
+            media_type = next(media for media, name in STREAM_MEDIA_TYPES.items() if name == stream_format)
+            return StreamingResponse(
+                stream_results(stream, stream_format, trace, query_request.query, start_time),
+                media_type=media_type
+            )
         logger.debug(f"Query returned {len(result)} rows")
         
         # Convert results to list of dictionaries
-        results = result.to_dict('records')
-        columns = list(result.columns)
+        with trace.span('serialize'):
+            results = result.to_dict('records')
+            columns = list(result.columns)
         
         execution_time = (time.time() - start_time) * 1000  # Convert to milliseconds
         print(f"\nQuery Execution Stats:")
@@ -315,70 +1432,118 @@ async def execute_query(query_request: QueryRequest):
         print(f"  Rows returned: {len(results):,}")
         print(f"  Columns: {', '.join(columns)}")
         
+        trace.finish('node_query', query=query_request.query, rows=len(results))
         return QueryResponse(
             results=results,
             columns=columns,
             execution_time_ms=execution_time,
             timestamp=datetime.now().isoformat()
         )
+    except HTTPException as e:
+        trace.finish('node_query', status='error', query=query_request.query, error=e.detail)
+        raise
     except Exception as e:
         logger.error(f"Error executing query: {str(e)}")
+        trace.finish('node_query', status='error', query=query_request.query, error=str(e))
         raise HTTPException(status_code=400, detail=str(e))
 
-def extract_string_literals(sql_query):
+def literal_value(literal: str):
+    """Python value of a SQL string or number literal, typed as DuckDB types the literal."""
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    if 'e' in literal.lower():
+        return float(literal)
+    if '.' in literal:
+        return decimal.Decimal(literal)
+    return int(literal)
+
+def extract_literals(sql_query):
     """
-    Extract string literals from SQL query and replace them with placeholders.
+    Extract literals from SQL query and replace them with placeholders.
     Returns a tuple of (modified_query, parameters).
     
-    This preserves case sensitivity in string literals by using parameterized queries.
+    String literals are replaced anywhere, which also preserves their case. Numbers are replaced
+    where they are compared with something, in IN-lists and as BETWEEN bounds, but not where
+    they must stay constants, such as LIMIT, ORDER BY positions and type arguments. A typed
+    literal such as DATE '2025-05-04' becomes CAST(? AS DATE); intervals are left as they are.
     """
-    # Regular expression to match string literals (text within single quotes)
-    # This handles escaped single quotes within the string
-    pattern = r"'([^']*(?:''[^']*)*)'" 
-    
-    # Find all string literals
-    matches = re.findall(pattern, sql_query)
     parameters = []
     
-    # Replace each string literal with a placeholder
-    modified_query = sql_query
-    for i, match in enumerate(matches):
-        # Replace escaped single quotes with single quotes
-        value = match.replace("''", "'")
-        parameters.append(value)
-        
-        # Replace the string literal with a placeholder
-        # We need to account for the quotes in the replacement
-        old_literal = f"'{match}'"
-        placeholder = f"?"
-        
-        # Only replace the first occurrence each time to handle repeated literals correctly
-        modified_query = modified_query.replace(old_literal, placeholder, 1)
+    def replace(match):
+        if match.group('skip'):
+            return match.group(0)
+        if match.group('typed'):
+            parameters.append(literal_value(match.group('typed')))
+            return f"CAST(? AS {match.group('type').upper()})"
+        parameters.extend(literal_value(literal) for literal in LITERAL_ITEM_PATTERN.findall(match.group(0)))
+        return LITERAL_ITEM_PATTERN.sub('?', match.group(0))
     
-    return modified_query, parameters
+    return LITERAL_PATTERN.sub(replace, sql_query), parameters
 
 def main():
+    global download_concurrency, download_part_size, statement_cache_size
+    global query_workers, query_timeout, queue_timeout, duckdb_threads, duckdb_memory_limit, stream_batch_rows, warmup_queries
+    global index_columns
+    
     parser = argparse.ArgumentParser(description='Start a web server for querying S3 CSV files using DuckDB')
-    parser.add_argument('s3_url', help='S3 URL of the gzipped CSV file (s3://bucket/key)')
+    parser.add_argument('s3_url', help='S3 URL of the gzipped CSV file (s3://bucket/key), or a prefix ending in / or glob '
+                        'of dated files served as one table partitioned by effective_date')
     parser.add_argument('--table-name', default='s3_data', help='Name of the table to create (default: s3_data)')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--port', type=int, default=8000, help='Port to bind the server to')
     parser.add_argument('--force-download', action='store_true', help='Force download from S3 even if cached file exists')
+    parser.add_argument('--download-concurrency', type=int, default=8, help='Ranged GETs in flight when downloading the file (default: 8)')
+    parser.add_argument('--download-part-mb', type=int, default=16, help='Size of each ranged GET in MB (default: 16)')
+    parser.add_argument('--statement-cache-size', type=int, default=256,
+                        help='Parsed statements kept per worker, keyed by query shape (0 to disable, default: 256)')
+    parser.add_argument('--workers', type=int, default=4, help='Queries run concurrently, each on its own cursor (default: 4)')
+    parser.add_argument('--query-timeout', type=float, default=120.0,
+                        help='Seconds after which a query is interrupted (0 for no limit, default: 120)')
+    parser.add_argument('--queue-timeout', type=float, default=30.0,
+                        help='Seconds a query waits for a free worker before it is answered with 503 (0 for no limit, default: 30)')
+    parser.add_argument('--stream-batch-rows', type=int, default=10000,
+                        help='Rows per record batch when streaming NDJSON or Arrow results (default: 10000)')
+    parser.add_argument('--duckdb-threads', type=int, help='DuckDB worker threads (default: number of cores)')
+    parser.add_argument('--duckdb-memory-limit', help='DuckDB memory limit, e.g. 4GB (default: DuckDB\'s default)')
+    parser.add_argument('--refresh-interval', type=float, default=300,
+                        help='Seconds between checks of S3 for a new version of the file (0 to disable, default: 300)')
+    parser.add_argument('--storage', choices=STORAGE_FORMATS, default='duckdb',
+                        help='Convert the cached CSV to a DuckDB database or Parquet file once, or query the CSV directly (default: duckdb)')
+    parser.add_argument('--index-column', action='append', default=[],
+                        help='Lookup column to sort the converted data on and, with --storage duckdb, index; may be repeated, '
+                        'the first sorts first')
+    parser.add_argument('--warmup-query', action='append', default=[],
+                        help='Query to run on every worker before reporting ready; may be repeated')
+    parser.add_argument('--warmup-file', help='JSON file with a list of warm-up queries')
     
     args = parser.parse_args()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    download_concurrency = args.download_concurrency
+    download_part_size = args.download_part_mb * 1024 * 1024
+    statement_cache_size = args.statement_cache_size
+    query_workers = args.workers
+    query_timeout = args.query_timeout
+    queue_timeout = args.queue_timeout
+    stream_batch_rows = args.stream_batch_rows
+    duckdb_threads = args.duckdb_threads
+    duckdb_memory_limit = args.duckdb_memory_limit
+    index_columns = list(args.index_column)
+    warmup_queries = list(args.warmup_query)
+    if args.warmup_file:
+        with open(args.warmup_file) as f:
+            warmup_queries += json.load(f)
 
-    # Set up DuckDB connection
-    setup_duckdb(args.s3_url, args.table_name)
+    # Load the data in the background; /health/ready reports when it can be queried
+    threading.Thread(
+        target=load_data, name='load-data', daemon=True,
+        args=(args.s3_url, args.table_name, args.storage, args.force_download, args.refresh_interval)
+    ).start()
 
     # Start the server
     print(f"\nStarting server on {args.host}:{args.port}")
-    print(f"Data available in table '{args.table_name}'")
-    print(f"Cache status: {cache_status}")
-    print(f"Local cache path: {local_cache_path}")
     uvicorn.run(app, host=args.host, port=args.port)
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Parallel ranged downloads of S3 objects.
+
+Fetches an object with concurrent ranged GETs written straight into a
+preallocated file, resumes an interrupted download from the parts already on
+disk and verifies the result against the object's ETag. Several downloads can
+share a TransferBudget that caps the connections in flight and the bandwidth
+used between them.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+# Parts of a multipart upload up to this size are downloaded as-is so their MD5s can be
+# checked against the ETag as they arrive; larger ones are split and hashed afterwards
+MAX_ALIGNED_PART_SIZE = 256 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+PART_ATTEMPTS = 3
+MULTIPART_ETAG_PATTERN = re.compile(r'^([0-9a-f]{32})-(\d+)$')
+MD5_ETAG_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class ChecksumError(Exception):
+    """The downloaded file does not match the object's ETag."""
+
+class TransferBudget:
+    """Connections and bandwidth shared by concurrent downloads."""
+
+    def __init__(self, max_connections: int = 16, bandwidth_mbps: Optional[float] = None):
+        self.max_connections = max_connections
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.bytes_per_second = bandwidth_mbps * 125000 if bandwidth_mbps else None
+        self.bytes_received = 0
+        self._next_read = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttle(self, nbytes: int) -> None:
+        """Account for bytes received, sleeping as needed to stay within the bandwidth."""
+        with self._lock:
+            self.bytes_received += nbytes
+            if not self.bytes_per_second:
+                return
+            now = time.monotonic()
+            self._next_read = max(self._next_read, now) + nbytes / self.bytes_per_second
+            delay = self._next_read - now
+        if delay > 0:
+            time.sleep(delay)
+
+def head_part_sizes(s3_client, bucket: str, key: str, numbers: List[int], budget: TransferBudget) -> List[int]:
+    """Sizes of the given parts of a multipart upload, looked up concurrently."""
+    def head_part(number: int) -> int:
+        with budget.connections:
+            return s3_client.head_object(Bucket=bucket, Key=key, PartNumber=number)['ContentLength']
+
+    with ThreadPoolExecutor(max_workers=min(budget.max_connections, len(numbers))) as executor:
+        return list(executor.map(head_part, numbers))
+
+def get_object_info(s3_client, bucket: str, key: str, budget: Optional[TransferBudget] = None) -> Dict:
+    """Size and ETag of an object, plus the part sizes of a multipart upload.
+
+    Uploaders split an object into parts of one size and a smaller last part, so only the
+    first and last parts are looked up when they account for the whole size, and the
+    sizes are marked inferred. Otherwise every part is looked up. The part sizes are None
+    if they cannot be found, leaving only the size to check.
+    """
+    budget = budget or TransferBudget()
+    response = s3_client.head_object(Bucket=bucket, Key=key)
+    info = {
+        'size': response['ContentLength'],
+        'etag': response.get('ETag', '').strip('"'),
+        'encryption': response.get('ServerSideEncryption') or response.get('SSECustomerAlgorithm'),
+        'upload_part_sizes': None,
+        'upload_part_sizes_inferred': False
+    }
+    match = MULTIPART_ETAG_PATTERN.match(info['etag'])
+    if match:
+        count = int(match.group(2))
+        try:
+            first, last = head_part_sizes(s3_client, bucket, key, [1, count], budget)
+            part_sizes = [first] * (count - 1) + [last]
+            inferred = count > 2
+            if sum(part_sizes) != info['size']:
+                part_sizes = head_part_sizes(s3_client, bucket, key, list(range(1, count + 1)), budget)
+                inferred = False
+        except Exception as e:
+            logger.warning(f"Cannot look up the parts of s3://{bucket}/{key}, checking its size only: {str(e)}")
+        else:
+            if sum(part_sizes) == info['size']:
+                info['upload_part_sizes'] = part_sizes
+                info['upload_part_sizes_inferred'] = inferred
+            else:
+                logger.warning(f"Parts of s3://{bucket}/{key} do not add up to its size, checking its size only")
+    return info
+
+def plan_parts(size: int, part_size: int) -> List[Tuple[int, int]]:
+    """Inclusive byte ranges covering an object of the given size."""
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+def upload_parts(part_sizes: List[int]) -> List[Tuple[int, int]]:
+    """Inclusive byte ranges of the parts of a multipart upload."""
+    parts = []
+    start = 0
+    for part_size in part_sizes:
+        parts.append((start, start + part_size - 1))
+        start += part_size
+    return parts
+
+def multipart_etag(digests: List[bytes]) -> str:
+    """The ETag S3 gives a multipart upload with parts of the given MD5 digests."""
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+def file_etag(path: str, upload_part_sizes: Optional[List[int]] = None) -> str:
+    """Compute the ETag of a local file as S3 would for a single or multipart upload."""
+    if not upload_part_sizes:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    digests = []
+    with open(path, 'rb') as f:
+        for part_size in upload_part_sizes:
+            digest = hashlib.md5()
+            remaining = part_size
+            while remaining:
+                block = f.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+            digests.append(digest.digest())
+    return multipart_etag(digests)
+
+def download_object(s3_client, bucket: str, key: str, local_path: str, part_size: int = DEFAULT_PART_SIZE,
+                    concurrency: int = 8, budget: Optional[TransferBudget] = None) -> Dict:
+    """Download an object to local_path with concurrent ranged GETs.
+
+    Parts are written into a preallocated <local_path>.part file and recorded in
+    <local_path>.part.json as they complete, so a failed or interrupted download of
+    the same object version resumes where it stopped. The file is verified against
+    the ETag and only then renamed to local_path. Returns the object's info.
+    """
+    budget = budget or TransferBudget(concurrency)
+    start_time = time.time()
+    info = get_object_info(s3_client, bucket, key, budget)
+    etag, size, upload_part_sizes = info['etag'], info['size'], info['upload_part_sizes']
+
+    # With SSE-KMS or SSE-C the ETag is not an MD5 of the data, and that of a multipart upload
+    # whose parts are unknown cannot be recomputed; only the size is checked then
+    verify = info['encryption'] in (None, 'AES256') and (bool(upload_part_sizes) or bool(MD5_ETAG_PATTERN.match(etag)))
+    aligned = bool(upload_part_sizes) and max(upload_part_sizes) <= MAX_ALIGNED_PART_SIZE
+    parts = upload_parts(upload_part_sizes) if aligned else plan_parts(size, part_size)
+
+    os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+    part_path = f"{local_path}.part"
+    state_path = f"{part_path}.json"
+    state = {'etag': etag, 'size': size, 'ranges': [list(part) for part in parts], 'parts': {}}
+    try:
+        with open(state_path) as f:
+            saved_state = json.load(f)
+        if (all(saved_state.get(field) == state[field] for field in ('etag', 'size', 'ranges'))
+                and os.path.getsize(part_path) == size):
+            state = saved_state
+    except (OSError, ValueError):
+        pass
+    resumed = len(state['parts'])
+    if resumed:
+        logger.info(f"Resuming download of s3://{bucket}/{key}: {resumed} of {len(parts)} parts already written")
+
+    lock = threading.Lock()
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+    try:
+        if not resumed:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+
+        def save_state():
+            tmp_state_path = f"{state_path}.tmp"
+            with open(tmp_state_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_state_path, state_path)
+
+        def fetch_part(index: int) -> None:
+            start, end = parts[index]
+            for attempt in range(1, PART_ATTEMPTS + 1):
+                digest = hashlib.md5()
+                offset = start
+                try:
+                    with budget.connections:
+                        request = {'Bucket': bucket, 'Key': key, 'Range': f"bytes={start}-{end}"}
+                        if etag:
+                            # Fail rather than mix parts of two versions if the object is replaced
+                            request['IfMatch'] = f'"{etag}"'
+                        body = s3_client.get_object(**request)['Body']
+                        for chunk in iter(lambda: body.read(READ_SIZE), b''):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            digest.update(chunk)
+                            budget.throttle(len(chunk))
+                    if offset != end + 1:
+                        raise IOError(f"Part {index} ended after {offset - start} of {end - start + 1} bytes")
+                    break
+                except Exception as e:
+                    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                    if code in ('PreconditionFailed', '412', '403', '404', 'AccessDenied', 'NoSuchKey') \
+                            or attempt == PART_ATTEMPTS:
+                        raise
+                    logger.warning(f"Attempt {attempt} of part {index} of s3://{bucket}/{key} failed: {str(e)}")
+            with lock:
+                state['parts'][str(index)] = digest.hexdigest()
+                save_state()
+
+        missing = [index for index in range(len(parts)) if str(index) not in state['parts']]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(missing))) as executor:
+                futures = [executor.submit(fetch_part, index) for index in missing]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception() is not None:
+                        for other in futures:
+                            other.cancel()
+                        raise future.exception()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if verify:
+        if aligned:
+            actual = multipart_etag([bytes.fromhex(state['parts'][str(index)]) for index in range(len(parts))])
+        else:
+            actual = file_etag(part_path, upload_part_sizes)
+        if actual != etag and info['upload_part_sizes_inferred']:
+            # The middle parts were taken to be the size of the first; look them all up before
+            # concluding the file differs, keeping it for the next attempt if that fails
+            try:
+                part_sizes = head_part_sizes(s3_client, bucket, key, list(range(1, len(upload_part_sizes) + 1)), budget)
+            except Exception as e:
+                raise ChecksumError(f"Downloaded s3://{bucket}/{key} has ETag {actual}, expected {etag}, "
+                                    f"and its parts cannot be looked up: {str(e)}")
+            if part_sizes != upload_part_sizes and sum(part_sizes) == size:
+                actual = file_etag(part_path, part_sizes)
+        if actual != etag:
+            # Recomputed from the object's own part sizes, so the file really differs; a corrupt
+            # part cannot be told apart from the others, so start over next time
+            os.remove(part_path)
+            os.remove(state_path)
+            raise ChecksumError(f"Downloaded s3://{bucket}/{key} has ETag {actual}, expected {etag}")
+    os.replace(part_path, local_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    elapsed = time.time() - start_time
+    logger.info(f"Downloaded s3://{bucket}/{key} ({size / 1024 / 1024:.1f} MB) in {elapsed:.2f}s "
+                f"({size / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s, {len(parts)} parts, {resumed} resumed, "
+                f"{'verified' if verify else 'not verified'})")
+    return info
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description='Download an S3 object with parallel ranged GETs')
+    parser.add_argument('s3_url', help='S3 URL of the object (s3://bucket/key)')
+    parser.add_argument('local_path', help='Where to write the object')
+    parser.add_argument('--concurrency', type=int, default=8, help='Ranged GETs in flight')
+    parser.add_argument('--part-mb', type=int, default=16, help='Size of each ranged GET in MB')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Bandwidth limit in megabits per second')
+
+    args = parser.parse_args()
+
+    bucket, _, key = args.s3_url[len('s3://'):].partition('/')
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=args.concurrency))
+    download_object(s3_client, bucket, key, args.local_path, args.part_mb * 1024 * 1024, args.concurrency,
+                    TransferBudget(args.concurrency, args.bandwidth_mbps))
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,10 @@ from typing import List, Dict, Optional
 import argparse
 import os
 import botocore
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_download import TransferBudget, download_object
 
 # Set up logging
 logging.basicConfig(
@@ -24,9 +28,10 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 class S3Enumerator:
     def __init__(self, bucket_name: str, root_path: str = "", include_pattern: Optional[str] = None, 
                  exclude_pattern: Optional[str] = None, download: bool = False, 
-                 download_dir: Optional[str] = None):
+                 download_dir: Optional[str] = None, parallel_downloads: int = 4,
+                 max_connections: int = 16, bandwidth_mbps: Optional[float] = None, part_size_mb: int = 16):
         self.session = boto3.Session()
-        self.s3_client = self.session.client('s3')
+        self.s3_client = self.session.client('s3', config=Config(max_pool_connections=max_connections))
         self.bucket_name = bucket_name
         self.root_path = root_path.rstrip('/')  # Remove trailing slash if present
         self.include_pattern = re.compile(include_pattern) if include_pattern else None
@@ -35,6 +40,11 @@ class S3Enumerator:
         self.download_dir = download_dir
         self.total_size = 0
         self.latest_files = []
+        # Downloads are queued while enumerating and run together under one connection and bandwidth budget
+        self.parallel_downloads = parallel_downloads
+        self.part_size = part_size_mb * 1024 * 1024
+        self.budget = TransferBudget(max_connections, bandwidth_mbps)
+        self.pending_downloads = []
         
         # Print credential diagnostics
         self._print_credential_diagnostics()
@@ -81,13 +91,16 @@ class S3Enumerator:
         return True
 
     def download_file(self, s3_key: str, local_path: str) -> bool:
-        """Download a file from S3 to the local filesystem."""
+        """Download a file from S3 to the local filesystem with parallel ranged GETs.
+        An interrupted download resumes from the parts already written on the next run.
+        """
         try:
             # Create the directory structure if it doesn't exist
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
             
             # Download the file
-            self.s3_client.download_file(self.bucket_name, s3_key, local_path)
+            download_object(self.s3_client, self.bucket_name, s3_key, local_path, self.part_size,
+                            self.budget.max_connections, self.budget)
             logger.info(f"Downloaded file to: {local_path}")
             return True
         except botocore.exceptions.ClientError as e:
@@ -151,10 +164,7 @@ class S3Enumerator:
                     
                     # Only download if file doesn't exist locally
                     if not self.file_exists_locally(local_path):
-                        if self.download_file(file['Key'], local_path):
-                            logger.info(f"Downloaded new file: {local_path}")
-                        else:
-                            logger.warning(f"Failed to download file: {local_path}")
+                        self.pending_downloads.append((file['Key'], local_path))
                     else:
                         logger.info(f"File already exists locally: {local_path}")
 
@@ -213,6 +223,24 @@ class S3Enumerator:
         except Exception as e:
             logger.error(f"Error enumerating directories: {str(e)}")
 
+    def download_pending(self) -> None:
+        """Download the queued files, several at a time, within the shared transfer budget."""
+        if not self.pending_downloads:
+            return
+        
+        # The same file can be queued once per listing page of its directory
+        downloads = list(dict.fromkeys(self.pending_downloads))
+        self.pending_downloads = []
+        logger.info(f"Downloading {len(downloads)} files, {self.parallel_downloads} at a time")
+        with ThreadPoolExecutor(max_workers=self.parallel_downloads) as executor:
+            results = list(executor.map(lambda download: self.download_file(*download), downloads))
+        for (_, local_path), succeeded in zip(downloads, results):
+            if succeeded:
+                logger.info(f"Downloaded new file: {local_path}")
+            else:
+                logger.warning(f"Failed to download file: {local_path}")
+        logger.info(f"Downloaded {self.budget.bytes_received} bytes")
+
     def save_results(self, output_file: str) -> None:
         """Save results to a JSON file."""
         results = {
@@ -236,6 +264,10 @@ def main():
     parser.add_argument('--output', default='s3_enum_results.json', help='Output JSON file path')
     parser.add_argument('--download', action='store_true', help='Download the latest files')
     parser.add_argument('--download-dir', help='Directory to download files to')
+    parser.add_argument('--parallel-downloads', type=int, default=4, help='Files downloaded at the same time')
+    parser.add_argument('--max-connections', type=int, default=16, help='Ranged GETs in flight across all downloads')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Total download bandwidth limit in megabits per second')
+    parser.add_argument('--part-mb', type=int, default=16, help='Size of each ranged GET in MB')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging for botocore')
     
     args = parser.parse_args()
@@ -256,9 +288,14 @@ def main():
         args.include, 
         args.exclude,
         args.download,
-        args.download_dir
+        args.download_dir,
+        args.parallel_downloads,
+        args.max_connections,
+        args.bandwidth_mbps,
+        args.part_mb
     )
     enumerator.enumerate_directories()
+    enumerator.download_pending()
     
     logger.info(f"Total size of latest files: {enumerator.total_size} bytes")
     enumerator.save_results(args.output)
@@ -129,6 +129,8 @@ resource "azurerm_container_app" "query_servers" {
       port      = table_config.port
       filename  = table_config.filename
       table_name = table_config.table_name
+      # Joined so tables with different numbers of lookup columns share one object type
+      index_columns = join(",", lookup(table_config, "index_columns", []))
     }
   }
 
@@ -144,12 +146,12 @@ resource "azurerm_container_app" "query_servers" {
       cpu    = 2.0
       memory = "8Gi"
       
-      command = [
+      command = concat([
         "python", 
         "/app/query_s3.py", 
         "--url", "s3://${azurerm_storage_account.data_storage.name}/${azurerm_storage_container.data_container.name}/${each.value.filename}",
         "--table-name", each.value.table_name
-      ]
+      ], flatten([for column in compact(split(",", each.value.index_columns)) : ["--index-column", column]]))
       
       env {
         name  = "AWS_ACCESS_KEY_ID"
@@ -175,6 +177,19 @@ resource "azurerm_container_app" "query_servers" {
         name  = "AZURE_STORAGE_CONTAINER"
         value = azurerm_storage_container.data_container.name
       }
+
+      # Live while loading the data; ready once it is cached, converted and warmed up
+      liveness_probe {
+        transport = "HTTP"
+        port      = each.value.port
+        path      = "/health/live"
+      }
+
+      readiness_probe {
+        transport = "HTTP"
+        port      = each.value.port
+        path      = "/health/ready"
+      }
     }
   }
 
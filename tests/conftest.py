@@ -0,0 +1,101 @@
+"""Fixtures that run the distributed router against mock data nodes in-process.
+
+Every data node is a mock_data_node.py app serving a slice of a generated table,
+reached through an httpx transport instead of the network, so the router's results
+can be compared with DuckDB querying the whole table directly.
+"""
+import json
+import os
+import sys
+from typing import Dict, Set
+
+import duckdb
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import distributed_query as dq
+import mock_data_node as mdn
+
+ARTIST_ROWS = 2000
+LABEL_ROWS = 100
+
+# Range shards of artists on id and hash shards of labels on id: host -> (table, where, shard config)
+SHARDS = {
+    'artists-0': ('artists', 'id <= 699', {'key_max': 699}),
+    'artists-1': ('artists', 'id BETWEEN 700 AND 1399', {'key_min': 700, 'key_max': 1399}),
+    'artists-2': ('artists', 'id >= 1400', {'key_min': 1400}),
+    'labels-0': ('labels', 'hash(CAST(id AS VARCHAR)) % 2 = 0', {'hash_remainder': 0}),
+    'labels-1': ('labels', 'hash(CAST(id AS VARCHAR)) % 2 = 1', {'hash_remainder': 1}),
+}
+PORT = 8000
+
+class RoutingTransport(httpx.AsyncBaseTransport):
+    """Hand each request to the app of the data node it is addressed to. Requests to hosts in
+    down fail to connect, and those to hosts in stalled wait until release is set.
+    """
+    def __init__(self, apps: Dict[str, object]):
+        self.transports = {host: httpx.ASGITransport(app=app) for host, app in apps.items()}
+        self.down: Set[str] = set()
+        self.stalled: Set[str] = set()
+        self.release = None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if host in self.down:
+            raise httpx.ConnectError(f"Connection refused by {host}", request=request)
+        if host in self.stalled:
+            await self.release.wait()
+        return await self.transports[host].handle_async_request(request)
+
+class Cluster:
+    """Mock data nodes serving the sharded tables, the router's config and a reference connection."""
+
+    def __init__(self, data_dir: str, config_path: str):
+        self.config_path = config_path
+        self.nodes = {}
+        apps = {}
+        for host, (table, where, _) in SHARDS.items():
+            node = mdn.MockDataNode(table, os.path.join(data_dir, f"{table}.parquet"), where)
+            self.nodes[host] = node
+            apps[host] = mdn.create_app(node)
+        self.transport = RoutingTransport(apps)
+
+        self.reference = duckdb.connect(database=':memory:')
+        for table in ('artists', 'labels'):
+            path = os.path.join(data_dir, f"{table}.parquet")
+            self.reference.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{path}')")
+
+    def server(self, **settings) -> dq.DistributedQueryServer:
+        """A router over the cluster, without result caching or background health checks by default."""
+        settings = {'result_cache_mb': 0, 'fragment_cache_mb': 0, 'health_check_interval': 0, **settings}
+        server = dq.DistributedQueryServer(self.config_path, dq.ServerSettings(**settings))
+        server.client = httpx.AsyncClient(transport=self.transport)
+        return server
+
+    def queried(self) -> Dict[str, int]:
+        """Queries each data node has answered so far."""
+        return {host: node.queries for host, node in self.nodes.items()}
+
+    def rows_sent(self) -> int:
+        return sum(node.rows_sent for node in self.nodes.values())
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data')
+    mdn.generate_synthetic_table('artists', ARTIST_ROWS, str(path / 'artists.parquet'), label_rows=LABEL_ROWS)
+    mdn.generate_synthetic_table('labels', LABEL_ROWS, str(path / 'labels.parquet'))
+
+    tables = {}
+    for host, (table, _, shard) in SHARDS.items():
+        tables.setdefault(table, {'table_name': table, 'shard_key': 'id', 'shards': []})
+        tables[table]['shards'].append({'url': f"http://{host}", 'port': PORT, **shard})
+    tables['labels']['hash_modulus'] = 2
+    with open(path / 'config.json', 'w') as f:
+        json.dump({'tables': tables}, f)
+    return path
+
+@pytest.fixture
+def cluster(data_dir) -> Cluster:
+    return Cluster(str(data_dir), str(data_dir / 'config.json'))
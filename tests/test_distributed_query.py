@@ -0,0 +1,580 @@
+"""Router results over sharded mock data nodes, compared with DuckDB over the whole table."""
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+import pyarrow as pa
+import pytest
+from fastapi import HTTPException
+
+import distributed_query as dq
+import mock_data_node as mdn
+from conftest import ARTIST_ROWS, LABEL_ROWS, SHARDS
+
+ARTIST_SHARDS = [host for host, (table, _, _) in SHARDS.items() if table == 'artists']
+
+async def route(server: dq.DistributedQueryServer, query: str) -> dq.QueryResponse:
+    try:
+        return await server.execute_query(dq.QueryRequest(query=query))
+    finally:
+        await server.client.aclose()
+
+def run_query(cluster, query: str, **settings) -> dq.QueryResponse:
+    async def main():
+        return await route(cluster.server(**settings), query)
+    return asyncio.run(main())
+
+def normalize(value):
+    return round(value, 6) if isinstance(value, float) else value
+
+def rows_of(response: dq.QueryResponse):
+    return [tuple(normalize(row[column]) for column in response.columns) for row in response.results]
+
+def assert_matches_duckdb(cluster, query: str, ordered: bool = False) -> dq.QueryResponse:
+    """Check the router answers a query with the rows and column names DuckDB gives."""
+    response = run_query(cluster, query)
+    expected = cluster.reference.execute(query)
+    columns = [column[0] for column in expected.description]
+    rows = [tuple(normalize(value) for value in row) for row in expected.fetchall()]
+    assert response.columns == columns
+    got = rows_of(response)
+    if ordered:
+        assert got == rows
+    else:
+        assert sorted(got, key=repr) == sorted(rows, key=repr)
+    return response
+
+def test_all_rows_come_back_without_pushdown(cluster):
+    response = assert_matches_duckdb(cluster, "SELECT id FROM artists")
+    assert len(response.results) == ARTIST_ROWS
+
+@pytest.mark.parametrize('query', [
+    "SELECT country, COUNT(*), SUM(score), MIN(score), MAX(score) FROM artists GROUP BY country",
+    "SELECT country, AVG(score) * 2, COUNT(name) AS named FROM artists GROUP BY country",
+    "SELECT COUNT(*), AVG(score) FROM artists WHERE score > 50",
+    "SELECT country, COUNT(*) FROM artists GROUP BY country HAVING COUNT(*) > 200",
+    "SELECT country, AVG(score) FROM artists GROUP BY country HAVING AVG(score) > 49 AND MAX(score) > 99",
+    "SELECT COUNT(*) total FROM artists",
+    "SELECT country, COUNT(*) n FROM artists GROUP BY country ORDER BY n",
+    "SELECT country, count(*) FROM artists GROUP BY 1",
+    "SELECT country AS c, SUM(score) FROM artists GROUP BY 1 HAVING COUNT(*) > 200",
+])
+def test_partial_aggregates_merge_like_duckdb(cluster, query):
+    assert_matches_duckdb(cluster, query)
+    # Each shard sends its groups rather than its rows
+    assert cluster.rows_sent() <= len(ARTIST_SHARDS) * 10
+    assert all(cluster.queried()[host] == 1 for host in ARTIST_SHARDS)
+
+@pytest.mark.parametrize('query', [
+    "SELECT COUNT(DISTINCT label_id) FROM artists",
+    "SELECT country, COUNT(DISTINCT label_id) AS labels FROM artists GROUP BY country",
+    "SELECT country, COUNT(DISTINCT label_id) FROM artists GROUP BY country HAVING COUNT(DISTINCT label_id) > 90",
+])
+def test_distinct_aggregates_match_duckdb(cluster, query):
+    # Distinct counts do not merge from per-shard counts, so the rows are aggregated at the router
+    assert_matches_duckdb(cluster, query)
+
+@pytest.mark.parametrize('query, limit', [
+    ("SELECT id, name, score FROM artists ORDER BY score DESC, id LIMIT 10", 10),
+    ("SELECT id, score FROM artists ORDER BY score, id LIMIT 5 OFFSET 7", 12),
+    ("SELECT name FROM artists WHERE country = 'SE' ORDER BY id DESC LIMIT 3 OFFSET 2", 5),
+])
+def test_top_n_is_pushed_to_shards(cluster, query, limit):
+    assert_matches_duckdb(cluster, query, ordered=True)
+    # Shards return at most LIMIT + OFFSET rows each
+    assert cluster.rows_sent() <= len(ARTIST_SHARDS) * limit
+
+@pytest.mark.parametrize('query, hosts', [
+    ("SELECT * FROM artists WHERE id = 5", {'artists-0'}),
+    ("SELECT id, name FROM artists WHERE id IN (5, 1500)", {'artists-0', 'artists-2'}),
+    ("SELECT COUNT(*) FROM artists WHERE id >= 1400", {'artists-2'}),
+    ("SELECT id FROM artists WHERE id BETWEEN 650 AND 720 ORDER BY id", {'artists-0', 'artists-1'}),
+    ("SELECT * FROM artists WHERE id = 5000", {'artists-2'}),
+    ("SELECT * FROM labels WHERE id IN (3, 4)", {'labels-0', 'labels-1'}),
+])
+def test_range_shards_are_pruned(cluster, query, hosts):
+    assert_matches_duckdb(cluster, query)
+    queried = {host for host, count in cluster.queried().items() if count}
+    assert queried == hosts
+
+def test_hash_shards_are_pruned(cluster):
+    response = assert_matches_duckdb(cluster, "SELECT * FROM labels WHERE id = 7")
+    assert len(response.results) == 1
+    assert sum(cluster.queried().values()) == 1
+    assert cluster.queried()['labels-0'] + cluster.queried()['labels-1'] == 1
+
+def test_unpruned_queries_ask_every_shard(cluster):
+    assert_matches_duckdb(cluster, "SELECT id FROM artists WHERE score > 99.5")
+    assert all(cluster.queried()[host] == 1 for host in ARTIST_SHARDS)
+    assert sum(cluster.queried().values()) == len(ARTIST_SHARDS)
+
+def test_breaker_opens_after_failures_and_closes_after_trial(cluster):
+    async def main():
+        server = cluster.server(retry_attempts=1, breaker_failure_threshold=2, breaker_reset_timeout=0.2)
+        base_url = f"http://artists-0:8000"
+        breaker = server._node_state(base_url).breaker
+        cluster.transport.down.add('artists-0')
+        try:
+            for _ in range(2):
+                with pytest.raises(Exception):
+                    await server._request_node(base_url, 'GET', '/version')
+            assert breaker.state == 'open'
+
+            # Rejected without reaching the node while open
+            with pytest.raises(dq.NodeUnavailableError):
+                await server._request_node(base_url, 'GET', '/version')
+            with pytest.raises(HTTPException) as error:
+                await server.execute_query(dq.QueryRequest(query="SELECT * FROM artists WHERE id = 5"))
+            assert error.value.status_code == 503
+
+            # A failed trial re-opens the circuit
+            await asyncio.sleep(0.25)
+            assert breaker.available()
+            with pytest.raises(Exception):
+                await server._request_node(base_url, 'GET', '/version')
+            assert breaker.state == 'open'
+
+            # A successful trial closes it
+            cluster.transport.down.clear()
+            await asyncio.sleep(0.25)
+            response = await server._request_node(base_url, 'GET', '/version')
+            assert response.status_code == 200
+            assert breaker.state == 'closed'
+            assert breaker.failures == 0
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def test_open_circuit_fails_join_queries_with_503(cluster):
+    query = "SELECT artists.name, labels.name AS label FROM artists JOIN labels ON artists.label_id = labels.id WHERE artists.id < 10"
+    async def main():
+        # labels is joined from a resident copy and artists fetched from its shards
+        server = cluster.server(breaker_reset_timeout=math.inf, broadcast_max_rows=LABEL_ROWS)
+        try:
+            response = await server.execute_query(dq.QueryRequest(query=query))
+            assert len(response.results) == 10
+
+            breaker = server._node_state("http://artists-0:8000").breaker
+            breaker.state = 'open'
+            breaker.opened_at = time.time()
+            with pytest.raises(HTTPException) as error:
+                await server.execute_query(dq.QueryRequest(query=query))
+            assert error.value.status_code == 503
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def test_cancelled_trial_hands_over_to_next_request(cluster):
+    async def main():
+        server = cluster.server(retry_attempts=1, breaker_failure_threshold=1, breaker_reset_timeout=0.1)
+        base_url = f"http://artists-1:8000"
+        breaker = server._node_state(base_url).breaker
+        breaker.state = 'open'
+        breaker.opened_at = time.time() - 1
+        cluster.transport.release = asyncio.Event()
+        cluster.transport.stalled.add('artists-1')
+        try:
+            trial = asyncio.ensure_future(server._request_node(base_url, 'GET', '/version'))
+            await asyncio.sleep(0.05)
+            assert breaker.state == 'half_open'
+            assert not breaker.available()
+
+            trial.cancel()
+            await asyncio.gather(trial, return_exceptions=True)
+            # Not stuck half-open: the next request becomes the trial straight away
+            assert breaker.state == 'open'
+            assert breaker.available()
+
+            cluster.transport.stalled.clear()
+            response = await server._request_node(base_url, 'GET', '/version')
+            assert response.status_code == 200
+            assert breaker.state == 'closed'
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def test_health_check_closes_circuit_of_unreplicated_node(cluster):
+    async def main():
+        server = cluster.server(breaker_reset_timeout=math.inf, health_check_interval=0.01)
+        base_url = f"http://artists-2:8000"
+        breaker = server._node_state(base_url).breaker
+        breaker.state = 'open'
+        breaker.opened_at = time.time()
+        task = asyncio.ensure_future(server._health_check_loop())
+        try:
+            await asyncio.sleep(0.1)
+            assert breaker.state == 'closed'
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.client.aclose()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('query, semi_join', [
+    ("SELECT artists.id, labels.name FROM artists JOIN labels ON artists.label_id = labels.id WHERE labels.founded > 2010", True),
+    ("SELECT artists.id, labels.name FROM artists JOIN labels ON artists.label_id = labels.id OR artists.id = labels.id "
+     "WHERE labels.founded > 2010", False),
+    ("SELECT artists.id, labels.name FROM artists JOIN labels ON artists.id = labels.id OR artists.label_id = labels.id "
+     "AND artists.score > 50 WHERE labels.founded > 2010", False),
+])
+def test_broadcast_joins_match_duckdb(cluster, query, semi_join):
+    response = run_query(cluster, query, broadcast_max_rows=LABEL_ROWS)
+    expected = cluster.reference.execute(query).fetchall()
+    assert sorted(rows_of(response)) == sorted(expected)
+    # labels is loaded once into the router; artists only sends the rows of the keys it holds
+    # when the join is a plain equi-join
+    assert cluster.queried()['labels-0'] == cluster.queried()['labels-1'] == 1
+    artist_rows = sum(cluster.nodes[host].rows_sent for host in ARTIST_SHARDS)
+    assert (artist_rows < ARTIST_ROWS) == semi_join
+
+def test_explain_plans_broadcast_without_loading_it(cluster):
+    query = "SELECT artists.id, labels.name FROM artists JOIN labels ON artists.label_id = labels.id WHERE labels.founded > 2010"
+    async def main():
+        server = cluster.server(broadcast_max_rows=LABEL_ROWS)
+        try:
+            plan = await server.explain_query(dq.QueryRequest(query=query))
+            assert plan.strategy == 'local_join'
+            assert plan.details['broadcast'] == ['labels']
+            assert plan.details['broadcast_unloaded'] == ['labels']
+            assert not plan.details['semi_joins']
+            assert {fragment.table for fragment in plan.fragments} == {'artists'}
+            assert not server._broadcast_tables
+            assert not cluster.queried()['labels-0'] and not cluster.queried()['labels-1']
+
+            # Once the copy is resident, explain shows the keys it pushes
+            await server.execute_query(dq.QueryRequest(query=query))
+            plan = await server.explain_query(dq.QueryRequest(query=query))
+            assert plan.details['broadcast_unloaded'] == []
+            assert plan.details['semi_joins']
+            assert all('label_id IN' in fragment.sql for fragment in plan.fragments)
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def test_job_runs_in_background_and_pages_its_result(cluster, tmp_path):
+    query = "SELECT country, COUNT(*) AS artists FROM artists GROUP BY country ORDER BY country"
+    async def main():
+        server = cluster.server(job_spool_dir=str(tmp_path))
+        try:
+            job = server.submit_job(dq.QueryRequest(query=query))
+            assert job.status == 'queued'
+            await server._jobs[job.job_id].task
+            status = server.get_job_status(job.job_id)
+            assert status.status == 'succeeded'
+            assert status.fragments_done == status.fragments_started == len(ARTIST_SHARDS)
+
+            pages = []
+            offset = 0
+            while offset is not None:
+                page = await server.get_job_result(job.job_id, offset, 4)
+                pages.append(page)
+                offset = page.next_offset
+            assert [len(page.results) for page in pages] == [4, 4, 2]
+            rows = [tuple(row.values()) for page in pages for row in page.results]
+            assert rows == cluster.reference.execute(query).fetchall()
+
+            # Deleting a finished job removes its result file
+            path = server._jobs[job.job_id].path
+            await server.cancel_job(job.job_id)
+            assert not os.path.exists(path)
+            with pytest.raises(HTTPException) as error:
+                server.get_job_status(job.job_id)
+            assert error.value.status_code == 404
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def test_cancelled_job_stops_before_its_cursor_is_reused(cluster, tmp_path):
+    stopped = threading.Event()
+    async def main():
+        server = cluster.server(job_spool_dir=str(tmp_path), duckdb_sessions=1)
+        spool = server._spool_to_parquet
+
+        def slow_spool(session, query, path):
+            try:
+                spool(session, "SELECT COUNT(*) FROM range(100000000000) t(i) WHERE i % 7 = 3", path)
+            finally:
+                stopped.set()
+        server._spool_to_parquet = slow_spool
+        try:
+            job = server.submit_job(dq.QueryRequest(query="SELECT id FROM artists WHERE id = 5"))
+            while not server._jobs[job.job_id].fragments or server._jobs[job.job_id].session is None:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            status = await server.cancel_job(job.job_id)
+            # The interrupted COPY has stopped and handed back the only cursor
+            assert status.status == 'cancelled'
+            assert stopped.is_set()
+            assert server._cursor_pool.qsize() == 1
+            assert not os.path.exists(server._jobs[job.job_id].path)
+        finally:
+            await server.client.aclose()
+    asyncio.run(main())
+
+def stream_query(cluster, query: str, stream_format: str, max_rows: Optional[int] = None, **settings) -> List[tuple]:
+    """Stream a query through the router and decode the rows it sends."""
+    async def main():
+        server = cluster.server(**settings)
+        try:
+            response = await server.execute_query_stream(dq.QueryRequest(query=query, max_rows=max_rows), stream_format)
+            return b''.join([chunk async for chunk in response.body_iterator])
+        finally:
+            await server.client.aclose()
+    body = asyncio.run(main())
+    if stream_format == 'arrow':
+        table = pa.ipc.open_stream(body).read_all()
+        return [tuple(normalize(value) for value in row.values()) for row in table.to_pylist()]
+    return [tuple(normalize(value) for value in json.loads(line).values()) for line in body.decode().splitlines()]
+
+def reference_rows(cluster, query: str) -> List[tuple]:
+    return [tuple(normalize(value) for value in row) for row in cluster.reference.execute(query).fetchall()]
+
+@pytest.mark.parametrize('stream_format', ['ndjson', 'arrow'])
+@pytest.mark.parametrize('query', [
+    "SELECT id, name, score FROM artists WHERE id < 1000 ORDER BY id",
+    "SELECT id, name FROM artists WHERE id = 5",
+    "SELECT country, COUNT(*) FROM artists GROUP BY country ORDER BY country",
+])
+def test_streamed_results_match_duckdb(cluster, query, stream_format):
+    assert stream_query(cluster, query, stream_format, stream_batch_rows=100) == reference_rows(cluster, query)
+
+@pytest.mark.parametrize('stream_format', ['ndjson', 'arrow'])
+def test_forwarded_stream_is_capped_at_the_data_node(cluster, stream_format):
+    query = "SELECT id FROM artists WHERE id <= 600 ORDER BY id"
+    rows = stream_query(cluster, query, stream_format, max_rows=7)
+    assert rows == reference_rows(cluster, query)[:7]
+    # The single shard was asked for no more than the cap
+    assert cluster.queried()['artists-0'] == 1
+    assert cluster.rows_sent() == 7
+
+def test_server_cap_applies_to_gathered_streams(cluster):
+    query = "SELECT id FROM artists ORDER BY id"
+    rows = stream_query(cluster, query, 'arrow', max_rows=50, max_stream_rows=20, stream_batch_rows=8)
+    assert rows == reference_rows(cluster, query)[:20]
+
+def test_concurrent_joins_keep_their_temp_tables_apart(cluster):
+    # More queries than pooled cursors, each copying both join sides into temp tables
+    queries = [f"SELECT artists.id, labels.name FROM artists JOIN labels ON artists.label_id = labels.id "
+               f"WHERE artists.id BETWEEN {start} AND {start + 299}" for start in range(0, ARTIST_ROWS, 250)]
+
+    async def main():
+        server = cluster.server(duckdb_sessions=2, broadcast_max_rows=0)
+        try:
+            responses = await asyncio.gather(*[server.execute_query(dq.QueryRequest(query=query)) for query in queries])
+            cursors = [server._cursor_pool.get_nowait() for _ in range(server._cursor_pool.qsize())]
+            leftover = [cursor.execute("SELECT table_name FROM duckdb_tables() WHERE temporary").fetchall()
+                        for cursor in cursors]
+            return responses, leftover
+        finally:
+            await server.client.aclose()
+    responses, leftover = asyncio.run(main())
+    for query, response in zip(queries, responses):
+        assert sorted(rows_of(response)) == sorted(reference_rows(cluster, query))
+    assert leftover == [[], []]
+
+def test_cached_results_are_invalidated_by_a_new_data_version(cluster):
+    query = "SELECT country, COUNT(*) AS n FROM artists GROUP BY country"
+    other = "SELECT country, COUNT(*) AS artists FROM artists GROUP BY country"
+
+    async def main():
+        server = cluster.server(result_cache_mb=16, fragment_cache_mb=16, version_ttl=0)
+        try:
+            steps = []
+            async def step(sql):
+                before = cluster.queried()
+                response = await server.execute_query(dq.QueryRequest(query=sql))
+                steps.append((rows_of(response), {host: n - before[host] for host, n in cluster.queried().items() if n > before[host]}))
+            await step(query)
+            await step(query)
+            # A different query over the same shards reuses their cached fragments
+            await step(other)
+            cluster.nodes['artists-1'].version += '-changed'
+            await step(query)
+            return steps, server.result_cache.stats()
+        finally:
+            await server.client.aclose()
+    steps, stats = asyncio.run(main())
+    expected = sorted(reference_rows(cluster, query))
+    assert all(sorted(rows) == expected for rows, _ in steps)
+    assert steps[0][1] == {'artists-0': 1, 'artists-1': 1, 'artists-2': 1}
+    assert steps[1][1] == {}
+    assert steps[2][1] == {}
+    # Only the changed shard is asked again
+    assert steps[3][1] == {'artists-1': 1}
+    assert stats['hits'] == 1
+
+def replicated_server(cluster, tmp_path, **settings) -> dq.DistributedQueryServer:
+    """A router whose last artists shard is also served by a replica at host artists-2b."""
+    data_dir = os.path.dirname(cluster.config_path)
+    node = mdn.MockDataNode('artists', os.path.join(data_dir, 'artists.parquet'), SHARDS['artists-2'][1])
+    cluster.nodes['artists-2b'] = node
+    cluster.transport.transports['artists-2b'] = httpx.ASGITransport(app=mdn.create_app(node))
+    with open(cluster.config_path) as f:
+        config = json.load(f)
+    config['tables']['artists']['shards'][2]['replicas'] = [{'url': 'http://artists-2b', 'port': 8000}]
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+    cluster.config_path = str(config_path)
+    return cluster.server(**settings)
+
+def test_replicas_share_a_shards_queries(cluster, tmp_path):
+    query = "SELECT COUNT(*) AS n FROM artists WHERE id >= 1500"
+
+    async def main():
+        server = replicated_server(cluster, tmp_path)
+        try:
+            return await asyncio.gather(*[server.execute_query(dq.QueryRequest(query=query)) for _ in range(20)])
+        finally:
+            await server.client.aclose()
+    responses = asyncio.run(main())
+    assert all(rows_of(response) == reference_rows(cluster, query) for response in responses)
+    queried = cluster.queried()
+    assert queried['artists-2'] + queried['artists-2b'] == 20
+    assert queried['artists-2'] > 0 and queried['artists-2b'] > 0
+
+def test_failed_replica_fails_over_without_retrying(cluster, tmp_path):
+    query = "SELECT COUNT(*) AS n, MAX(id) AS top FROM artists"
+
+    async def main():
+        server = replicated_server(cluster, tmp_path, breaker_failure_threshold=2)
+        try:
+            cluster.transport.down.add('artists-2')
+            responses = [await server.execute_query(dq.QueryRequest(query=query)) for _ in range(4)]
+            return responses, server._node_state('http://artists-2:8000')
+        finally:
+            await server.client.aclose()
+    responses, down = asyncio.run(main())
+    assert all(rows_of(response) == reference_rows(cluster, query) for response in responses)
+    assert cluster.queried()['artists-2b'] == 4
+    # One attempt per query until the circuit opens, after which the replica is skipped
+    assert down.errors == {'transport': 2}
+    assert not down.breaker.available()
+
+def test_explain_analyze_reports_each_fragment(cluster):
+    query = "SELECT country, COUNT(*) AS n FROM artists WHERE id >= 500 GROUP BY country"
+
+    async def main():
+        server = cluster.server()
+        try:
+            plan = await server.explain_query(dq.QueryRequest(query=query))
+            explained = cluster.queried()
+            analyzed = await server.explain_query(dq.QueryRequest(query=query), analyze=True)
+            return plan, explained, analyzed
+        finally:
+            await server.client.aclose()
+    plan, explained, analyzed = asyncio.run(main())
+    assert plan.strategy == analyzed.strategy == 'partial_aggregation'
+    # Without analyze only the row estimates are asked for
+    assert explained == {host: int(host.startswith('artists')) for host in SHARDS}
+    assert all(fragment.rows is None and fragment.estimated_rows for fragment in plan.fragments)
+
+    assert [fragment.node for fragment in analyzed.fragments] == [f"http://{host}:8000" for host in ARTIST_SHARDS]
+    # Each shard sends one partial row per country
+    assert [fragment.rows for fragment in analyzed.fragments] == [
+        cluster.reference.execute(f"SELECT COUNT(DISTINCT country) FROM artists WHERE id >= 500 AND {SHARDS[host][1]}").fetchone()[0]
+        for host in ARTIST_SHARDS
+    ]
+    assert all(fragment.bytes and fragment.elapsed_ms is not None for fragment in analyzed.fragments)
+    assert analyzed.fetch_ms <= analyzed.total_ms and analyzed.local_ms is not None
+    assert 'HASH_GROUP_BY' in analyzed.profile
+
+def test_query_trace_continues_the_callers_and_reaches_the_nodes(cluster):
+    trace_id, caller_span = 'ab' * 16, 'cd' * 8
+    query = "SELECT country, COUNT(*) AS n FROM artists GROUP BY country"
+    sent = {}
+    handle = cluster.transport.handle_async_request
+
+    async def record(request):
+        sent[request.url.host] = request.headers.get('traceparent')
+        return await handle(request)
+    cluster.transport.handle_async_request = record
+
+    async def main():
+        server = cluster.server()
+        try:
+            response = await server.execute_query(dq.QueryRequest(query=query), f"00-{trace_id}-{caller_span}-01")
+            return response, server.tracer.get_trace(trace_id)
+        finally:
+            await server.client.aclose()
+    response, spans = asyncio.run(main())
+    assert response.trace_id == trace_id
+    by_id = {span['span_id']: span for span in spans}
+    assert spans[0]['name'] == 'query' and spans[0]['parent_id'] == caller_span
+    assert {span['name'] for span in spans} == {'query', 'parse', 'plan', 'fragment', 'register', 'execute_local'}
+
+    fragments = [span for span in spans if span['name'] == 'fragment']
+    assert sorted(span['attributes']['node'] for span in fragments) == [f"http://{host}:8000" for host in ARTIST_SHARDS]
+    assert all(span['attributes']['rows'] and span['attributes']['bytes'] for span in fragments)
+    # Each node was sent its fragment's span as the parent of its own spans
+    for span in fragments:
+        host = span['attributes']['node'][len('http://'):-len(':8000')]
+        assert sent[host] == f"00-{trace_id}-{span['span_id']}-01"
+        assert by_id[span['parent_id']]['name'] == 'plan'
+
+def test_metrics_count_queries_and_node_errors(cluster):
+    async def main():
+        server = cluster.server(retry_attempts=1)
+        try:
+            await server.execute_query(dq.QueryRequest(query="SELECT COUNT(*) FROM artists"))
+            cluster.transport.down.add('labels-1')
+            with pytest.raises(HTTPException):
+                await server.execute_query(dq.QueryRequest(query="SELECT COUNT(*) FROM labels"))
+            return server.render_metrics()
+        finally:
+            await server.client.aclose()
+    metrics = asyncio.run(main()).splitlines()
+    assert 'distributed_query_duration_seconds_count 1' in metrics
+    assert 'distributed_query_errors_total 1' in metrics
+    assert 'distributed_query_node_errors_total{node="http://labels-1:8000",kind="transport"} 1' in metrics
+    for host in ARTIST_SHARDS:
+        assert f'distributed_query_node_request_duration_seconds_count{{node="http://{host}:8000"}} 1' in metrics
+    rows = [line for line in metrics if line.startswith('distributed_query_node_received_rows_total{node="http://artists')]
+    assert rows == [f'distributed_query_node_received_rows_total{{node="http://{host}:8000"}} 1' for host in ARTIST_SHARDS]
+
+def test_large_fragments_spill_to_the_temp_directory(cluster, tmp_path, monkeypatch):
+    # An unsharded table whose fragments are several MB, over the 1 MB spill threshold
+    source = str(tmp_path / 'plays.parquet')
+    mdn.generate_synthetic_table('artists', 100000, source, label_rows=LABEL_ROWS)
+    node = mdn.MockDataNode('plays', source)
+    cluster.transport.transports['plays'] = httpx.ASGITransport(app=mdn.create_app(node))
+    with open(cluster.config_path) as f:
+        config = json.load(f)
+    config['tables']['plays'] = {'table_name': 'plays', 'url': 'http://plays', 'port': 8000}
+    cluster.config_path = str(tmp_path / 'config.json')
+    with open(cluster.config_path, 'w') as f:
+        json.dump(config, f)
+    cluster.reference.execute(f"CREATE VIEW plays AS SELECT * FROM read_parquet('{source}')")
+
+    spill_dir = tmp_path / 'spill'
+    spilled = []
+    named_temporary_file = dq.tempfile.NamedTemporaryFile
+
+    def record(**kwargs):
+        spill = named_temporary_file(**kwargs)
+        spilled.append(spill.name)
+        return spill
+    monkeypatch.setattr(dq.tempfile, 'NamedTemporaryFile', record)
+
+    query = ("SELECT labels.country, COUNT(*) AS plays, SUM(plays.score) AS score "
+             "FROM plays JOIN labels ON plays.label_id = labels.id GROUP BY labels.country")
+
+    async def main():
+        server = cluster.server(spill_threshold_mb=1, duckdb_temp_directory=str(spill_dir),
+                                duckdb_memory_limit='256MB', broadcast_max_rows=0)
+        try:
+            response = await server.execute_query(dq.QueryRequest(query=query))
+            return response, server.conn.execute("SELECT current_setting('temp_directory')").fetchone()[0]
+        finally:
+            await server.client.aclose()
+    response, temp_directory = asyncio.run(main())
+    assert sorted(rows_of(response)) == sorted(reference_rows(cluster, query))
+    assert temp_directory == str(spill_dir)
+    assert len(spilled) == 1
+    assert os.path.dirname(spilled[0]) == str(spill_dir)
+    # The file is removed once mapped
+    assert not os.listdir(spill_dir)
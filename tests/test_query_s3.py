@@ -0,0 +1,506 @@
+"""The data node serving gzipped CSV files from an in-memory stand-in for S3."""
+import asyncio
+import decimal
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import duckdb
+import httpx
+import pyarrow as pa
+import pytest
+
+# boto3 only creates the S3 client, which FakeS3 stands in for
+for module in ('boto3', 'botocore', 'botocore.config'):
+    sys.modules.setdefault(module, types.ModuleType(module))
+if not hasattr(sys.modules['botocore.config'], 'Config'):
+    sys.modules['botocore.config'].Config = lambda **kwargs: kwargs
+
+import query_s3 as qs
+
+BUCKET = 'bucket'
+KEY = 'feeds/artists.csv.gz'
+COLUMNS = "id, name, country, score"
+
+# Module globals describing the served data, as they are before anything is loaded
+NODE_STATE = {
+    'conn': None, 'view_name': None, 's3_url': None, 's3_client': None, 'load_time_ms': None,
+    'local_cache_path': None, 'last_modified': None, 'cache_status': None, 'data_version': None,
+    'storage_format': 'duckdb', 'storage_path': None, 'last_checked': None, 'refresh_error': None,
+    'table_statistics': None, 'dataset_paths': None, 'cursor_pool': None, 'query_executor': None,
+    'query_workers': 2, 'query_timeout': 120.0, 'queue_timeout': 30.0, 'index_columns': [],
+    'startup_phase': 'starting', 'startup_error': None, 'warmup_queries': [], 'warmup_errors': 0,
+    'warmup_time_ms': None,
+}
+
+class ClientError(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+class FakeS3:
+    """Objects held in memory, each uploaded in a single PUT, counting the GETs served.
+    GETs wait while hold is set to an event that is not set yet.
+    """
+
+    def __init__(self):
+        self.objects = {}  # Key -> (body, ETag, last modified)
+        self.gets = 0
+        self.fail_heads = False
+        self.hold = None
+        self.lock = threading.Lock()
+        self.clock = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def put(self, key: str, body: bytes) -> str:
+        self.clock += timedelta(minutes=1)
+        etag = hashlib.md5(body).hexdigest()
+        self.objects[key] = (body, etag, self.clock)
+        return etag
+
+    def etag(self, key: str = KEY) -> str:
+        return self.objects[key][1]
+
+    def head_bucket(self, Bucket):
+        pass
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        if self.fail_heads or Key not in self.objects:
+            raise ClientError('404')
+        body, etag, modified = self.objects[Key]
+        return {'ContentLength': len(body), 'ETag': f'"{etag}"', 'LastModified': modified}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        if self.hold is not None:
+            self.hold.wait(5)
+        body, etag, _ = self.objects[Key]
+        if IfMatch is not None and IfMatch != f'"{etag}"':
+            raise ClientError('PreconditionFailed')
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        with self.lock:
+            self.gets += 1
+        return {'Body': io.BytesIO(body[start:end + 1])}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [{'Key': key, 'ETag': f'"{etag}"', 'Size': len(body), 'LastModified': modified}
+                            for key, (body, etag, modified) in sorted(self.objects.items()) if key.startswith(Prefix)]}
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    """A fresh node caching to a temporary directory, with S3 replaced by a FakeS3."""
+    fake = FakeS3()
+    monkeypatch.setattr(qs.boto3, 'client', lambda *args, **kwargs: fake, raising=False)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setattr(qs, 'CACHE_DIR', str(tmp_path / 'cache'))
+    for name, value in NODE_STATE.items():
+        monkeypatch.setattr(qs, name, value.copy() if isinstance(value, list) else value, raising=False)
+    monkeypatch.setattr(qs, 'recent_traces', OrderedDict())
+    yield fake
+    if qs.query_executor is not None:
+        qs.query_executor.shutdown(wait=False)
+
+def artists(rows: int, start: int = 0) -> duckdb.DuckDBPyConnection:
+    """A connection with a table of synthetic artists with ids from start."""
+    connection = duckdb.connect()
+    connection.execute(f"""CREATE TABLE artists AS SELECT i AS id, 'Artist ' || i AS name,
+            ['US', 'GB', 'DE'][1 + i % 3] AS country, (i % 100) / 4.0 AS score,
+            DATE '2025-01-01' + (i % 30)::INTEGER AS joined
+        FROM range({start}, {start + rows}) t(i)""")
+    return connection
+
+def artists_csv(rows: int, start: int = 0) -> bytes:
+    """The synthetic artists as a gzipped CSV file's bytes."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'artists.csv.gz')
+        artists(rows, start).execute(f"COPY artists TO '{path}' (HEADER, COMPRESSION gzip)")
+        with open(path, 'rb') as f:
+            return f.read()
+
+def expected_rows(query: str, rows: int, start: int = 0):
+    return artists(rows, start).execute(query).fetchall()
+
+def load(key: str = KEY, fmt: str = 'duckdb', table: str = 'artists') -> None:
+    """Start the node on an object or dataset, as main() does, and check it became ready."""
+    qs.load_data(f"s3://{BUCKET}/{key}", table, fmt, False, 0)
+    assert qs.startup_phase == 'ready', qs.startup_error
+
+def call(method: str, path: str, **kwargs) -> httpx.Response:
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=qs.app), base_url='http://node') as client:
+            return await client.request(method, path, **kwargs)
+    return asyncio.run(main())
+
+def query_rows(query: str):
+    response = call('POST', '/query', json={'query': query})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    return [tuple(row[column] for column in body['columns']) for row in body['results']]
+
+@pytest.mark.parametrize('fmt', qs.STORAGE_FORMATS)
+def test_cached_csv_is_converted_once_per_etag(s3, fmt):
+    s3.put(KEY, artists_csv(500))
+    load(fmt=fmt)
+    assert qs.cache_status == 'DOWNLOADED'
+    assert qs.storage_path == qs.converted_path(qs.local_cache_path, s3.etag(), fmt)
+    query = f"SELECT {COLUMNS} FROM artists WHERE country = 'GB' ORDER BY id"
+    assert query_rows(query) == expected_rows(query, 500)
+
+    # A restart finds both the download and its converted copy
+    gets = s3.gets
+    converted = os.stat(qs.storage_path).st_mtime_ns
+    load(fmt=fmt)
+    assert qs.cache_status == 'HIT'
+    assert s3.gets == gets
+    assert os.stat(qs.storage_path).st_mtime_ns == converted
+    assert query_rows(query) == expected_rows(query, 500)
+
+def test_new_etag_is_converted_and_outdated_copies_removed(s3):
+    s3.put(KEY, artists_csv(500))
+    load()
+    old_copy = qs.storage_path
+    gets = s3.gets
+    s3.put(KEY, artists_csv(300, start=1000))
+    load()
+    assert qs.cache_status == 'DOWNLOADED' and s3.gets > gets
+    assert qs.storage_path == qs.converted_path(qs.local_cache_path, s3.etag(), 'duckdb')
+    assert not os.path.exists(old_copy)
+    assert sorted(os.listdir(qs.CACHE_DIR)) == sorted(
+        ['artists.csv.gz', 'artists.csv.gz.meta.json', 'artists.csv.gz.stats.json', os.path.basename(qs.storage_path)])
+    query = "SELECT MIN(id), COUNT(*) FROM artists"
+    assert query_rows(query) == [(1000, 300)]
+
+def test_changed_object_is_swapped_in_under_running_queries(s3):
+    s3.put(KEY, artists_csv(500))
+    load()
+    assert not qs.refresh_cache()
+    old_copy = qs.storage_path
+
+    # A stream opened on the current version holds a cursor of its pool across the refresh
+    stream = asyncio.run(qs.open_result_stream("SELECT id FROM artists ORDER BY id", [], None))
+    etag = s3.put(KEY, artists_csv(300, start=1000))
+    assert qs.refresh_cache()
+    assert qs.cursor_pool.connection is not stream.pool.connection
+    assert stream.reader.read_all().column('id').to_pylist() == list(range(500))
+    stream.close()
+    assert os.path.exists(old_copy)
+
+    metadata = call('GET', '/metadata').json()
+    assert (metadata['cache_status'], metadata['data_version'], metadata['row_count']) == ('REFRESHED', etag, 300)
+    assert call('GET', '/version').json()['version'] == etag
+    assert query_rows("SELECT MIN(id), COUNT(*) FROM artists") == [(1000, 300)]
+
+    # The next refresh removes the copy the previous version's queries were reading
+    s3.put(KEY, artists_csv(200))
+    assert qs.refresh_cache()
+    assert not os.path.exists(old_copy)
+
+def test_failed_refresh_keeps_serving_the_current_version(s3):
+    etag = s3.put(KEY, artists_csv(500))
+    load()
+    s3.put(KEY, artists_csv(300, start=1000))
+    s3.fail_heads = True
+    assert not qs.refresh_cache()
+    metadata = call('GET', '/metadata').json()
+    assert metadata['data_version'] == etag
+    assert metadata['refresh_error'] == "Could not get S3 object metadata"
+    assert query_rows("SELECT COUNT(*) FROM artists") == [(500,)]
+
+def test_statistics_are_computed_once_per_version(s3, monkeypatch):
+    s3.put(KEY, artists_csv(1000))
+    load()
+    statistics = call('GET', '/statistics').json()
+    assert statistics['row_count'] == 1000 and statistics['data_version'] == s3.etag()
+    columns = {column['name']: column for column in statistics['columns']}
+    assert (columns['id']['min'], columns['id']['max'], columns['id']['null_count']) == (0, 999, 0)
+    assert columns['country']['min'] == 'DE' and columns['country']['max'] == 'US'
+    assert columns['country']['histogram'] is None
+    # Equi-depth boundaries from min to max
+    histogram = columns['id']['histogram']
+    assert len(histogram) == qs.HISTOGRAM_BUCKETS + 1
+    assert histogram == sorted(histogram) and histogram[0] == 0 and histogram[-1] == 999
+    assert all(abs(boundary - i * 1000 / qs.HISTOGRAM_BUCKETS) < 50 for i, boundary in enumerate(histogram[1:-1], 1))
+    assert columns['joined']['histogram'][0] == '2025-01-01'
+    assert 2 <= columns['country']['distinct_count'] <= 4
+
+    # /metadata and later starts read the stored statistics rather than scanning the data
+    computed = []
+    compute_table_statistics = qs.compute_table_statistics
+    monkeypatch.setattr(qs, 'compute_table_statistics', lambda *args: computed.append(args) or compute_table_statistics(*args))
+    metadata = call('GET', '/metadata').json()
+    assert metadata['row_count'] == 1000 and [column['name'] for column in metadata['columns']] == list(columns)
+    load()
+    assert call('GET', '/statistics').json() == statistics
+    assert not computed
+
+    # A new version gets statistics of its own
+    etag = s3.put(KEY, artists_csv(10))
+    assert qs.refresh_cache()
+    assert len(computed) == 1
+    assert call('GET', '/statistics').json()['data_version'] == etag
+    assert call('GET', '/metadata').json()['row_count'] == 10
+
+@pytest.mark.parametrize('query, parameterized, params', [
+    ("SELECT * FROM t WHERE name = 'O''Brien' AND id > 5 LIMIT 10",
+     "SELECT * FROM t WHERE name = ? AND id > ? LIMIT 10", ["O'Brien", 5]),
+    ("SELECT id FROM t WHERE id IN (1, 2, 3) ORDER BY 1", "SELECT id FROM t WHERE id IN (?, ?, ?) ORDER BY 1", [1, 2, 3]),
+    ("SELECT CAST(x AS DECIMAL(10, 2)) FROM t WHERE x BETWEEN 1.5 AND 2e3",
+     "SELECT CAST(x AS DECIMAL(10, 2)) FROM t WHERE x BETWEEN ? AND ?", [decimal.Decimal('1.5'), 2000.0]),
+    ('SELECT "a = 1" FROM t -- id = 2', 'SELECT "a = 1" FROM t -- id = 2', []),
+    ("SELECT * FROM t WHERE d >= date '2025-05-04' AND d < DATE '2025-05-04' + INTERVAL '1 day'",
+     "SELECT * FROM t WHERE d >= CAST(? AS DATE) AND d < CAST(? AS DATE) + INTERVAL '1 day'", ['2025-05-04', '2025-05-04']),
+])
+def test_literals_are_extracted_where_they_can_be_bound(query, parameterized, params):
+    assert qs.extract_literals(query) == (parameterized, params)
+
+def test_statement_cache_parses_each_shape_once():
+    connection = artists(100)
+    cache = qs.StatementCache(connection.cursor(), max_size=2)
+    for name in ('Artist 1', 'Artist 2', 'Artist 3'):
+        query, params = qs.extract_literals(f"SELECT id FROM artists WHERE name = '{name}'")
+        assert cache.execute(query, params).fetchall() == [(int(name[-1]),)]
+    assert (cache.stats().parses, cache.stats().binds, cache.stats().cached_statements) == (1, 3, 1)
+
+    for query in ("SELECT COUNT(*) FROM artists WHERE id < ?", "SELECT MAX(id) FROM artists WHERE id < ?"):
+        cache.execute(query, [10])
+    assert (cache.stats().parses, cache.stats().evictions, cache.stats().cached_statements) == (3, 1, 2)
+
+    with pytest.raises(duckdb.Error):
+        cache.execute("SELEC nothing", [])
+    assert cache.stats().uncached == 1
+
+def test_several_statements_each_get_their_own_parameters(s3, monkeypatch):
+    monkeypatch.setattr(qs, 'query_workers', 1)
+    s3.put(KEY, artists_csv(100))
+    load()
+    query = "CREATE TEMP TABLE picked AS SELECT * FROM artists WHERE id < 10; SELECT name FROM picked WHERE id = 5"
+    assert query_rows(query) == [('Artist 5',)]
+    for name in ('Artist 7', 'Artist 8'):
+        assert query_rows(f"SELECT id FROM artists WHERE name = '{name}'") == [(int(name[-1]),)]
+    stats = call('GET', '/stats').json()
+    assert (stats['queries'], stats['uncached'], stats['parses'], stats['binds']) == (3, 1, 1, 2)
+
+def test_typed_literals_are_bound_as_casts(s3):
+    s3.put(KEY, artists_csv(100))
+    load()
+    query = "SELECT id FROM artists WHERE joined = DATE '2025-01-02' AND joined < DATE '2025-01-02' + INTERVAL '1 day' ORDER BY id"
+    assert query_rows(query) == expected_rows(query, 100) == [(1,), (31,), (61,), (91,)]
+
+SLOW_QUERY = "SELECT COUNT(*) FROM range(10000000000) t(i) WHERE i % 7 = 3"
+
+def race(*queries, delay: float = 0.1):
+    """Post queries, each after the previous has had time to take a cursor. Returns each
+    response with the seconds it took, once interrupted queries have handed back their cursors.
+    """
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=qs.app), base_url='http://node') as client:
+            async def post(i, query):
+                await asyncio.sleep(i * delay)
+                start_time = time.time()
+                response = await client.post('/query', json={'query': query})
+                return response, time.time() - start_time
+            responses = await asyncio.gather(*[post(i, query) for i, query in enumerate(queries)])
+        # Cursors come back through the event loop once the interrupted work stops
+        deadline = time.time() + 5
+        while qs.cursor_pool.idle.qsize() < len(qs.cursor_pool.caches) and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        return responses
+    return asyncio.run(main())
+
+def test_slow_query_does_not_hold_up_lookups_and_is_interrupted(s3, monkeypatch):
+    s3.put(KEY, artists_csv(100))
+    load()
+    monkeypatch.setattr(qs, 'query_timeout', 1.0)
+    (slow, slow_seconds), (lookup, lookup_seconds) = race(SLOW_QUERY, "SELECT name FROM artists WHERE id = 42")
+    assert lookup.status_code == 200 and lookup.json()['results'] == [{'name': 'Artist 42'}]
+    assert lookup_seconds < 0.5
+    assert slow.status_code == 504
+    assert slow_seconds < 5
+    assert qs.cursor_pool.idle.qsize() == 2
+
+def test_query_waiting_too_long_for_a_cursor_is_turned_away(s3, monkeypatch):
+    monkeypatch.setattr(qs, 'query_workers', 1)
+    s3.put(KEY, artists_csv(100))
+    load()
+    monkeypatch.setattr(qs, 'query_timeout', 1.0)
+    monkeypatch.setattr(qs, 'queue_timeout', 0.2)
+    (slow, _), (queued, queued_seconds) = race(SLOW_QUERY, "SELECT COUNT(*) FROM artists")
+    assert queued.status_code == 503 and queued.headers['Retry-After'] == '1'
+    assert queued_seconds < 0.9
+    assert slow.status_code == 504
+    assert qs.cursor_pool.idle.qsize() == 1
+    assert query_rows("SELECT COUNT(*) FROM artists") == [(100,)]
+
+def daily_key(day: str) -> str:
+    return f"feeds/daily/best_amer.out.{day}.csv.gz"
+
+def test_dated_files_are_one_table_pruned_by_date(s3):
+    for day, start in (('20250504', 0), ('20250505', 100), ('20250506', 200)):
+        s3.put(daily_key(day), artists_csv(100, start))
+    s3.put('feeds/daily/README.csv.gz', artists_csv(5))
+    load('feeds/daily/')
+    assert query_rows("SELECT CAST(effective_date AS VARCHAR), MIN(id), COUNT(*) FROM artists GROUP BY ALL ORDER BY 1") == [
+        ('2025-05-04', 0, 100), ('2025-05-05', 100, 100), ('2025-05-06', 200, 100)]
+    assert call('GET', '/metadata').json()['file_count'] == 3
+
+    # The date bound as a parameter still skips the other days' files
+    plan = query_rows("EXPLAIN ANALYZE SELECT COUNT(*) FROM artists WHERE effective_date = DATE '2025-05-05'")[0][1]
+    assert 'Scanning Files: 1/3' in plan
+
+    # A refresh fetches only the new day and stops serving the removed one
+    gets = s3.gets
+    del s3.objects[daily_key('20250504')]
+    s3.put(daily_key('20250507'), artists_csv(50, 300))
+    assert qs.refresh_cache()
+    assert s3.gets == gets + 1
+    assert query_rows("SELECT MIN(effective_date) = DATE '2025-05-05', COUNT(*) FROM artists") == [(True, 250)]
+    assert call('GET', '/metadata').json()['file_count'] == 3
+
+    # Its file is kept for queries of the previous version until the next refresh
+    days = ['effective_date=2025-05-05', 'effective_date=2025-05-06', 'effective_date=2025-05-07']
+    assert sorted(os.listdir(qs.local_cache_path)) == ['effective_date=2025-05-04'] + days
+    s3.put(daily_key('20250508'), artists_csv(50, 350))
+    assert qs.refresh_cache()
+    assert sorted(os.listdir(qs.local_cache_path)) == days + ['effective_date=2025-05-08']
+
+ARROW = 'application/vnd.apache.arrow.stream'
+
+@pytest.mark.parametrize('query', [
+    f"SELECT {COLUMNS}, joined FROM artists WHERE score > 20 ORDER BY id",
+    "SELECT id, name FROM artists WHERE id < 0",
+])
+def test_arrow_and_ndjson_responses_match_json(s3, monkeypatch, query):
+    monkeypatch.setattr(qs, 'stream_batch_rows', 100)
+    s3.put(KEY, artists_csv(1000))
+    load()
+    expected = artists(1000).execute(query).to_arrow_table()
+
+    response = call('POST', '/query', json={'query': query}, headers={'Accept': ARROW})
+    assert response.headers['content-type'] == ARROW
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.schema == expected.schema
+    assert table.equals(expected)
+
+    response = call('POST', '/query', json={'query': query}, headers={'Accept': 'application/x-ndjson'})
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.content.decode().splitlines()]
+    assert rows == json.loads(json.dumps(expected.to_pylist(), default=str))
+    assert qs.cursor_pool.idle.qsize() == 2
+
+def test_result_stream_returns_its_cursor_once(s3, monkeypatch):
+    monkeypatch.setattr(qs, 'stream_batch_rows', 10)
+    s3.put(KEY, artists_csv(1000))
+    load()
+
+    async def main():
+        stream = await qs.open_result_stream("SELECT id FROM artists", [], None)
+        held = qs.cursor_pool.idle.qsize()
+        # A client that goes away after the first batch
+        chunks = qs.stream_results(stream, 'arrow', qs.RequestTrace(None), 'SELECT id FROM artists', time.time())
+        await chunks.__anext__()
+        await chunks.aclose()
+        return held
+    assert asyncio.run(main()) == 1
+    assert qs.cursor_pool.idle.qsize() == 2
+
+    # Closed while a batch is being read, the cursor is returned once the read stops
+    stream = asyncio.run(qs.open_result_stream("SELECT id FROM artists", [], None))
+    reading, finish = threading.Event(), threading.Event()
+    read_chunk = qs.read_chunk
+
+    def slow_read_chunk(*args):
+        reading.set()
+        finish.wait(5)
+        return read_chunk(*args)
+    monkeypatch.setattr(qs, 'read_chunk', slow_read_chunk)
+    reader = threading.Thread(target=stream.read, args=(None, io.BytesIO()))
+    reader.start()
+    assert reading.wait(5)
+    stream.close()
+    assert qs.cursor_pool.idle.qsize() == 1
+    finish.set()
+    reader.join()
+    assert qs.cursor_pool.idle.qsize() == 2
+    stream.close()
+    assert stream.read(None, io.BytesIO()) is None
+    assert qs.cursor_pool.idle.qsize() == 2
+
+def test_node_is_ready_once_loaded_and_warmed_up(s3, monkeypatch):
+    monkeypatch.setattr(qs, 'warmup_queries', ["SELECT COUNT(*) FROM artists WHERE country = 'GB'", "SELECT nope FROM artists"])
+    s3.put(KEY, artists_csv(100))
+    s3.hold = threading.Event()
+    loader = threading.Thread(target=load)
+    loader.start()
+    try:
+        deadline = time.time() + 5
+        while qs.startup_phase != 'caching' and time.time() < deadline:
+            time.sleep(0.01)
+        live, ready = call('GET', '/health/live'), call('GET', '/health/ready')
+        assert live.status_code == 200 and live.json()['status'] == 'caching'
+        assert ready.status_code == 503 and not ready.json()['ready']
+        response = call('POST', '/query', json={'query': "SELECT COUNT(*) FROM artists"})
+        assert response.status_code == 503 and response.json()['detail'] == "Data not loaded yet (caching)"
+    finally:
+        s3.hold.set()
+        loader.join()
+
+    ready = call('GET', '/health/ready')
+    assert ready.status_code == 200
+    status = ready.json()
+    assert (status['status'], status['data_version'], status['warmup_queries'], status['warmup_errors']) == (
+        'ready', s3.etag(), 2, 1)
+    # Every cursor has the working warm-up statement parsed
+    warmed, _ = qs.extract_literals(qs.warmup_queries[0])
+    assert all(warmed in cache.statements for cache in qs.cursor_pool.caches)
+    assert query_rows("SELECT COUNT(*) FROM artists") == [(100,)]
+
+def test_failed_load_fails_the_liveness_probe(s3):
+    qs.load_data(f"s3://{BUCKET}/{KEY}", 'artists', 'duckdb', False, 0)
+    live = call('GET', '/health/live')
+    assert live.status_code == 503
+    assert live.json()['status'] == 'failed' and 'not found' in live.json()['error']
+    assert call('GET', '/health/ready').status_code == 503
+
+@pytest.mark.parametrize('fmt', ['duckdb', 'parquet'])
+def test_lookup_columns_sort_and_index_the_converted_copy(s3, monkeypatch, fmt):
+    monkeypatch.setattr(qs, 'index_columns', ['country', 'id'])
+    s3.put(KEY, artists_csv(1000))
+    load(fmt=fmt)
+    assert qs.storage_path.endswith(f".{s3.etag()}.by_country_id.{fmt}")
+    assert call('GET', '/metadata').json()['index_columns'] == ['country', 'id']
+
+    if fmt == 'duckdb':
+        stored = qs.conn.execute("SELECT country, id FROM storage.artists ORDER BY rowid").fetchall()
+        indexes = qs.conn.execute("SELECT index_name FROM duckdb_indexes() WHERE database_name = 'storage'").fetchall()
+        assert sorted(indexes) == [('artists_country_idx',), ('artists_id_idx',)]
+    else:
+        stored = duckdb.connect().execute(f"SELECT country, id FROM read_parquet('{qs.storage_path}')").fetchall()
+    assert stored == sorted(stored)
+
+    for query in (f"SELECT {COLUMNS} FROM artists WHERE id IN (5, 6, 700) ORDER BY id",
+                  f"SELECT {COLUMNS} FROM artists WHERE country = 'GB' AND id = 4"):
+        assert query_rows(query) == expected_rows(query, 1000)
+
+def test_other_lookup_columns_convert_the_file_again(s3, monkeypatch):
+    s3.put(KEY, artists_csv(100))
+    load()
+    unsorted = qs.storage_path
+    monkeypatch.setattr(qs, 'index_columns', ['name'])
+    load()
+    assert qs.storage_path == unsorted.replace('.duckdb', '.by_name.duckdb')
+    assert not os.path.exists(unsorted)
+
+    # CSV storage is queried as downloaded, so it reports no lookup columns
+    load(fmt='csv')
+    assert call('GET', '/metadata').json()['index_columns'] == []
@@ -0,0 +1,123 @@
+"""Parallel ranged downloads against an in-memory stand-in for S3."""
+import hashlib
+import io
+import os
+import threading
+
+import pytest
+
+import s3_download as sd
+
+DATA = bytes(range(256)) * 40 + b'tail'
+
+class ClientError(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+class FakeS3:
+    """One object uploaded in parts of the given sizes (a single PUT if None), counting requests."""
+
+    def __init__(self, part_sizes=None, corrupt_at=None, fail_at=(), fail_part_heads=False):
+        self.part_sizes = part_sizes
+        self.corrupt_at = corrupt_at
+        self.fail_at = set(fail_at)
+        self.fail_part_heads = fail_part_heads
+        self.part_heads = []
+        self.gets = 0
+        self.lock = threading.Lock()
+        if part_sizes:
+            assert sum(part_sizes) == len(DATA)
+            starts = [sum(part_sizes[:i]) for i in range(len(part_sizes))]
+            self.etag = sd.multipart_etag([hashlib.md5(DATA[start:start + size]).digest()
+                                           for start, size in zip(starts, part_sizes)])
+        else:
+            self.etag = hashlib.md5(DATA).hexdigest()
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        if PartNumber is None:
+            return {'ContentLength': len(DATA), 'ETag': f'"{self.etag}"'}
+        with self.lock:
+            self.part_heads.append(PartNumber)
+        if self.fail_part_heads:
+            raise ClientError('400')
+        return {'ContentLength': self.part_sizes[PartNumber - 1], 'ETag': f'"{self.etag}"'}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        assert IfMatch == f'"{self.etag}"'
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        with self.lock:
+            self.gets += 1
+            if start in self.fail_at:
+                self.fail_at.discard(start)
+                raise ClientError('PreconditionFailed')
+        chunk = DATA[start:end + 1]
+        if self.corrupt_at is not None and start <= self.corrupt_at <= end:
+            offset = self.corrupt_at - start
+            chunk = chunk[:offset] + bytes([chunk[offset] ^ 1]) + chunk[offset + 1:]
+        return {'Body': io.BytesIO(chunk)}
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'object.bin')
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_single_upload_is_verified_against_its_md5(path):
+    s3 = FakeS3()
+    sd.download_object(s3, 'bucket', 'key', path, part_size=1000, concurrency=4)
+    assert read(path) == DATA
+    assert s3.gets == 11
+    assert not os.path.exists(f"{path}.part.json")
+
+def test_uniform_parts_are_inferred_from_the_first_and_last(path):
+    s3 = FakeS3([3000, 3000, 3000, len(DATA) - 9000])
+    info = sd.download_object(s3, 'bucket', 'key', path, part_size=1000)
+    assert read(path) == DATA
+    assert sorted(s3.part_heads) == [1, 4]
+    assert info['upload_part_sizes_inferred']
+    # Aligned to the upload's parts so their MD5s are checked as they arrive
+    assert s3.gets == 4
+
+def test_uneven_parts_are_all_looked_up(path):
+    s3 = FakeS3([3000, 5000, 2000, len(DATA) - 10000])
+    info = sd.download_object(s3, 'bucket', 'key', path, part_size=1000)
+    assert read(path) == DATA
+    assert sorted(s3.part_heads) == [1, 1, 2, 3, 4, 4]
+    assert info['upload_part_sizes'] == s3.part_sizes
+    assert not info['upload_part_sizes_inferred']
+
+def test_wrongly_inferred_parts_are_looked_up_before_failing(path):
+    # The first and last parts add up as if the middle ones were all 3000 bytes
+    s3 = FakeS3([3000, 2000, 4000, len(DATA) - 9000])
+    sd.download_object(s3, 'bucket', 'key', path, part_size=1000)
+    assert read(path) == DATA
+    assert sorted(s3.part_heads) == [1, 1, 2, 3, 4, 4]
+
+@pytest.mark.parametrize('part_sizes', [None, [3000, 3000, 3000, len(DATA) - 9000]])
+def test_corrupt_download_is_discarded(path, part_sizes):
+    s3 = FakeS3(part_sizes, corrupt_at=4321)
+    with pytest.raises(sd.ChecksumError):
+        sd.download_object(s3, 'bucket', 'key', path, part_size=1000)
+    assert not os.path.exists(path)
+    assert not os.path.exists(f"{path}.part")
+
+def test_unverifiable_parts_fall_back_to_the_size(path):
+    s3 = FakeS3([3000, 3000, 3000, len(DATA) - 9000], corrupt_at=4321, fail_part_heads=True)
+    info = sd.download_object(s3, 'bucket', 'key', path, part_size=1000)
+    assert info['upload_part_sizes'] is None
+    assert len(read(path)) == len(DATA)
+
+def test_failed_download_resumes_from_written_parts(path):
+    s3 = FakeS3(fail_at={5000})
+    with pytest.raises(ClientError):
+        sd.download_object(s3, 'bucket', 'key', path, part_size=1000, concurrency=1)
+    assert os.path.exists(f"{path}.part")
+
+    s3.gets = 0
+    sd.download_object(s3, 'bucket', 'key', path, part_size=1000, concurrency=1)
+    assert read(path) == DATA
+    # Parts 0-4 were written before part 5 failed
+    assert s3.gets <= 6